@@ -0,0 +1,231 @@
+#!/usr/bin/python
+import os
+import asyncio
+import contextlib
+import time
+import aiohttp
+import backoff
+
+
+"""
+Client for the aca-py agent admin API, used to verify OrgBook credentials against the agent wallet.
+
+Credentials are either listed in bulk (paging through the agent's credential listing), or verified one at a time.
+Requests are made concurrently over a single (keep-alive) aiohttp session, with an adaptive limit on the
+number of requests in flight.  Requests that time out or get a server error (5xx) are retried with backoff.
+
+The limit is adjusted AIMD-style (like TCP congestion control): it goes up by one for every "limit" requests
+that succeed within the target latency, and is cut by a factor when requests are slow, time out or get a
+server error - so the audit finds the highest rate the agent can handle without degrading it.
+"""
+
+# value for PROD is "https://agent-admin.orgbook.gov.bc.ca/credential/"
+AGENT_API_URL = os.environ.get("AGENT_API_URL", "http://localhost:8021/credential/")
+AGENT_API_KEY = os.environ.get("AGENT_API_KEY")
+# credential listing endpoint (paged), the default is AGENT_API_URL with "/credential/" replaced by "/credentials"
+AGENT_API_LIST_URL = os.environ.get("AGENT_API_LIST_URL", AGENT_API_URL.rstrip("/") + "s")
+
+# max (ceiling) and min (floor) number of agent requests in flight at the same time
+AGENT_API_CONCURRENCY = int(os.environ.get("AGENT_API_CONCURRENCY", "20"))
+AGENT_API_MIN_CONCURRENCY = int(os.environ.get("AGENT_API_MIN_CONCURRENCY", "2"))
+# requests slower than this are treated as a sign the agent is overloaded
+AGENT_API_TARGET_LATENCY_SECONDS = float(os.environ.get("AGENT_API_TARGET_LATENCY_SECONDS", "1"))
+# the concurrency limit is multiplied by this when the agent is overloaded
+AGENT_API_DECREASE_FACTOR = float(os.environ.get("AGENT_API_DECREASE_FACTOR", "0.5"))
+# timeout for each agent request (including reading the response)
+AGENT_API_TIMEOUT_SECONDS = float(os.environ.get("AGENT_API_TIMEOUT_SECONDS", "30"))
+# number of tries (including the first) for requests that time out or get a server error
+AGENT_API_MAX_TRIES = int(os.environ.get("AGENT_API_MAX_TRIES", "5"))
+# number of credentials per page when listing the wallet credentials
+AGENT_API_PAGE_SIZE = int(os.environ.get("AGENT_API_PAGE_SIZE", "1000"))
+
+REPORT_COUNT = 10000
+
+
+def is_permanent_error(error):
+    """
+    Client errors (e.g. 404 not found) are not retried, only timeouts, connection errors and 5xx responses.
+    """
+    return isinstance(error, aiohttp.ClientResponseError) and error.status < 500
+
+
+class AdaptiveLimiter:
+    """
+    AIMD limit on the number of agent requests in flight, between min_limit and max_limit.
+    Also keeps the request stats, to report the throughput achieved.
+    """
+
+    def __init__(
+        self,
+        min_limit: int = AGENT_API_MIN_CONCURRENCY,
+        max_limit: int = AGENT_API_CONCURRENCY,
+        target_latency: float = AGENT_API_TARGET_LATENCY_SECONDS,
+        decrease_factor: float = AGENT_API_DECREASE_FACTOR,
+    ):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.target_latency = target_latency
+        self.decrease_factor = decrease_factor
+        self.limit = float(self.min_limit)
+        self.in_flight = 0
+        # (created on first use, so it belongs to the running event loop)
+        self.condition = None
+        self.last_decrease = 0.0
+        self.start_time = time.perf_counter()
+        self.requests = 0
+        self.errors = 0
+        self.slow_requests = 0
+        self.latency_total = 0.0
+
+    async def acquire(self):
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight = self.in_flight + 1
+
+    async def release(self, latency, overloaded):
+        async with self.condition:
+            self.in_flight = self.in_flight - 1
+            self.requests = self.requests + 1
+            self.latency_total = self.latency_total + latency
+            now = time.perf_counter()
+            if overloaded:
+                # cut the limit at most once per latency window, since the requests already in flight will also be slow
+                if self.target_latency < now - self.last_decrease:
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    self.last_decrease = now
+            else:
+                self.limit = min(self.max_limit, self.limit + (1.0 / self.limit))
+            self.condition.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def request(self):
+        """
+        Waits for a free slot, and times the request made within the "async with" block.
+        """
+        await self.acquire()
+        start_time = time.perf_counter()
+        overloaded = False
+        try:
+            yield
+            if self.target_latency < time.perf_counter() - start_time:
+                self.slow_requests = self.slow_requests + 1
+                overloaded = True
+        except Exception as e:
+            if not is_permanent_error(e):
+                self.errors = self.errors + 1
+                overloaded = True
+            raise
+        finally:
+            await self.release(time.perf_counter() - start_time, overloaded)
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start_time
+        print(
+            "Agent requests:", self.requests, "in {:.1f} sec ({:.1f}/sec)".format(elapsed, self.requests / elapsed if elapsed else 0.0),
+            ", avg latency: {:.3f} sec".format(self.latency_total / self.requests if self.requests else 0.0),
+            ", errors:", self.errors, ", slow:", self.slow_requests,
+            ", concurrency: {:.1f} ({}-{})".format(self.limit, self.min_limit, self.max_limit),
+        )
+
+
+def agent_session(concurrency: int = AGENT_API_CONCURRENCY):
+    """
+    Opens a keep-alive session to the agent admin API (use with "async with").
+    """
+    headers = {"x-api-key": AGENT_API_KEY} if AGENT_API_KEY else {}
+    return aiohttp.ClientSession(
+        headers=headers,
+        connector=aiohttp.TCPConnector(limit=concurrency),
+        timeout=aiohttp.ClientTimeout(total=AGENT_API_TIMEOUT_SECONDS),
+        raise_for_status=True,
+    )
+
+
+@backoff.on_exception(
+    backoff.expo,
+    (asyncio.TimeoutError, aiohttp.ClientError),
+    max_tries=lambda: AGENT_API_MAX_TRIES,
+    giveup=is_permanent_error,
+)
+async def get_agent_credential(session, limiter, credential_id):
+    """
+    Reads a credential from the agent wallet, raises an exception if it doesn't exist.
+    """
+    async with limiter.request():
+        async with session.get(AGENT_API_URL + credential_id) as response:
+            return await response.json(content_type=None)
+
+
+async def verify_agent_credentials(credential_ids, limiter: AdaptiveLimiter = None, session=None):
+    """
+    Checks which of the credential id's exist in the agent wallet, with the number of requests in flight set by the limiter.
+    Returns a list (in the same order as credential_ids) with None for credentials that exist in the wallet,
+    or the exception raised by the agent request for credentials that don't.
+    The requests use the session if one is given (e.g. shared by a series of calls), otherwise a new session is opened.
+    """
+    if limiter is None:
+        limiter = AdaptiveLimiter()
+    results = [None] * len(credential_ids)
+    pending = iter(enumerate(credential_ids))
+    verified = [0]
+
+    async def verify_worker(session):
+        # each worker takes the next credential off the (shared) iterator until they are all verified
+        for (i, credential_id) in pending:
+            try:
+                await get_agent_credential(session, limiter, credential_id)
+            except Exception as e:
+                results[i] = e
+            verified[0] += 1
+            if 0 == verified[0] % REPORT_COUNT:
+                print("Verified", verified[0], "of", len(credential_ids), "credentials with the agent, concurrency: {:.1f}".format(limiter.limit))
+
+    # (one worker for each request that could be in flight, the limiter decides how many actually are)
+    workers = max(1, min(limiter.max_limit, len(credential_ids)))
+    if session is None:
+        async with agent_session(limiter.max_limit) as session:
+            await asyncio.gather(*[verify_worker(session) for _ in range(workers)])
+    else:
+        await asyncio.gather(*[verify_worker(session) for _ in range(workers)])
+
+    return results
+
+
+@backoff.on_exception(
+    backoff.expo,
+    (asyncio.TimeoutError, aiohttp.ClientError),
+    max_tries=lambda: AGENT_API_MAX_TRIES,
+    giveup=is_permanent_error,
+)
+async def get_agent_credential_page(session, limiter, start, count):
+    """
+    Reads a page of credentials from the agent wallet listing, returns the credential id's (referents).
+    """
+    async with limiter.request():
+        async with session.get(AGENT_API_LIST_URL, params={"start": str(start), "count": str(count)}) as response:
+            page = await response.json(content_type=None)
+            return [credential["referent"] for credential in page["results"]]
+
+
+async def list_agent_credential_ids(page_size: int = AGENT_API_PAGE_SIZE, limiter: AdaptiveLimiter = None):
+    """
+    Pages through the agent wallet credential listing, yielding the credential id's a page at a time.
+    Pages are requested in windows of up to the limiter's max concurrency, the listing ends at the first short page.
+    """
+    if limiter is None:
+        limiter = AdaptiveLimiter()
+    window = limiter.max_limit
+    start = 0
+    async with agent_session(window) as session:
+        while True:
+            pages = await asyncio.gather(*[
+                get_agent_credential_page(session, limiter, start + (page * page_size), page_size)
+                for page in range(window)
+            ])
+            start = start + (window * page_size)
+            for credential_ids in pages:
+                yield credential_ids
+                if len(credential_ids) < page_size:
+                    return
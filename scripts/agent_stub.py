@@ -0,0 +1,98 @@
+#!/usr/bin/python
+import argparse
+import asyncio
+import csv
+import random
+
+from aiohttp import web
+
+
+"""
+Local stub of the aca-py agent admin API, for testing detail_audit_report_agent.py offline.
+
+Serves the two endpoints used by the audit:
+- GET /credential/{credential_id} - a single wallet credential (404 if it isn't in the wallet)
+- GET /credentials?start=&count= - a page of the wallet credential listing
+
+The wallet credential id's are read from a file (one per line, or an exported wallet id csv file).
+"""
+
+
+def read_wallet_ids(file_name):
+    """
+    Reads the wallet credential id's, either one per line or from the "wallet_id" column of a csv file.
+    """
+    with open(file_name, mode='r') as ids_file:
+        first_line = ids_file.readline()
+        ids_file.seek(0)
+        if "wallet_id" in first_line:
+            return [row["wallet_id"] for row in csv.DictReader(ids_file)]
+        return [line.strip() for line in ids_file if line.strip()]
+
+
+def stub_app(wallet_ids, error_rate: float = 0.0, delay: float = 0.0):
+    wallet_id_set = set(wallet_ids)
+
+    async def maybe_fail():
+        # simulate a slow and/or flaky agent
+        if delay:
+            await asyncio.sleep(delay)
+        if error_rate and random.random() < error_rate:
+            raise web.HTTPServiceUnavailable()
+
+    async def get_credential(request):
+        await maybe_fail()
+        credential_id = request.match_info["credential_id"]
+        if credential_id not in wallet_id_set:
+            raise web.HTTPNotFound()
+        return web.json_response({"referent": credential_id})
+
+    async def list_credentials(request):
+        await maybe_fail()
+        start = int(request.query.get("start", "0"))
+        count = int(request.query.get("count", "10"))
+        page = wallet_ids[start:start + count]
+        return web.json_response({"results": [{"referent": credential_id} for credential_id in page]})
+
+    app = web.Application()
+    app.router.add_get("/credential/{credential_id}", get_credential)
+    app.router.add_get("/credentials", list_credentials)
+    return app
+
+
+# mainline
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Runs a local stub of the agent admin API (credential lookup and listing)."
+    )
+    parser.add_argument(
+        "--ids",
+        required=True,
+        help="File of wallet credential id's (one per line, or an exported wallet id csv file).",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8021,
+        required=False,
+        help="Port to listen on (default 8021).",
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        required=False,
+        help="Fraction of requests that fail with a 503 (default 0).",
+    )
+    parser.add_argument(
+        "--delay",
+        type=float,
+        default=0.0,
+        required=False,
+        help="Seconds to wait before responding to each request (default 0).",
+    )
+    args = parser.parse_args()
+
+    wallet_ids = read_wallet_ids(args.ids)
+    print("Serving", len(wallet_ids), "wallet credentials on port", args.port)
+    web.run_app(stub_app(wallet_ids, error_rate=args.error_rate, delay=args.delay), port=args.port)
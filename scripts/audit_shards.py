@@ -0,0 +1,168 @@
+#!/usr/bin/python
+import concurrent.futures
+import datetime
+import json
+import multiprocessing
+import os
+import time
+
+from config import release_connections
+from orgbook_data_load import (
+    get_bc_reg_corps_sorted,
+    get_bc_reg_corps_sorted_csv,
+    get_orgbook_all_corps_sorted,
+    get_orgbook_all_corps_sorted_csv,
+)
+from orgbook_data_audit import AuditResults, merge_compare_corps
+
+
+"""
+Sharded BC Reg / OrgBook audit.
+
+The corps are split into shards by a stable hash of the corp num (see corp_shard() in config.py),
+and each shard is extracted and compared separately - either by a pool of worker processes, or by
+separate jobs (e.g. OpenShift job pods) which each save their results to a file.  The results of
+all the shards are then merged (along with the relationship checks) into a single report.
+"""
+
+SHARD_RESULTS_FILE = 'export/audit_shard_{}_of_{}.json'
+
+
+def shard_results_file(shard_index, shard_count):
+    return SHARD_RESULTS_FILE.format(shard_index, shard_count)
+
+
+def audit_shard(
+    shard_index,
+    shard_count,
+    bc_reg_relation_corp_nums,
+    future_corps,
+    ignore_list,
+    USE_LEAR: bool = False,
+    USE_CSV: bool = False,
+):
+    """
+    Extracts and compares the corps in one shard.
+    Returns the results as a dict (see AuditResults.as_dict()), plus the BC Reg relationship corps found in the shard.
+    """
+    shard = (shard_index, shard_count)
+    start_time = time.perf_counter()
+    print("Audit shard {} of {}".format(shard_index, shard_count), datetime.datetime.now())
+    try:
+        if USE_CSV:
+            bc_reg_corps = get_bc_reg_corps_sorted_csv(shard=shard)
+            orgbook_corps = get_orgbook_all_corps_sorted_csv(shard=shard)
+        else:
+            bc_reg_corps = get_bc_reg_corps_sorted(USE_LEAR=USE_LEAR, shard=shard)
+            orgbook_corps = get_orgbook_all_corps_sorted(shard=shard)
+
+        results = AuditResults(future_corps, ignore_list, USE_LEAR=USE_LEAR)
+        found_relation_corp_nums = merge_compare_corps(results, bc_reg_corps, orgbook_corps, bc_reg_relation_corp_nums)
+    finally:
+        # (the worker process is re-used for other shards)
+        release_connections()
+
+    shard_results = results.as_dict()
+    shard_results["shard"] = [shard_index, shard_count]
+    shard_results["relation_corp_nums"] = sorted(found_relation_corp_nums)
+    print("Audited shard {} of {} in {:.2f} sec".format(shard_index, shard_count, time.perf_counter() - start_time))
+    return shard_results
+
+
+def run_audit_shards(
+    shard_count,
+    max_workers,
+    bc_reg_relation_corp_nums,
+    future_corps,
+    ignore_list,
+    USE_LEAR: bool = False,
+    USE_CSV: bool = False,
+):
+    """
+    Audits all the shards in a pool of worker processes, returns the list of shard results.
+    Workers are started with "spawn" so they open their own database connections.
+    If any shard fails the shards that haven't started yet are cancelled and the exception is re-raised.
+    """
+    shard_results = [None] * shard_count
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+    try:
+        futures = {
+            executor.submit(
+                audit_shard,
+                shard_index,
+                shard_count,
+                bc_reg_relation_corp_nums,
+                future_corps,
+                ignore_list,
+                USE_LEAR=USE_LEAR,
+                USE_CSV=USE_CSV,
+            ): shard_index
+            for shard_index in range(shard_count)
+        }
+        for future in concurrent.futures.as_completed(futures):
+            shard_index = futures[future]
+            error = future.exception()
+            if error is not None:
+                print("Audit of shard {} failed: {}".format(shard_index, error))
+                for other_future in futures:
+                    other_future.cancel()
+                raise error
+            shard_results[shard_index] = future.result()
+    finally:
+        executor.shutdown(wait=True)
+
+    return shard_results
+
+
+def write_shard_results(shard_results):
+    """
+    Saves the results of a shard (to be merged later by merge_shard_results()).
+    """
+    (shard_index, shard_count) = shard_results["shard"]
+    file_name = shard_results_file(shard_index, shard_count)
+    tmp_file_name = file_name + ".tmp"
+    with open(tmp_file_name, mode='w') as results_file:
+        json.dump(shard_results, results_file)
+    os.replace(tmp_file_name, file_name)
+    print("Saved shard results to", file_name)
+
+
+def read_shard_results(shard_count):
+    """
+    Reads the saved results of all the shards, fails if any shard is missing.
+    """
+    shard_results = []
+    for shard_index in range(shard_count):
+        file_name = shard_results_file(shard_index, shard_count)
+        if not os.path.exists(file_name):
+            raise Exception("Missing results for shard " + str(shard_index) + " of " + str(shard_count) + ": " + file_name)
+        with open(file_name, mode='r') as results_file:
+            shard_results.append(json.load(results_file))
+    return shard_results
+
+
+def merge_shard_results(
+    shard_results,
+    bc_reg_owners,
+    orgbook_corp_missing_relations,
+    orgbook_corp_active_relations,
+    future_corps,
+    ignore_list,
+    USE_LEAR: bool = False,
+):
+    """
+    Merges the results of all the shards, checks the relationships and reports.
+    Returns the list of corps with the wrong business number (the same as compare_bc_reg_orgbook()).
+    """
+    results = AuditResults(future_corps, ignore_list, USE_LEAR=USE_LEAR)
+    found_relation_corp_nums = set()
+    for shard_result in sorted(shard_results, key=lambda shard_result: shard_result["shard"][0]):
+        results.merge(shard_result)
+        found_relation_corp_nums.update(shard_result["relation_corp_nums"])
+
+    results.compare_relations(found_relation_corp_nums, bc_reg_owners, orgbook_corp_missing_relations, orgbook_corp_active_relations)
+
+    return results.report()
@@ -1,9 +1,17 @@
 #!/usr/bin/python
+import hashlib
+import itertools
 import json
 import os
 import psycopg2
+import psycopg2.pool
+import threading
+import time
 import traceback
 import logging
+import weakref
+
+from contextlib import contextmanager
 
 from rocketchat_hooks import log_error, log_warning, log_info
 
@@ -94,112 +102,459 @@ def config(db_name):
     return db
 
 
-# pre-connected databases
-db_conns = {}
+# TCP keepalives, so a long-running query or idle pooled connection isn't silently dropped
+DB_KEEPALIVES_IDLE = os.environ.get('DB_KEEPALIVES_IDLE', '30')
+DB_KEEPALIVES_INTERVAL = os.environ.get('DB_KEEPALIVES_INTERVAL', '10')
+DB_KEEPALIVES_COUNT = os.environ.get('DB_KEEPALIVES_COUNT', '5')
+
+# connection pool sizes, can be overridden per database (e.g. ORGBOOK_DB_POOL_MAX)
+# (DB_POOL_MIN connections are opened when the pool is created, up to DB_POOL_MAX are kept open once they're opened)
+DB_POOL_MIN = os.environ.get('DB_POOL_MIN', '1')
+DB_POOL_MAX = os.environ.get('DB_POOL_MAX', '4')
+
+# pooled connections idle for longer than this are checked before they are handed out
+DB_HEALTH_CHECK_IDLE_SECONDS = int(os.environ.get('DB_HEALTH_CHECK_IDLE_SECONDS', '60'))
+
+# number of times a read is retried on a fresh connection if the connection fails
+DB_RECONNECT_ATTEMPTS = int(os.environ.get('DB_RECONNECT_ATTEMPTS', '3'))
+DB_RECONNECT_DELAY_SECONDS = int(os.environ.get('DB_RECONNECT_DELAY_SECONDS', '5'))
+
+DB_ENV_PREFIXES = {
+    'bc_registries': 'BC_REG_DB',
+    'bc_reg_lear': 'LEAR_DB',
+    'event_processor': 'EVENT_PROC_DB',
+    'org_book': 'ORGBOOK_DB',
+    'orgbook_wallet': 'ORGBOOK_WALLET_DB',
+}
+
+# errors that mean the connection itself is broken (rather than the sql)
+DB_CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+def connect_config(db_name):
+    db = config(db_name)
+    db['keepalives'] = 1
+    db['keepalives_idle'] = DB_KEEPALIVES_IDLE
+    db['keepalives_interval'] = DB_KEEPALIVES_INTERVAL
+    db['keepalives_count'] = DB_KEEPALIVES_COUNT
+    return db
+
+
+def pool_config(db_name):
+    prefix = DB_ENV_PREFIXES[db_name]
+    pool_min = int(os.environ.get(prefix + '_POOL_MIN', DB_POOL_MIN))
+    pool_max = int(os.environ.get(prefix + '_POOL_MAX', DB_POOL_MAX))
+    return (pool_min, max(pool_min, pool_max))
+
+
+class ConnectionManager:
+    """
+    Thread-safe pool of connections to one database.
+
+    Callers block (rather than fail) when all connections are in use, connections
+    that have been idle are health-checked before they are handed out, and broken
+    connections are discarded and replaced.
+    """
+
+    def __init__(self, db_name, readonly: bool = True):
+        self.db_name = db_name
+        self.readonly = readonly
+        (self.pool_min, self.pool_max) = pool_config(db_name)
+        self.pool = self.new_pool()
+        self.available = threading.BoundedSemaphore(self.pool_max)
+        self.lock = threading.Lock()
+        # conn -> time the connection was last returned to the pool
+        # (weak keys, so connections the pool closes drop out, and a new connection is never mistaken for an old one)
+        self.last_used = weakref.WeakKeyDictionary()
+        # connections currently checked out of the pool
+        self.in_use = set()
+
+    def new_pool(self):
+        attempt = 0
+        while True:
+            try:
+                pool = psycopg2.pool.ThreadedConnectionPool(self.pool_min, self.pool_max, **connect_config(self.db_name))
+                break
+            except DB_CONNECTION_ERRORS as error:
+                # can't connect, wait for the database to come back
+                attempt = attempt + 1
+                if attempt > DB_RECONNECT_ATTEMPTS:
+                    raise
+                LOGGER.warning("Connect to %s failed (%s), retrying ...", self.db_name, error)
+                time.sleep(DB_RECONNECT_DELAY_SECONDS)
+        # the pool closes returned connections once it holds "minconn" idle ones,
+        # so keep all of them (the pool never opens more than pool_max)
+        pool.minconn = self.pool_max
+        return pool
+
+    def is_healthy(self, conn):
+        if conn.closed:
+            return False
+        cur = None
+        try:
+            cur = conn.cursor()
+            cur.execute("select 1")
+            cur.fetchone()
+            cur.close()
+            cur = None
+            conn.rollback()
+            return True
+        except DB_CONNECTION_ERRORS:
+            return False
+        finally:
+            if cur is not None and not cur.closed:
+                cur.close()
+
+    def getconn(self):
+        self.available.acquire()
+        try:
+            attempt = 0
+            while True:
+                try:
+                    conn = self.pool.getconn()
+                except DB_CONNECTION_ERRORS as error:
+                    # can't open a new connection, wait for the database to come back
+                    attempt = attempt + 1
+                    if attempt > DB_RECONNECT_ATTEMPTS:
+                        raise
+                    LOGGER.warning("Connect to %s failed (%s), retrying ...", self.db_name, error)
+                    time.sleep(DB_RECONNECT_DELAY_SECONDS)
+                    continue
+                with self.lock:
+                    last_used = self.last_used.get(conn)
+                if last_used is None:
+                    # new (or never returned) connection
+                    conn.set_session(
+                        isolation_level=psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED,
+                        readonly=self.readonly,
+                    )
+                elif conn.closed or (DB_HEALTH_CHECK_IDLE_SECONDS < time.monotonic() - last_used and not self.is_healthy(conn)):
+                    self.discard(conn)
+                    continue
+                with self.lock:
+                    self.in_use.add(conn)
+                return conn
+        except:
+            self.available.release()
+            raise
+
+    def putconn(self, conn, close: bool = False):
+        try:
+            close = close or conn.closed
+            with self.lock:
+                self.in_use.discard(conn)
+                if close:
+                    self.last_used.pop(conn, None)
+                else:
+                    self.last_used[conn] = time.monotonic()
+            # the pool rolls back any open transaction
+            self.pool.putconn(conn, close=close)
+            if conn.closed:
+                with self.lock:
+                    self.last_used.pop(conn, None)
+        finally:
+            self.available.release()
+
+    def discard(self, conn):
+        with self.lock:
+            self.last_used.pop(conn, None)
+        self.pool.putconn(conn, close=True)
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        broken = False
+        try:
+            yield conn
+        except DB_CONNECTION_ERRORS:
+            broken = True
+            raise
+        finally:
+            self.putconn(conn, close=broken)
+
+    def cancel_all(self):
+        """
+        Cancel any queries running on connections that are checked out of the pool.
+        """
+        with self.lock:
+            conns = list(self.in_use)
+        for conn in conns:
+            try:
+                if not conn.closed:
+                    conn.cancel()
+            except (Exception, psycopg2.DatabaseError) as error:
+                LOGGER.warning("Unable to cancel query on %s: %s", self.db_name, error)
+
+    def closeall(self):
+        with self.lock:
+            self.last_used = weakref.WeakKeyDictionary()
+            self.in_use = set()
+        self.pool.closeall()
+
+
+# connection pools, one per database (and read-only/read-write)
+db_managers = {}
+db_managers_lock = threading.Lock()
+
+
+def get_connection_manager(db_name, readonly: bool = True):
+    db_cache_name = db_name + "::" + str(readonly)
+    with db_managers_lock:
+        if db_cache_name not in db_managers:
+            db_managers[db_cache_name] = ConnectionManager(db_name, readonly=readonly)
+        return db_managers[db_cache_name]
+
+
+# cancel all running queries (e.g. to stop other extracts when one has failed)
+def cancel_queries():
+    with db_managers_lock:
+        managers = list(db_managers.values())
+    for manager in managers:
+        manager.cancel_all()
+
+
+# borrow a pooled connection for the duration of a "with" block
+def db_connection(db_name, readonly: bool = True):
+    return get_connection_manager(db_name, readonly=readonly).connection()
+
+
+# run a read against a pooled connection, re-connecting and retrying if the connection fails
+def run_with_reconnect(db_name, func, readonly: bool = True):
+    attempt = 0
+    while True:
+        try:
+            with db_connection(db_name, readonly=readonly) as conn:
+                return func(conn)
+        except DB_CONNECTION_ERRORS as error:
+            attempt = attempt + 1
+            if attempt > DB_RECONNECT_ATTEMPTS:
+                raise
+            LOGGER.warning("Connection to %s failed (%s), reconnecting ...", db_name, error)
+            time.sleep(DB_RECONNECT_DELAY_SECONDS)
+
+
+# pre-connected databases (one per thread, checked out of the connection pool)
+db_conns = threading.local()
+
+# number of rows fetched per round trip by the streaming (server-side cursor) queries
+DB_ITERSIZE = int(os.environ.get('DB_ITERSIZE', '10000'))
+
+# server-side cursors need a unique name per connection
+cursor_names = itertools.count(1)
+
+
+def next_cursor_name(db_name):
+    return "{}_cursor_{}".format(db_name, next(cursor_names))
+
 
 # get (shared) connection to database
+# the connection is private to the calling thread, and is replaced if it has been closed
+# (it stays checked out of the pool until the thread calls release_connections())
 def get_connection(db_name, readonly: bool = True):
     db_cache_name = db_name + "::" + str(readonly)
-    if db_cache_name in db_conns and db_conns[db_cache_name]:
-        return db_conns[db_cache_name]
-
-    db_config = config(db_name)
-    conn = psycopg2.connect(**db_config)
-    conn.set_session(readonly=readonly)
-    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
-    db_conns[db_cache_name] = conn
+    thread_conns = db_conns.__dict__.setdefault('conns', {})
+    manager = get_connection_manager(db_name, readonly=readonly)
+    if db_cache_name in thread_conns and thread_conns[db_cache_name]:
+        conn = thread_conns[db_cache_name]
+        if not conn.closed:
+            return conn
+        manager.putconn(conn, close=True)
+        thread_conns[db_cache_name] = None
+
+    conn = manager.getconn()
+    thread_conns[db_cache_name] = conn
 
     return conn
 
 
-# get (shared) connection to database
+# get (shared) read/write connection to database
 def get_rw_connection(db_name, readonly: bool = True):
-    db_cache_name = db_name + "::" + str(readonly)
-    if db_cache_name in db_conns and db_conns[db_cache_name]:
-        return db_conns[db_cache_name]
+    return get_connection(db_name, readonly=False)
 
-    db_config = config(db_name)
-    conn = psycopg2.connect(**db_config)
-    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
-    db_conns[db_cache_name] = conn
 
-    return conn
+# return this thread's shared connections to the pool
+def release_connections():
+    thread_conns = db_conns.__dict__.setdefault('conns', {})
+    for db_cache_name in thread_conns:
+        conn = thread_conns[db_cache_name]
+        if conn:
+            (db_name, readonly) = db_cache_name.split("::")
+            get_connection_manager(db_name, readonly=(readonly == "True")).putconn(conn)
+    thread_conns.clear()
 
 
 # get all records and return in an array of dicts
 # returns a zero-length array if none found
 # optionally takes a WHERE clause and ORDER BY clause (must be valid SQL)
 def get_db_sql(db_name, sql, args=None):
-    cursor = None
-    try:
-        conn = get_connection(db_name)
+    def run_sql(conn):
         cursor = conn.cursor()
-        if args:
-            cursor.execute(sql, args)
-        else:
-            cursor.execute(sql)
-        desc = cursor.description
-        column_names = [col[0] for col in desc]
-        rows = [dict(zip(column_names, row))
-            for row in cursor]
-        cursor.close()
-        cursor = None
-        return rows
+        try:
+            if args:
+                cursor.execute(sql, args)
+            else:
+                cursor.execute(sql)
+            desc = cursor.description
+            column_names = [col[0] for col in desc]
+            rows = [dict(zip(column_names, row))
+                for row in cursor]
+            return rows
+        finally:
+            cursor.close()
+
+    try:
+        return run_with_reconnect(db_name, run_sql)
     except (Exception, psycopg2.DatabaseError) as error:
         LOGGER.error(error)
         LOGGER.error(traceback.print_exc())
         log_error("Exception reading DB: " + str(error))
         raise
-    finally:
-        if cursor is not None:
-            cursor.close()
+
+
+# stream all records as batches of dicts, using a named (server-side) cursor
+# so only one batch of rows is held in memory at a time
+# optionally takes a WHERE clause and ORDER BY clause (must be valid SQL)
+def get_db_sql_batches(db_name, sql, args=None, itersize: int = None, as_dict: bool = True):
+    if itersize is None:
+        itersize = DB_ITERSIZE
+    attempt = 0
+    yielded = False
+    while True:
         cursor = None
+        try:
+            with db_connection(db_name) as conn:
+                try:
+                    cursor = conn.cursor(name=next_cursor_name(db_name))
+                    cursor.itersize = itersize
+                    if args:
+                        cursor.execute(sql, args)
+                    else:
+                        cursor.execute(sql)
+                    column_names = None
+                    while True:
+                        rows = cursor.fetchmany(itersize)
+                        if 0 == len(rows):
+                            break
+                        if as_dict:
+                            if column_names is None:
+                                column_names = [col[0] for col in cursor.description]
+                            rows = [dict(zip(column_names, row)) for row in rows]
+                        yielded = True
+                        yield rows
+                    cursor.close()
+                    cursor = None
+                    return
+                finally:
+                    if cursor is not None and not cursor.closed and not conn.closed:
+                        cursor.close()
+                    cursor = None
+        except DB_CONNECTION_ERRORS as error:
+            # can only safely retry if nothing has been returned to the caller yet
+            attempt = attempt + 1
+            if yielded or attempt > DB_RECONNECT_ATTEMPTS:
+                LOGGER.error(error)
+                log_error("Exception reading DB: " + str(error))
+                raise
+            LOGGER.warning("Connection to %s failed (%s), reconnecting ...", db_name, error)
+            time.sleep(DB_RECONNECT_DELAY_SECONDS)
+        except (Exception, psycopg2.DatabaseError) as error:
+            LOGGER.error(error)
+            LOGGER.error(traceback.print_exc())
+            log_error("Exception reading DB: " + str(error))
+            raise
+
+
+# stream all records one dict at a time (see get_db_sql_batches)
+def get_db_sql_stream(db_name, sql, args=None, itersize: int = None, as_dict: bool = True):
+    for rows in get_db_sql_batches(db_name, sql, args=args, itersize=itersize, as_dict=as_dict):
+        for row in rows:
+            yield row
 
 
 # post an update
+# (updates are not retried, since we can't tell if a failed commit was applied)
 def post_db_sql(db_name, sql, args=None):
     cursor = None
     try:
-        conn = get_connection(db_name, readonly=False)
-        cursor = conn.cursor()
-        if args:
-            cursor.execute(sql, args)
-        else:
-            cursor.execute(sql)
-        count = cursor.fetchone()[0]
-        conn.commit()
-        cursor.close()
-        cursor = None
-        return count
+        with db_connection(db_name, readonly=False) as conn:
+            cursor = conn.cursor()
+            if args:
+                cursor.execute(sql, args)
+            else:
+                cursor.execute(sql)
+            count = cursor.fetchone()[0]
+            conn.commit()
+            cursor.close()
+            cursor = None
+            return count
     except (Exception, psycopg2.DatabaseError) as error:
         LOGGER.error(error)
         LOGGER.error(traceback.print_exc())
         log_error("Exception writing DB: " + str(error))
         raise
     finally:
-        if cursor is not None:
+        if cursor is not None and not cursor.closed:
             cursor.close()
         cursor = None
 
 
 def get_sql_record_count(db_name, sql):
-    cur = None
-    try:
-        conn = get_connection(db_name)
+    def run_sql(conn):
         cur = conn.cursor()
-        cur.execute(sql)
-        ct = cur.fetchone()[0]
-        cur.close()
-        cur = None
-        return ct
+        try:
+            cur.execute(sql)
+            return cur.fetchone()[0]
+        finally:
+            cur.close()
+
+    try:
+        return run_with_reconnect(db_name, run_sql)
     except (Exception, psycopg2.DatabaseError) as error:
         LOGGER.error(error)
         LOGGER.error(traceback.print_exc())
         raise
-    finally:
-        if cur is not None:
+
+
+# sql list of corp types (for an "in (...)" condition), the default is the corp types in scope
+def corp_types_sql(corp_types=None):
+    if corp_types is None:
+        corp_types = CORP_TYPES_IN_SCOPE
+    return ", ".join("'" + corp_type.replace("'", "''") + "'" for corp_type in sorted(corp_types))
+
+
+# count the rows of a query by corp type in the database, returns a dict of corp type -> count
+# from_sql is the FROM (and optional WHERE) clause of the query, corp_typ_cd_sql is the corp type column or expression,
+# and only the corp types in corp_types are counted (all corp types if None)
+def get_corp_type_counts(db_name, from_sql, corp_typ_cd_sql, corp_types=None, args=None):
+    sql = "SELECT corp_typ_cd, count(*) FROM (SELECT " + corp_typ_cd_sql + " AS corp_typ_cd " + from_sql + ") corps"
+    if corp_types is not None:
+        sql = sql + " WHERE corp_typ_cd in (" + corp_types_sql(corp_types) + ")"
+    sql = sql + " GROUP BY corp_typ_cd"
+
+    def run_sql(conn):
+        cur = conn.cursor()
+        try:
+            if args:
+                cur.execute(sql, args)
+            else:
+                cur.execute(sql)
+            return {corp_typ_cd: count for (corp_typ_cd, count) in cur}
+        finally:
             cur.close()
-        cur = None
+
+    try:
+        return run_with_reconnect(db_name, run_sql)
+    except (Exception, psycopg2.DatabaseError) as error:
+        LOGGER.error(error)
+        LOGGER.error(traceback.print_exc())
+        raise
+
+
+# count the rows of a query with a corp type in scope (see get_corp_type_counts), in a single round trip
+def get_scoped_corp_count(db_name, from_sql, corp_typ_cd_sql, corp_types=None, args=None):
+    if corp_types is None:
+        corp_types = CORP_TYPES_IN_SCOPE
+    return sum(get_corp_type_counts(db_name, from_sql, corp_typ_cd_sql, corp_types=corp_types, args=args).values())
 
 
 def starts_with_bc(corp_num):
@@ -230,6 +585,19 @@ def bare_corp_num(corp_num):
         return corp_num
 
 
+# stable shard for a (full) corp num, the first 32 bits of the md5 hash mod the number of shards
+# (the same hash as corp_shard_sql(), so a shard can be selected in the database or in python)
+def corp_shard(corp_num, shard_count):
+    return int(hashlib.md5(corp_num.encode("utf-8")).hexdigest()[:8], 16) % shard_count
+
+
+# sql condition that selects the corps in a shard, corp_num_sql is the (full) corp num column or expression
+def corp_shard_sql(corp_num_sql, shard_index, shard_count):
+    return "(('x' || lpad(substr(md5({}), 1, 8), 16, '0'))::bit(64)::bigint % {}) = {}".format(
+        corp_num_sql, int(shard_count), int(shard_index)
+    )
+
+
 def is_valid_corp_num(corp_num):
     if not corp_num:
         return False
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+import sys
+
+from reg_dates import normalize_bc_reg_date, normalize_utc_date
+
+
+"""
+Compact in-memory records for the corps loaded from BC Reg and OrgBook.
+
+Each corp is stored once, as a __slots__ object (no per-record dict), and the
+low-cardinality code values (corp type, state, jurisdiction etc.) are interned
+so all the records share a single copy of each code string.
+
+Each record also carries its registration date normalized to UTC (registration_utc, see reg_dates.py),
+so the audit can compare dates without parsing them.
+"""
+
+
+def intern_code(value):
+    """
+    Returns a shared copy of a (csv-normalized) code value.
+    """
+    if value is None:
+        return ""
+    return sys.intern(str(value))
+
+
+class BcRegCorp:
+    """
+    A corp loaded from the BC Reg (COLIN or LEAR) database.
+    """
+    __slots__ = (
+        "corp_num",
+        "corp_type",
+        "corp_name",
+        "recognition_dts",
+        "bn_9",
+        "can_jur_typ_cd",
+        "xpro_typ_cd",
+        "othr_juris_desc",
+        "state_typ_cd",
+        "op_state_typ_cd",
+        "corp_class",
+        "registration_utc",
+    )
+    CODE_FIELDS = ("corp_type", "can_jur_typ_cd", "xpro_typ_cd", "state_typ_cd", "op_state_typ_cd", "corp_class")
+
+    def __init__(
+        self,
+        corp_num,
+        corp_type,
+        corp_name="",
+        recognition_dts="",
+        bn_9="",
+        can_jur_typ_cd="",
+        xpro_typ_cd="",
+        othr_juris_desc="",
+        state_typ_cd="",
+        op_state_typ_cd="",
+        corp_class="",
+        registration_utc=None,
+    ):
+        self.corp_num = corp_num
+        self.corp_type = intern_code(corp_type)
+        self.corp_name = corp_name
+        self.recognition_dts = recognition_dts
+        self.bn_9 = bn_9
+        self.can_jur_typ_cd = intern_code(can_jur_typ_cd)
+        self.xpro_typ_cd = intern_code(xpro_typ_cd)
+        self.othr_juris_desc = othr_juris_desc
+        self.state_typ_cd = intern_code(state_typ_cd)
+        self.op_state_typ_cd = intern_code(op_state_typ_cd)
+        self.corp_class = intern_code(corp_class)
+        self.registration_utc = registration_utc if registration_utc is not None else normalize_bc_reg_date(recognition_dts)
+
+    @classmethod
+    def from_row(cls, row):
+        # registration_utc is missing from older exports (it is re-computed)
+        return cls(*[row.get(field) for field in cls.__slots__])
+
+    def as_row(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+class OrgBookCorp:
+    """
+    A corp (topic) loaded from the OrgBook search database.
+    """
+    __slots__ = (
+        "corp_num",
+        "corp_type",
+        "registration_date",
+        "corp_name",
+        "home_jurisdiction",
+        "entity_status",
+        "bus_num",
+        "registration_utc",
+    )
+    CODE_FIELDS = ("corp_type", "home_jurisdiction", "entity_status")
+
+    def __init__(
+        self,
+        corp_num,
+        corp_type,
+        registration_date="",
+        corp_name="",
+        home_jurisdiction="",
+        entity_status="",
+        bus_num="",
+        registration_utc=None,
+    ):
+        self.corp_num = corp_num
+        self.corp_type = intern_code(corp_type)
+        self.registration_date = registration_date
+        self.corp_name = corp_name
+        self.home_jurisdiction = intern_code(home_jurisdiction)
+        self.entity_status = intern_code(entity_status)
+        self.bus_num = bus_num
+        self.registration_utc = registration_utc if registration_utc is not None else normalize_utc_date(registration_date)
+
+    @classmethod
+    def from_row(cls, row):
+        # registration_utc is missing from older exports (it is re-computed)
+        return cls(*[row.get(field) for field in cls.__slots__])
+
+    def as_row(self):
+        return {field: getattr(self, field) for field in self.__slots__}
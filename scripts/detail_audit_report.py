@@ -32,10 +32,27 @@ from orgbook_data_load import (
     get_event_proc_future_corps_csv,
     get_bc_reg_corps,
     get_bc_reg_corps_csv,
+    get_bc_reg_corps_sorted,
+    get_bc_reg_corps_sorted_csv,
+    get_orgbook_all_corps_sorted,
+    get_orgbook_all_corps_sorted_csv,
     get_bc_reg_lear_all_relations,
     get_bc_reg_lear_all_relations_csv,
+    run_extractions,
+)
+from orgbook_data_audit import (
+    compare_bc_reg_orgbook,
+    compare_bc_reg_orgbook_columnar,
+    compare_bc_reg_orgbook_sorted,
+    relation_corp_nums,
+)
+from audit_shards import (
+    audit_shard,
+    merge_shard_results,
+    read_shard_results,
+    run_audit_shards,
+    write_shard_results,
 )
-from orgbook_data_audit import compare_bc_reg_orgbook
 from rocketchat_hooks import log_error, log_warning, log_info
 
 
@@ -44,6 +61,17 @@ USE_LEAR = (os.environ.get('USE_LEAR', 'false').lower() == 'true')
 USE_IGNORE_LIST = (os.environ.get('USE_IGNORE_LIST', 'false').lower() == 'true')
 REQUEUE_WRONG_BN_CORPS = (os.environ.get('REQUEUE_WRONG_BN_CORPS', 'false').lower() == 'true')
 
+# "hash" loads both sets of corps into memory, "merge" streams both (sorted by corp num) and merge-joins them,
+# "columnar" loads both into memory and compares them field-by-field with numpy
+AUDIT_ENGINE = os.environ.get('AUDIT_ENGINE', 'hash').lower()
+
+# sharded audit - the corps are split into AUDIT_SHARD_COUNT shards, audited by AUDIT_WORKERS processes
+# (or set AUDIT_SHARD_INDEX to audit a single shard, e.g. in a job pod, and AUDIT_MERGE_SHARDS to merge the saved shard results)
+AUDIT_WORKERS = int(os.environ.get('AUDIT_WORKERS', '1'))
+AUDIT_SHARD_COUNT = int(os.environ.get('AUDIT_SHARD_COUNT', str(AUDIT_WORKERS)))
+AUDIT_SHARD_INDEX = os.environ.get('AUDIT_SHARD_INDEX', '')
+AUDIT_MERGE_SHARDS = (os.environ.get('AUDIT_MERGE_SHARDS', 'false').lower() == 'true')
+
 
 # mainline
 if __name__ == "__main__":
@@ -54,50 +82,121 @@ if __name__ == "__main__":
     - corps in orgbook that are *not* in BC Reg database (maybe have been removed?)
     """
 
-    # read from orgbook database
-    if USE_CSV:
-        (orgbook_corp_types, orgbook_corp_names, orgbook_corp_infos) = get_orgbook_all_corps_csv()
-    else:
-        (orgbook_corp_types, orgbook_corp_names, orgbook_corp_infos) = get_orgbook_all_corps(USE_LEAR=USE_LEAR)
-    if USE_CSV:
-        orgbook_corp_missing_relations = get_orgbook_missing_relations_csv()
-        orgbook_corp_active_relations = get_orgbook_active_relations_csv()
-    else:
-        orgbook_corp_missing_relations = get_orgbook_missing_relations(USE_LEAR=USE_LEAR)
-        orgbook_corp_active_relations = get_orgbook_active_relations(USE_LEAR=USE_LEAR)
-
-    # corps that are still in the event processor queue waiting to be processed (won't be in orgbook yet)
+    # the extracts hit independent databases, so run them all at once
     if USE_CSV:
-        future_corps = get_event_proc_future_corps_csv()
+        loaders = {
+            "orgbook_corps": get_orgbook_all_corps_csv,
+            "orgbook_missing_relations": get_orgbook_missing_relations_csv,
+            "orgbook_active_relations": get_orgbook_active_relations_csv,
+            "future_corps": get_event_proc_future_corps_csv,
+            "bc_reg_corps": get_bc_reg_corps_csv,
+            "bc_reg_relations": get_bc_reg_lear_all_relations_csv,
+        }
     else:
-        future_corps = get_event_proc_future_corps(USE_LEAR=USE_LEAR)
+        loaders = {
+            "orgbook_corps": lambda: get_orgbook_all_corps(USE_LEAR=USE_LEAR),
+            "orgbook_missing_relations": lambda: get_orgbook_missing_relations(USE_LEAR=USE_LEAR),
+            "orgbook_active_relations": lambda: get_orgbook_active_relations(USE_LEAR=USE_LEAR),
+            # corps that are still in the event processor queue waiting to be processed (won't be in orgbook yet)
+            "future_corps": lambda: get_event_proc_future_corps(USE_LEAR=USE_LEAR),
+            "bc_reg_corps": lambda: get_bc_reg_corps(USE_LEAR=USE_LEAR),
+            "bc_reg_relations": get_bc_reg_lear_all_relations,
+        }
+    sharded = (1 < AUDIT_SHARD_COUNT)
+    if sharded or (AUDIT_ENGINE == "merge" and not USE_CSV):
+        # the corps are streamed during the compare, rather than extracted up front
+        del loaders["orgbook_corps"]
+        del loaders["bc_reg_corps"]
+    extracts = run_extractions(loaders)
 
-    # check if all the BC Reg corps are in orgbook (with the same corp type)
-    if USE_CSV:
-        (bc_reg_corp_types, bc_reg_corp_names, bc_reg_corp_infos) = get_bc_reg_corps_csv()
-        (bc_reg_owners, bc_reg_firms) = get_bc_reg_lear_all_relations_csv()
-    else:
-        (bc_reg_corp_types, bc_reg_corp_names, bc_reg_corp_infos) = get_bc_reg_corps(USE_LEAR=USE_LEAR)
-        (bc_reg_owners, bc_reg_firms) = get_bc_reg_lear_all_relations()
+    orgbook_corp_missing_relations = extracts["orgbook_missing_relations"]
+    orgbook_corp_active_relations = extracts["orgbook_active_relations"]
+    future_corps = extracts["future_corps"]
+    (bc_reg_owners, bc_reg_firms) = extracts["bc_reg_relations"]
 
     ignore_list = get_ignore_list(USE_IGNORE_LIST=USE_IGNORE_LIST, USE_LEAR=USE_LEAR)
 
     # do the orgbook/bc reg compare
-    wrong_bus_num = compare_bc_reg_orgbook(
-        bc_reg_corp_types,
-        bc_reg_corp_names,
-        bc_reg_corp_infos,
-        bc_reg_owners,
-        bc_reg_firms,
-        orgbook_corp_types,
-        orgbook_corp_names,
-        orgbook_corp_infos,
-        orgbook_corp_missing_relations,
-        orgbook_corp_active_relations,
-        future_corps,
-        ignore_list,
-        USE_LEAR=USE_LEAR,
-    )
+    if sharded:
+        if AUDIT_MERGE_SHARDS:
+            shard_results = read_shard_results(AUDIT_SHARD_COUNT)
+        elif AUDIT_SHARD_INDEX:
+            shard_results = [audit_shard(
+                int(AUDIT_SHARD_INDEX),
+                AUDIT_SHARD_COUNT,
+                relation_corp_nums(bc_reg_owners),
+                future_corps,
+                ignore_list,
+                USE_LEAR=USE_LEAR,
+                USE_CSV=USE_CSV,
+            )]
+        else:
+            shard_results = run_audit_shards(
+                AUDIT_SHARD_COUNT,
+                AUDIT_WORKERS,
+                relation_corp_nums(bc_reg_owners),
+                future_corps,
+                ignore_list,
+                USE_LEAR=USE_LEAR,
+                USE_CSV=USE_CSV,
+            )
+
+        if AUDIT_SHARD_INDEX and not AUDIT_MERGE_SHARDS:
+            # the merge job reports (and fixes BN's) for all the shards
+            write_shard_results(shard_results[0])
+            wrong_bus_num = []
+        else:
+            wrong_bus_num = merge_shard_results(
+                shard_results,
+                bc_reg_owners,
+                orgbook_corp_missing_relations,
+                orgbook_corp_active_relations,
+                future_corps,
+                ignore_list,
+                USE_LEAR=USE_LEAR,
+            )
+    elif AUDIT_ENGINE == "merge":
+        if USE_CSV:
+            bc_reg_corps = get_bc_reg_corps_sorted_csv()
+            orgbook_corps = get_orgbook_all_corps_sorted_csv()
+        else:
+            bc_reg_corps = get_bc_reg_corps_sorted(USE_LEAR=USE_LEAR)
+            orgbook_corps = get_orgbook_all_corps_sorted()
+        wrong_bus_num = compare_bc_reg_orgbook_sorted(
+            bc_reg_corps,
+            bc_reg_owners,
+            bc_reg_firms,
+            orgbook_corps,
+            orgbook_corp_missing_relations,
+            orgbook_corp_active_relations,
+            future_corps,
+            ignore_list,
+            USE_LEAR=USE_LEAR,
+        )
+    elif AUDIT_ENGINE == "columnar":
+        wrong_bus_num = compare_bc_reg_orgbook_columnar(
+            extracts["bc_reg_corps"],
+            bc_reg_owners,
+            bc_reg_firms,
+            extracts["orgbook_corps"],
+            orgbook_corp_missing_relations,
+            orgbook_corp_active_relations,
+            future_corps,
+            ignore_list,
+            USE_LEAR=USE_LEAR,
+        )
+    else:
+        wrong_bus_num = compare_bc_reg_orgbook(
+            extracts["bc_reg_corps"],
+            bc_reg_owners,
+            bc_reg_firms,
+            extracts["orgbook_corps"],
+            orgbook_corp_missing_relations,
+            orgbook_corp_active_relations,
+            future_corps,
+            ignore_list,
+            USE_LEAR=USE_LEAR,
+        )
 
     if 0 < len(wrong_bus_num):
         if not USE_LEAR:
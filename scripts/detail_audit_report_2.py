@@ -21,6 +21,6 @@ if __name__ == "__main__":
     Reads from the orgbook database and compares:
     """
     # read from orgbook database
-    (orgbook_corp_types, orgbook_corp_names, orgbook_corp_infos) = get_orgbook_all_corps(USE_LEAR=USE_LEAR)
+    orgbook_corps = get_orgbook_all_corps(USE_LEAR=USE_LEAR)
     orgbook_corp_missing_relations = get_orgbook_missing_relations(USE_LEAR=USE_LEAR)
     orgbook_corp_active_relations = get_orgbook_active_relations(USE_LEAR=USE_LEAR)
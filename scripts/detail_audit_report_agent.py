@@ -1,20 +1,29 @@
 #!/usr/bin/python
 import os 
+import argparse
 import psycopg2
 import datetime
 import time
 import json
 import decimal
-import requests
 import csv
 import asyncio
+import aiohttp
+import collections
+import concurrent.futures
+import multiprocessing
 
-from config import get_connection, get_db_sql, get_sql_record_count, CORP_TYPES_IN_SCOPE, corp_num_with_prefix, bare_corp_num
+from config import get_connection, get_db_sql, release_connections, get_db_sql_batches, get_sql_record_count, CORP_TYPES_IN_SCOPE, corp_num_with_prefix, bare_corp_num
 from orgbook_data_load import (
     get_orgbook_all_corps, get_orgbook_all_corps_csv,
     get_event_proc_future_corps, get_event_proc_future_corps_csv,
     get_bc_reg_corps, get_bc_reg_corps_csv,
-    get_agent_wallet_ids, append_agent_wallet_ids
+    get_agent_wallet_ids
+)
+from wallet_id_cache import WALLET_ID_DELTA_MAX, merge_shard_delta_logs
+from agent_api import (
+    agent_session, verify_agent_credentials, list_agent_credential_ids, AdaptiveLimiter,
+    AGENT_API_CONCURRENCY, AGENT_API_MIN_CONCURRENCY, AGENT_API_PAGE_SIZE
 )
 
 
@@ -28,13 +37,34 @@ TOPIC_QUERY = "/topic/registration.registries.ca/"
 TOPIC_NAME_SEARCH = "/search/topic?inactive=false&latest=true&revoked=false&name="
 TOPIC_ID_SEARCH = "/search/topic?inactive=false&latest=true&revoked=false&topic_id="
 
-# value for PROD is "https://agent-admin.orgbook.gov.bc.ca/credential/"
-AGENT_API_URL = os.environ.get("AGENT_API_URL", "http://localhost:8021/credential/")
-AGENT_API_KEY = os.environ.get("AGENT_API_KEY")
-
 # default is to audit active (non-revoked) credentials
 AUDIT_ALL_CREDENTIALS = (os.environ.get("AUDIT_ALL_CREDENTIALS", "false").lower() == 'true')
 
+# watermark of the last completed audit (incremental audits only check the credentials added or updated since)
+AGENT_AUDIT_STATE_FILE = 'export/agent_audit_state.json'
+# credentials updated up to this long before the last audit started are re-checked (to allow for slow commits)
+AGENT_AUDIT_OVERLAP_MINUTES = int(os.environ.get("AGENT_AUDIT_OVERLAP_MINUTES", "60"))
+
+# progress of the current audit, saved after every AGENT_AUDIT_CHECKPOINT_COUNT credentials checked with the agent
+# (or every AGENT_AUDIT_CHECKPOINT_SECONDS, whichever comes first)
+AGENT_AUDIT_CHECKPOINT_FILE = 'export/agent_audit_checkpoint.json'
+AGENT_AUDIT_CHECKPOINT_COUNT = int(os.environ.get("AGENT_AUDIT_CHECKPOINT_COUNT", "10000"))
+AGENT_AUDIT_CHECKPOINT_SECONDS = float(os.environ.get("AGENT_AUDIT_CHECKPOINT_SECONDS", "300"))
+
+# max number of streamed batches of credentials being checked with the agent at the same time
+# (the limiter sets the number of agent requests in flight, this bounds the uncached credentials held in memory)
+AGENT_AUDIT_VERIFY_BATCHES = int(os.environ.get("AGENT_AUDIT_VERIFY_BATCHES", "4"))
+
+# credentials the agent confirmed are not in the wallet, these aren't re-checked with the agent for AGENT_AUDIT_RECHECK_DAYS
+# (they are still reported, as missing or extra, each audit) - set to 0 to always re-check
+AGENT_AUDIT_NEGATIVE_CACHE_FILE = 'export/agent_audit_not_in_wallet.json'
+AGENT_AUDIT_RECHECK_DAYS = float(os.environ.get("AGENT_AUDIT_RECHECK_DAYS", "7"))
+
+# sharded audit - each shard checks the credentials with id % shard count == shard index,
+# and saves its checkpoints and results to its own files (the results are then merged)
+AGENT_AUDIT_SHARD_CHECKPOINT_FILE = 'export/agent_audit_checkpoint_{}_of_{}.json'
+AGENT_AUDIT_SHARD_RESULTS_FILE = 'export/agent_audit_shard_{}_of_{}.json'
+
 
 """
 Detail audit report - credential list from orgbook.
@@ -42,22 +72,172 @@ Reads from the orgbook database:
 - wallet id for each credential
 """
 
-async def process_credential_queue():
-    # preload agent wallet id's
-    print("Get exported wallet id's from agent", datetime.datetime.now())
-    agent_wallet_ids = get_agent_wallet_ids()
-    print("# wallet id's:", len(agent_wallet_ids))
+# an orgbook credential, as read by the audit query
+AgentCredential = collections.namedtuple("AgentCredential", [
+    "credential_id", "id", "topic_id", "timestamp",
+    "source_id", "credential_type_id", "credential_type",
+    "revoked", "inactive", "latest",
+    "effective_date", "revoked_date", "revoked_by",
+])
 
-    conn = None
-    try:
-        conn = get_connection('org_book')
-    except (Exception) as error:
-        print(error)
-        raise
+# a streamed batch of credentials - the highest credential id in the batch, the number found in the cache,
+# the (i, AgentCredential)'s recently confirmed not in the wallet, and the (i, AgentCredential)'s to check with the agent
+CredentialBatch = collections.namedtuple("CredentialBatch", ["position", "cache_checks", "known_missing", "unchecked"])
+
+
+def read_audit_state():
+    """
+    Reads the watermark of the last completed audit, returns None if there isn't one (or it was for different credentials).
+    """
+    if not os.path.exists(AGENT_AUDIT_STATE_FILE):
+        return None
+    with open(AGENT_AUDIT_STATE_FILE, mode='r') as state_file:
+        audit_state = json.load(state_file)
+    if audit_state.get("all_credentials") != AUDIT_ALL_CREDENTIALS:
+        print("Last audit was for", "all" if audit_state.get("all_credentials") else "non-revoked", "credentials, running a full audit")
+        return None
+    return audit_state
+
+
+def write_json_file(file_name, data):
+    # written to a temp file and renamed, so an interrupted write can't corrupt the previous version
+    tmp_file_name = file_name + ".tmp"
+    with open(tmp_file_name, mode='w') as json_file:
+        json.dump(data, json_file, indent=2)
+    os.replace(tmp_file_name, file_name)
+
+
+def write_audit_state(audit_state):
+    """
+    Saves the watermark of a completed audit.
+    """
+    write_json_file(AGENT_AUDIT_STATE_FILE, audit_state)
+    print("Saved audit watermark, credential id:", audit_state["max_id"], ", started:", audit_state["run_start"])
+
+
+def completed_audit_state(audit_state, run_start, max_id, recheck_ids):
+    """
+    The watermark after an audit - the highest credential id checked, when the audit started,
+    and the credentials that are missing from the wallet (these are re-checked by the next audit).
+    """
+    return {
+        "max_id": max([max_id, audit_state["max_id"] if audit_state else 0]),
+        "run_start": run_start.isoformat(),
+        "all_credentials": AUDIT_ALL_CREDENTIALS,
+        "recheck_ids": sorted(recheck_ids),
+    }
+
+
+def read_negative_cache():
+    """
+    Reads the credentials the agent has confirmed are not in the wallet (credential id -> when it was confirmed),
+    dropping those that are due to be re-checked.
+    """
+    if AGENT_AUDIT_RECHECK_DAYS <= 0 or not os.path.exists(AGENT_AUDIT_NEGATIVE_CACHE_FILE):
+        return {}
+    with open(AGENT_AUDIT_NEGATIVE_CACHE_FILE, mode='r') as cache_file:
+        negative_cache = json.load(cache_file)
+    recheck_before = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=AGENT_AUDIT_RECHECK_DAYS)
+    return {
+        credential_id: confirmed for (credential_id, confirmed) in negative_cache.items()
+        if recheck_before < datetime.datetime.fromisoformat(confirmed)
+    }
+
+
+def update_negative_cache(confirmed_not_in_wallet):
+    """
+    Adds the credentials the agent confirmed are not in the wallet (during an audit) to the negative cache.
+    """
+    if AGENT_AUDIT_RECHECK_DAYS <= 0:
+        return
+    negative_cache = read_negative_cache()
+    negative_cache.update(confirmed_not_in_wallet)
+    write_json_file(AGENT_AUDIT_NEGATIVE_CACHE_FILE, negative_cache)
+    print("# credentials confirmed not in wallet:", len(negative_cache))
 
+
+def checkpoint_file_name(shard=None):
+    if shard:
+        return AGENT_AUDIT_SHARD_CHECKPOINT_FILE.format(shard[0], shard[1])
+    return AGENT_AUDIT_CHECKPOINT_FILE
+
+
+def shard_results_file_name(shard):
+    return AGENT_AUDIT_SHARD_RESULTS_FILE.format(shard[0], shard[1])
+
+
+def read_checkpoint(shard=None):
+    """
+    Reads the progress saved by an interrupted audit (or shard of an audit),
+    returns None if there isn't one (or it was for different credentials).
+    """
+    if not os.path.exists(checkpoint_file_name(shard)):
+        print("No checkpoint to resume from, starting a new audit")
+        return None
+    with open(checkpoint_file_name(shard), mode='r') as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+    if checkpoint["all_credentials"] != AUDIT_ALL_CREDENTIALS:
+        print("Checkpoint is for", "all" if checkpoint["all_credentials"] else "non-revoked", "credentials, starting a new audit")
+        return None
+    return checkpoint
+
+
+def write_checkpoint(checkpoint):
+    """
+    Saves the progress of the current audit - the credential id checked up to (in id order), and the results so far.
+    """
+    write_json_file(checkpoint_file_name(checkpoint.get("shard")), checkpoint)
+    print("Checkpoint at credential id:", checkpoint["position"], ", agent checks:", checkpoint["agent_checks"], datetime.datetime.now())
+
+
+def new_checkpoint(audit_state, run_start, shard=None):
+    return {
+        "shard": list(shard) if shard else None,
+        "audit_state": audit_state,
+        "run_start": run_start.isoformat(),
+        "all_credentials": AUDIT_ALL_CREDENTIALS,
+        "position": 0,
+        "cache_checks": 0,
+        "agent_checks": 0,
+        "negative_cache_checks": 0,
+        "missing_ids": [],
+        "extra_ids": [],
+        "not_in_wallet": {},
+    }
+
+
+def get_orgbook_db_time():
+    """
+    Returns the current orgbook database time (the start of an audit, for the watermark).
+    """
+    return get_db_sql('org_book', "select now() as db_time")[0]["db_time"]
+
+
+def get_orgbook_credential_batches(audit_state=None, after_id: int = 0, shard=None):
+    """
+    Streams all the credentials (or just the non-revoked credentials) from the orgbook database, in id order,
+    as batches of AgentCredential's.
+    If there is a watermark from a previous audit, only reads the credentials added, updated or revoked since then
+    (plus the credentials that were missing from the wallet).
+    Credentials up to after_id are skipped (i.e. already checked by an interrupted audit).
+    For a sharded audit, only reads the credentials in the (shard index, shard count) shard.
+    """
     # get all the corps from orgbook
     print("Get credential stats from OrgBook DB", datetime.datetime.now())
     cred_filter = " and not credential.revoked " if not AUDIT_ALL_CREDENTIALS else ""
+    sql_args = {"after_id": after_id}
+    if after_id:
+        cred_filter = cred_filter + " and credential.id > %(after_id)s "
+    if shard:
+        cred_filter = cred_filter + " and mod(credential.id, %(shard_count)s) = %(shard_index)s "
+        sql_args.update({"shard_index": shard[0], "shard_count": shard[1]})
+    if audit_state:
+        cred_filter = cred_filter + """ and (credential.id > %(max_id)s
+                or credential.update_timestamp >= %(since)s or credential.revoked_date >= %(since)s
+                or credential.id = any(%(recheck_ids)s::bigint[])) """
+        since = datetime.datetime.fromisoformat(audit_state["run_start"]) - datetime.timedelta(minutes=AGENT_AUDIT_OVERLAP_MINUTES)
+        sql_args.update({"max_id": audit_state["max_id"], "since": since, "recheck_ids": audit_state["recheck_ids"]})
+        print("Incremental audit, credentials after id:", audit_state["max_id"], ", or updated since:", since)
     sql4 = """select 
                   credential.credential_id, credential.id, credential.topic_id, credential.update_timestamp,
                   topic.source_id, credential.credential_type_id, credential_type.description,
@@ -67,75 +247,393 @@ async def process_credential_queue():
                 where topic.id = credential.topic_id""" + cred_filter + """
                 and credential_type.id = credential.credential_type_id
                 order by id;"""
-    corp_creds = []
+    for rows in get_db_sql_batches('org_book', sql4, sql_args, as_dict=False):
+        yield [AgentCredential._make(row) for row in rows]
+
+
+async def stream_orgbook_credentials(audit_state=None, after_id: int = 0, shard=None):
+    """
+    Streams the batches of orgbook credentials (see get_orgbook_credential_batches()), the next batch is read
+    (in a worker thread) while the caller processes the current one.
+    """
+    loop = asyncio.get_running_loop()
+    batches = get_orgbook_credential_batches(audit_state, after_id, shard)
+    next_batch = loop.run_in_executor(None, next, batches, None)
+    while True:
+        batch = await next_batch
+        if batch is None:
+            break
+        next_batch = loop.run_in_executor(None, next, batches, None)
+        yield batch
+
+
+def classify_missing_credential(i, corp_cred, missing, extra_cred):
+    """
+    A credential that is in orgbook but not in the wallet is either an extra cred in orgbook, or missing from the wallet.
+    """
+    if (corp_cred.revoked and corp_cred.revoked_by is not None and
+        corp_cred.effective_date == corp_cred.revoked_date):
+        print("Extra cred in TOB:", i, corp_cred.credential_id)
+        extra_cred.append(corp_cred)
+    else:
+        print(
+            "Exception:", i, corp_cred.credential_id,
+            corp_cred.topic_id, corp_cred.source_id, corp_cred.credential_type,
+            corp_cred.revoked, corp_cred.inactive, corp_cred.latest,
+            corp_cred.timestamp,
+            )
+        missing.append(corp_cred)
+
+
+async def export_agent_wallet_ids():
+    """
+    Pages through the agent's credential listing and replaces the local cache with the wallet credential id's.
+    Returns the (compacted) cache.
+    """
+    print("Listing wallet credentials from agent, page size:", AGENT_API_PAGE_SIZE, ", concurrency:", AGENT_API_MIN_CONCURRENCY, "-", AGENT_API_CONCURRENCY, datetime.datetime.now())
+    limiter = AdaptiveLimiter()
+    agent_wallet_ids = get_agent_wallet_ids()
+    # the listed id's are streamed into a separate (temp) cache, which replaces the cache once the listing is complete
+    # (so if the listing fails part way the cache is left as it was)
+    listing = agent_wallet_ids.new_listing()
     try:
-        cur = conn.cursor()
-        cur.execute(sql4)
-        for row in cur:
-            corp_creds.append({
-                'credential_id': row[0], 'id': row[1], 'topic_id': row[2], 'timestamp': row[3],
-                'source_id': row[4], 'credential_type_id': row[5], 'credential_type': row[6],
-                'revoked': row[7], 'inactive': row[8], 'latest': row[9],
-                'effective_date': row[10], 'revoked_date': row[11], 'revoked_by': row[12]
-            })
-        cur.close()
-    except (Exception) as error:
-        print(error)
+        pages = 0
+        async for credential_ids in list_agent_credential_ids(limiter=limiter):
+            listing.add(credential_ids)
+            pages = pages + 1
+            if WALLET_ID_DELTA_MAX < len(listing.delta_ids):
+                listing.compact()
+            if 0 == pages % 100:
+                print("# wallet id's:", len(listing), datetime.datetime.now())
+    except:
+        listing.close()
+        os.remove(listing.index_file)
+        os.remove(listing.delta_file)
         raise
-    print("# orgbook creds:", len(corp_creds), datetime.datetime.now())
+    agent_wallet_ids.replace(listing)
+    print("# wallet id's:", len(agent_wallet_ids), datetime.datetime.now())
+    limiter.report()
+    return agent_wallet_ids
 
-    i = 0
-    agent_checks = 0
-    cache_checks = 0
+
+def checkpoint_missing_credential(checkpoint, i, corp_cred):
+    """
+    Reports a credential that is not in the wallet, and adds it to the audit results.
+    """
     missing = []
     extra_cred = []
-    not_in_cache = []
-    print("Checking for valid credentials ...", datetime.datetime.now())
-    while i < len(corp_creds):
-        # if cached we are good, otherwise check agent via api
-        if not corp_creds[i]['credential_id'] in agent_wallet_ids.keys():
-            agent_checks = agent_checks + 1
-            api_key_hdr = {"x-api-key": AGENT_API_KEY}
-            url = AGENT_API_URL + corp_creds[i]['credential_id']
-            #print(i, url)
-            try:
-                response = requests.get(url, headers=api_key_hdr)
-                response.raise_for_status()
-                if response.status_code == 404:
-                    raise Exception("404 not found")
-                else:
-                    wallet_credential = response.json()
-                    # exists in agent but is not in cache
-                    not_in_cache.append(corp_creds[i])
-            except Exception as e:
-                if (corp_creds[i]['revoked'] and corp_creds[i]['revoked_by'] is not None and
-                    corp_creds[i]['effective_date'] == corp_creds[i]['revoked_date']):
-                    print("Extra cred in TOB:", i, corp_creds[i]['credential_id'])
-                    extra_cred.append(corp_creds[i])
-                else:
-                    print(
-                        "Exception:", i, corp_creds[i]['credential_id'],
-                        corp_creds[i]['topic_id'], corp_creds[i]['source_id'], corp_creds[i]['credential_type'],
-                        corp_creds[i]['revoked'], corp_creds[i]['inactive'], corp_creds[i]['latest'],
-                        corp_creds[i]['timestamp'],
-                        )
-                    missing.append(corp_creds[i])
-        else:
+    classify_missing_credential(i, corp_cred, missing, extra_cred)
+    checkpoint["missing_ids"].extend(corp_cred.id for corp_cred in missing)
+    checkpoint["extra_ids"].extend(corp_cred.id for corp_cred in extra_cred)
+
+
+def classify_credential_batch(i, corp_creds, agent_wallet_ids, negative_cache):
+    """
+    Sorts a streamed batch of credentials (numbered from i) into the cache hits, which are only counted,
+    the credentials recently confirmed not in the wallet, and the credentials that need checking with the agent.
+    """
+    cache_checks = 0
+    known_missing = []
+    unchecked = []
+    for corp_cred in corp_creds:
+        if corp_cred.credential_id in agent_wallet_ids:
             cache_checks = cache_checks + 1
+        elif corp_cred.credential_id in negative_cache:
+            # recently confirmed not in the wallet, so no need to ask the agent again
+            known_missing.append((i, corp_cred))
+        else:
+            unchecked.append((i, corp_cred))
         i = i + 1
-        if 0 == i % 100000:
-            print(i)
+    return CredentialBatch(corp_creds[-1].id, cache_checks, known_missing, unchecked)
+
+
+async def verify_credential_batch(batch, limiter, session):
+    """
+    Checks the uncached credentials of a batch with the agent, returns the agent errors (see verify_agent_credentials()).
+    """
+    if 0 == len(batch.unchecked):
+        return []
+    return await verify_agent_credentials([corp_cred.credential_id for (i, corp_cred) in batch.unchecked], limiter, session=session)
+
+
+def checkpoint_credential_batch(batch, agent_errors, agent_wallet_ids, checkpoint):
+    """
+    Adds a checked batch to the audit results and moves the checkpoint position past it, and adds the id's
+    the agent verified to the cache.  (Batches are added in stream order, so the position is only moved past
+    credentials that have all been checked.)
+    """
+    checkpoint["cache_checks"] = checkpoint["cache_checks"] + batch.cache_checks
+    for (i, corp_cred) in batch.known_missing:
+        checkpoint["negative_cache_checks"] = checkpoint["negative_cache_checks"] + 1
+        checkpoint_missing_credential(checkpoint, i, corp_cred)
+
+    not_in_cache = []
+    confirmed = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    for ((i, corp_cred), error) in zip(batch.unchecked, agent_errors):
+        if error is None:
+            # exists in agent but is not in cache
+            not_in_cache.append(corp_cred.credential_id)
+        else:
+            checkpoint_missing_credential(checkpoint, i, corp_cred)
+            if isinstance(error, aiohttp.ClientResponseError) and error.status == 404:
+                # (only a "not found" from the agent confirms it's not in the wallet, other errors are re-checked next time)
+                checkpoint["not_in_wallet"][corp_cred.credential_id] = confirmed
+
+    agent_wallet_ids.add(not_in_cache)
+
+    checkpoint["position"] = batch.position
+    checkpoint["agent_checks"] = checkpoint["agent_checks"] + len(batch.unchecked)
+
+
+async def process_credential_queue(audit_state=None, checkpoint=None, shard=None):
+    # preload agent wallet id's
+    print("Get exported wallet id's from agent", datetime.datetime.now())
+    agent_wallet_ids = get_agent_wallet_ids(shard)
+    print("# wallet id's:", len(agent_wallet_ids))
+    negative_cache = read_negative_cache()
+    print("# credentials confirmed not in wallet (re-checked after {} days):".format(AGENT_AUDIT_RECHECK_DAYS), len(negative_cache))
+
+    if checkpoint:
+        # carry on with the same audit (credentials after the checkpoint)
+        print("Resuming audit from credential id:", checkpoint["position"], ", started:", checkpoint["run_start"])
+        audit_state = checkpoint["audit_state"]
+    else:
+        checkpoint = new_checkpoint(audit_state, get_orgbook_db_time(), shard)
+
+    print("Checking for valid credentials, agent concurrency:", AGENT_API_MIN_CONCURRENCY, "-", AGENT_API_CONCURRENCY, datetime.datetime.now())
+    # (the same limiter and session are used for all the batches, so the concurrency found and the connections are kept)
+    limiter = AdaptiveLimiter()
+    # the credentials are streamed from orgbook, if cached we are good, otherwise check agent via api
+    # (the uncached credentials of each batch are checked as soon as the batch is read, with up to
+    # AGENT_AUDIT_VERIFY_BATCHES batches being checked at once, and the results are added in stream order)
+    i = 0
+    pending = collections.deque()
+    # (position, agent checks and time of the last saved checkpoint)
+    checkpoint_position = checkpoint["position"]
+    checkpoint_checks = checkpoint["agent_checks"]
+    checkpoint_time = time.monotonic()
+    try:
+        async with agent_session(limiter.max_limit) as session:
+            async for corp_creds in stream_orgbook_credentials(audit_state, after_id=checkpoint["position"], shard=shard):
+                batch = classify_credential_batch(i, corp_creds, agent_wallet_ids, negative_cache)
+                i = i + len(corp_creds)
+                pending.append((batch, asyncio.ensure_future(verify_credential_batch(batch, limiter, session))))
+                # add the batches that have been checked, waiting for the oldest if too many are being checked
+                while pending and (pending[0][1].done() or AGENT_AUDIT_VERIFY_BATCHES < len(pending)):
+                    (batch, verify) = pending.popleft()
+                    checkpoint_credential_batch(batch, await verify, agent_wallet_ids, checkpoint)
+                if (checkpoint["position"] != checkpoint_position and (
+                    AGENT_AUDIT_CHECKPOINT_COUNT <= checkpoint["agent_checks"] - checkpoint_checks
+                    or AGENT_AUDIT_CHECKPOINT_SECONDS <= time.monotonic() - checkpoint_time
+                )):
+                    write_checkpoint(checkpoint)
+                    checkpoint_position = checkpoint["position"]
+                    checkpoint_checks = checkpoint["agent_checks"]
+                    checkpoint_time = time.monotonic()
+            while pending:
+                (batch, verify) = pending.popleft()
+                checkpoint_credential_batch(batch, await verify, agent_wallet_ids, checkpoint)
+    finally:
+        for (batch, verify) in pending:
+            verify.cancel()
+    max_id = checkpoint["position"]
+    print("# orgbook creds:", i, datetime.datetime.now())
+
+    print("Total # missing in wallet:", len(checkpoint["missing_ids"]), ", Extra:", len(checkpoint["extra_ids"]), datetime.datetime.now())
+    print(
+        "Cache checks:", checkpoint["cache_checks"], ", Agent checks:", checkpoint["agent_checks"],
+        ", Known not in wallet:", checkpoint["negative_cache_checks"],
+    )
+    limiter.report()
+
+    if shard:
+        # the merge saves the watermark (and merges the cache) for all the shards
+        checkpoint["max_id"] = max_id
+        write_json_file(shard_results_file_name(shard), checkpoint)
+        print("Saved shard results to", shard_results_file_name(shard))
+    else:
+        update_negative_cache(checkpoint["not_in_wallet"])
+        run_start = datetime.datetime.fromisoformat(checkpoint["run_start"])
+        write_audit_state(completed_audit_state(audit_state, run_start, max_id, checkpoint["missing_ids"] + checkpoint["extra_ids"]))
+    if os.path.exists(checkpoint_file_name(shard)):
+        os.remove(checkpoint_file_name(shard))
 
-    append_agent_wallet_ids(not_in_cache)
+
+async def process_credential_listing(audit_state=None):
+    # list all the wallet credential id's from the agent (this also refreshes the local cache)
+    agent_wallet_ids = await export_agent_wallet_ids()
+
+    run_start = get_orgbook_db_time()
+
+    i = 0
+    max_id = 0
+    missing = []
+    extra_cred = []
+    print("Checking for valid credentials ...", datetime.datetime.now())
+    # orgbook credentials that are not in the wallet
+    async for corp_creds in stream_orgbook_credentials(audit_state):
+        for corp_cred in corp_creds:
+            if not corp_cred.credential_id in agent_wallet_ids:
+                classify_missing_credential(i, corp_cred, missing, extra_cred)
+            i = i + 1
+        max_id = corp_creds[-1].id
+    print("# orgbook creds:", i, datetime.datetime.now())
 
     print("Total # missing in wallet:", len(missing), ", Extra:", len(extra_cred), datetime.datetime.now())
-    print("Cache checks:", cache_checks, ", Agent checks:", agent_checks)
+    print("Wallet credentials:", len(agent_wallet_ids), ", OrgBook credentials:", i)
+
+    write_audit_state(completed_audit_state(audit_state, run_start, max_id, [corp_cred.id for corp_cred in missing + extra_cred]))
+
+
+def audit_credential_shard(shard_index, shard_count, audit_state, resume: bool = False):
+    """
+    Audits the credentials in one shard (in a worker process).
+    """
+    shard = (shard_index, shard_count)
+    checkpoint = read_checkpoint(shard) if resume else None
+    try:
+        asyncio.run(process_credential_queue(audit_state, checkpoint, shard))
+    finally:
+        # (the worker process is re-used for other shards)
+        release_connections()
+
 
+def run_credential_shards(shard_count, max_workers, audit_state, resume: bool = False):
+    """
+    Audits all the shards in a pool of worker processes.
+    If any shard fails the shards that haven't started yet are cancelled and the exception is re-raised.
+    """
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+    try:
+        futures = {
+            executor.submit(audit_credential_shard, shard_index, shard_count, audit_state, resume): shard_index
+            for shard_index in range(shard_count)
+        }
+        for future in concurrent.futures.as_completed(futures):
+            error = future.exception()
+            if error is not None:
+                print("Audit of shard {} failed: {}".format(futures[future], error))
+                for other_future in futures:
+                    other_future.cancel()
+                raise error
+    finally:
+        executor.shutdown(wait=True)
+
+
+def merge_credential_shards(shard_count):
+    """
+    Merges the results of all the shards - the cache delta logs, the totals and the watermark.
+    Fails if any shard is missing.
+    """
+    shard_results = []
+    for shard_index in range(shard_count):
+        file_name = shard_results_file_name((shard_index, shard_count))
+        if not os.path.exists(file_name):
+            raise Exception("Missing results for shard " + str(shard_index) + " of " + str(shard_count) + ": " + file_name)
+        with open(file_name, mode='r') as results_file:
+            shard_results.append(json.load(results_file))
+
+    merge_shard_delta_logs(shard_count)
+
+    missing_ids = [cred_id for shard_result in shard_results for cred_id in shard_result["missing_ids"]]
+    extra_ids = [cred_id for shard_result in shard_results for cred_id in shard_result["extra_ids"]]
+    print("Total # missing in wallet:", len(missing_ids), ", Extra:", len(extra_ids), datetime.datetime.now())
+    print(
+        "Cache checks:", sum(shard_result["cache_checks"] for shard_result in shard_results),
+        ", Agent checks:", sum(shard_result["agent_checks"] for shard_result in shard_results),
+        ", Known not in wallet:", sum(shard_result["negative_cache_checks"] for shard_result in shard_results),
+    )
+    not_in_wallet = {}
+    for shard_result in shard_results:
+        not_in_wallet.update(shard_result["not_in_wallet"])
+    update_negative_cache(not_in_wallet)
+
+    # (the shards all start from the same watermark, the new watermark is from when the first shard started)
+    audit_state = shard_results[0]["audit_state"]
+    run_start = min(datetime.datetime.fromisoformat(shard_result["run_start"]) for shard_result in shard_results)
+    max_id = max(shard_result["max_id"] for shard_result in shard_results)
+    write_audit_state(completed_audit_state(audit_state, run_start, max_id, missing_ids + extra_ids))
+    for shard_index in range(shard_count):
+        os.remove(shard_results_file_name((shard_index, shard_count)))
 
-try:
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(process_credential_queue())
-except Exception as e:
-    print("Exception", e)
-    raise
+
+# mainline
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Audits the OrgBook credentials against the agent wallet."
+    )
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        required=False,
+        help="List all the wallet credentials from the agent (and refresh the local cache), rather than checking each credential that isn't cached.",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        required=False,
+        help="Check all the OrgBook credentials, rather than just those added or updated since the last audit.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        required=False,
+        help="Carry on from the last checkpoint of an interrupted audit.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        required=False,
+        help="Number of worker processes to audit the shards (default 1).",
+    )
+    parser.add_argument(
+        "--shard-count",
+        type=int,
+        default=None,
+        required=False,
+        help="Number of shards to split the credentials into (default is the number of workers).",
+    )
+    parser.add_argument(
+        "--shard-index",
+        type=int,
+        default=None,
+        required=False,
+        help="Only audit this shard, and save the results to be merged (e.g. in a job pod).",
+    )
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        required=False,
+        help="Merge the saved results of all the shards.",
+    )
+    args = parser.parse_args()
+    shard_count = args.shard_count if args.shard_count else args.workers
+    sharded = (1 < shard_count)
+    if args.bulk and sharded:
+        parser.error("--bulk can't be sharded")
+    if (args.shard_index is not None or args.merge) and not sharded:
+        parser.error("--shard-index and --merge need a --shard-count")
+
+    audit_state = None if args.full else read_audit_state()
+
+    try:
+        if args.bulk:
+            asyncio.run(process_credential_listing(audit_state))
+        elif args.merge:
+            merge_credential_shards(shard_count)
+        elif args.shard_index is not None:
+            audit_credential_shard(args.shard_index, shard_count, audit_state, resume=args.resume)
+        elif sharded:
+            run_credential_shards(shard_count, args.workers, audit_state, resume=args.resume)
+            merge_credential_shards(shard_count)
+        else:
+            checkpoint = read_checkpoint() if args.resume else None
+            asyncio.run(process_credential_queue(audit_state, checkpoint))
+    except Exception as e:
+        print("Exception", e)
+        raise
 
@@ -8,6 +8,8 @@ import json
 import decimal
 import requests
 import csv
+import operator
+import numpy as np
 
 from config import (
     CORP_TYPES_IN_SCOPE,
@@ -15,22 +17,17 @@ from config import (
     corp_num_with_prefix,
     bare_corp_num,
 )
+from corp_records import OrgBookCorp
+from reg_dates import registration_dates_match
 from rocketchat_hooks import log_error, log_warning, log_info
 
 
-MIN_START_DATE = datetime.datetime(datetime.MINYEAR+1, 1, 1)
-MIN_VALID_DATE = datetime.datetime(datetime.MINYEAR+10, 1, 1)
-MAX_END_DATE   = datetime.datetime(datetime.MAXYEAR-1, 12, 31)
-
-# for now, we are in PST time
-timezone = pytz.timezone("PST8PDT")
-
-MIN_START_DATE_TZ = timezone.localize(MIN_START_DATE)
-MIN_VALID_DATE_TZ = timezone.localize(MIN_VALID_DATE)
-MAX_END_DATE_TZ   = timezone.localize(MAX_END_DATE)
+XPRO_CORP_TYPES = {'XP', 'XL', 'XCP', 'XS'}
 
 MAX_ERRORS_TO_POST = int(environ.get('MAX_ERRORS_TO_POST', '15'))
 
+REPORT_COUNT = 1000000
+
 
 # determine jurisdiction for corp
 def get_corp_jurisdiction(corp_typ_cd, corp_class, can_jur_typ_cd, othr_juris_desc):
@@ -52,46 +49,6 @@ def get_corp_jurisdiction(corp_typ_cd, corp_class, can_jur_typ_cd, othr_juris_de
     return registered_jurisdiction
 
 
-def compare_dates_lear(orgbook_reg_dt, bc_reg_reg_dt):
-    # convert to string if necessary
-    if isinstance(orgbook_reg_dt, datetime.datetime):
-        orgbook_reg_dt = orgbook_reg_dt.astimezone(pytz.utc).isoformat()
-    if isinstance(bc_reg_reg_dt, datetime.datetime):
-        bc_reg_reg_dt = bc_reg_reg_dt.astimezone(pytz.utc).isoformat()
-    if bc_reg_reg_dt is None or len(bc_reg_reg_dt) == 0 or bc_reg_reg_dt.startswith('0001-01-01'):
-        if orgbook_reg_dt is None or len(orgbook_reg_dt) == 0 or orgbook_reg_dt.startswith('0001-01-01'):
-            return True
-        return False
-    if orgbook_reg_dt is None or len(orgbook_reg_dt) == 0 or orgbook_reg_dt.startswith('0001-01-01'):
-        return False
-    return (bc_reg_reg_dt == orgbook_reg_dt)
-
-
-# compare registration dates
-def compare_dates_colin(orgbook_reg_dt, bc_reg_reg_dt):
-    if bc_reg_reg_dt is None or len(bc_reg_reg_dt) == 0:
-        if orgbook_reg_dt is None or len(orgbook_reg_dt) == 0:
-            return True
-        return MIN_START_DATE_TZ.astimezone(pytz.utc).isoformat() == orgbook_reg_dt
-    if orgbook_reg_dt is None or len(orgbook_reg_dt) == 0:
-        return bc_reg_reg_dt == '0001-01-01 00:00:00'
-    try:
-        bc_reg_reg_dt_obj = datetime.datetime.strptime(bc_reg_reg_dt, '%Y-%m-%d %H:%M:%S')
-        bc_reg_reg_dt_tz = timezone.localize(bc_reg_reg_dt_obj)
-        bc_reg_reg_dt_tz_str = bc_reg_reg_dt_tz.astimezone(pytz.utc).isoformat()
-        return bc_reg_reg_dt_tz_str == orgbook_reg_dt
-    except (Exception) as error:
-        return MIN_START_DATE_TZ.astimezone(pytz.utc).isoformat() == orgbook_reg_dt
-
-
-# compare registration dates
-def compare_dates(orgbook_reg_dt, bc_reg_reg_dt, USE_LEAR: bool = False):
-    if USE_LEAR:
-        return compare_dates_lear(orgbook_reg_dt, bc_reg_reg_dt)
-    else:
-        return compare_dates_colin(orgbook_reg_dt, bc_reg_reg_dt)
-
-
 # find the nth occurrance of substrung
 def find_nth_occurrance(substring, string, n):
     res = -1
@@ -100,125 +57,157 @@ def find_nth_occurrance(substring, string, n):
     return res
 
 
-def compare_bc_reg_orgbook(
-    bc_reg_corp_types,
-    bc_reg_corp_names,
-    bc_reg_corp_infos,
-    bc_reg_owners,
-    bc_reg_firms,
-    orgbook_corp_types,
-    orgbook_corp_names,
-    orgbook_corp_infos,
-    orgbook_corp_missing_relations,
-    orgbook_corp_active_relations,
-    future_corps,
-    ignore_list,
-    USE_LEAR: bool = False,
-):
-    missing_in_orgbook = []
-    missing_in_bcreg = []
-    wrong_corp_type = []
-    wrong_corp_name = []
-    wrong_corp_status = []
-    wrong_bus_num = []
-    wrong_corp_reg_dt = []
-    wrong_corp_juris = []
-    ignored_corps = []
-
-    if USE_LEAR:
-        corp_types_filter = LEAR_CORP_TYPES_IN_SCOPE
-    else:
-        corp_types_filter = CORP_TYPES_IN_SCOPE
+class AuditResults:
+    """
+    Discrepancies found by the BC Reg / OrgBook audit, plus the error messages
+    and the management commands to fix them.
+    Shared by all the compare engines, so they report in exactly the same way.
+    """
 
-    # check if all the BC Reg corps are in orgbook (with the same corp type)
-    if USE_LEAR:
-        cmd_pfx = "Lear"
-    else:
-        cmd_pfx = ""
-    error_msgs = ""
-    error_cmds = ""
-    for bc_reg_corp_num in bc_reg_corp_types:
-        bc_reg_corp_type = bc_reg_corp_types[bc_reg_corp_num]
-        bc_reg_corp_name = bc_reg_corp_names[bc_reg_corp_num]
-        bc_reg_corp_info = bc_reg_corp_infos[bc_reg_corp_num]
-        if bc_reg_corp_type in corp_types_filter:
-            if bc_reg_corp_num in ignore_list:
-                ignored_corps.append(bc_reg_corp_num)
+    def __init__(self, future_corps, ignore_list, USE_LEAR: bool = False):
+        self.future_corps = future_corps
+        self.ignore_list = ignore_list
+        self.USE_LEAR = USE_LEAR
+        if USE_LEAR:
+            self.corp_types_filter = LEAR_CORP_TYPES_IN_SCOPE
+            self.cmd_pfx = "Lear"
+        else:
+            self.corp_types_filter = CORP_TYPES_IN_SCOPE
+            self.cmd_pfx = ""
+
+        self.missing_in_orgbook = []
+        self.missing_in_bcreg = []
+        self.wrong_corp_type = []
+        self.wrong_corp_name = []
+        self.wrong_corp_status = []
+        self.wrong_bus_num = []
+        self.wrong_corp_reg_dt = []
+        self.wrong_corp_juris = []
+        self.ignored_corps = []
+        self.reln_list = []
+        self.active_reln_list = []
+
+        # messages are kept in groups, so they are reported in the same order whatever order the corps are compared in
+        # (lists of lines, appending to a string attribute would copy the whole string each time)
+        self.corp_msgs = []
+        self.corp_cmds = []
+        self.orgbook_msgs = []
+        self.orgbook_cmds = []
+        self.reln_msgs = []
+        self.reln_cmds = []
+
+    # the discrepancy lists and messages, that can be saved and merged (e.g. from the shards of a sharded audit)
+    RESULT_FIELDS = (
+        "missing_in_orgbook",
+        "missing_in_bcreg",
+        "wrong_corp_type",
+        "wrong_corp_name",
+        "wrong_corp_status",
+        "wrong_bus_num",
+        "wrong_corp_reg_dt",
+        "wrong_corp_juris",
+        "ignored_corps",
+        "reln_list",
+        "active_reln_list",
+        "corp_msgs",
+        "corp_cmds",
+        "orgbook_msgs",
+        "orgbook_cmds",
+        "reln_msgs",
+        "reln_cmds",
+    )
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.RESULT_FIELDS}
+
+    def merge(self, results_dict):
+        """
+        Adds the discrepancies and messages from another set of results (see as_dict()).
+        """
+        for field in self.RESULT_FIELDS:
+            getattr(self, field).extend(results_dict[field])
+
+    def add_corp_error(self, error_list, bc_reg_corp_num, error_msg):
+        # in orgbook but has the wrong data in orgbook
+        self.corp_msgs.append(error_msg + "\n")
+        error_list.append(bc_reg_corp_num)
+        self.corp_cmds.append("./manage -p bc -e prod deleteTopic " + bc_reg_corp_num + "\n")
+        self.corp_cmds.append("./manage -e prod requeueOrganization" + self.cmd_pfx + " " + bare_corp_num(bc_reg_corp_num) + "\n")
+
+    def compare_corp(self, bc_reg_corp_num, bc_reg_corp, orgbook_corp):
+        """
+        Check a BC Reg corp is in orgbook (with the same corp type, name, etc.)
+        orgbook_corp is None if the corp isn't in orgbook.
+        """
+        bc_reg_corp_type = bc_reg_corp.corp_type
+        bc_reg_corp_name = bc_reg_corp.corp_name
+        if bc_reg_corp_type in self.corp_types_filter:
+            if bc_reg_corp_num in self.ignore_list:
+                self.ignored_corps.append(bc_reg_corp_num)
                 pass
-            elif bare_corp_num(bc_reg_corp_num) in future_corps:
+            elif bare_corp_num(bc_reg_corp_num) in self.future_corps:
                 #print("Future corp ignore:", row["corp_num"])
                 pass
-            elif not bc_reg_corp_num in orgbook_corp_types:
+            elif orgbook_corp is None:
                 # not in orgbook
-                error_msgs += "Topic not found for: " + bc_reg_corp_num + "\n"
-                missing_in_orgbook.append(bc_reg_corp_num)
-                error_cmds += "./manage -e prod queueOrganization" + cmd_pfx + " " + bare_corp_num(bc_reg_corp_num) + "\n"
+                self.corp_msgs.append("Topic not found for: " + bc_reg_corp_num + "\n")
+                self.missing_in_orgbook.append(bc_reg_corp_num)
+                self.corp_cmds.append("./manage -e prod queueOrganization" + self.cmd_pfx + " " + bare_corp_num(bc_reg_corp_num) + "\n")
                 pass
-            elif (not orgbook_corp_types[bc_reg_corp_num]) or (orgbook_corp_types[bc_reg_corp_num] != bc_reg_corp_type):
+            elif (not orgbook_corp.corp_type) or (orgbook_corp.corp_type != bc_reg_corp_type):
                 # in orgbook but has the wrong corp type in orgbook
-                error_msgs += "Corp Type mis-match for: " + bc_reg_corp_num + '; BC Reg: "'+bc_reg_corp_type+'", OrgBook: "'+orgbook_corp_types[bc_reg_corp_num]+'"' + "\n"
-                wrong_corp_type.append(bc_reg_corp_num)
-                error_cmds += "./manage -p bc -e prod deleteTopic " + bc_reg_corp_num + "\n"
-                error_cmds += "./manage -e prod requeueOrganization" + cmd_pfx + " " + bare_corp_num(bc_reg_corp_num) + "\n"
-            elif (orgbook_corp_names[bc_reg_corp_num].strip() != bc_reg_corp_name.strip()):
+                self.add_corp_error(self.wrong_corp_type, bc_reg_corp_num, "Corp Type mis-match for: " + bc_reg_corp_num + '; BC Reg: "'+bc_reg_corp_type+'", OrgBook: "'+orgbook_corp.corp_type+'"')
+            elif (orgbook_corp.corp_name.strip() != bc_reg_corp_name.strip()):
                 # in orgbook but has the wrong corp name in orgbook
-                error_msgs += "Corp Name mis-match for: " + bc_reg_corp_num + ' BC Reg: "'+bc_reg_corp_name+'", OrgBook: "'+orgbook_corp_names[bc_reg_corp_num]+'"' + "\n"
-                wrong_corp_name.append(bc_reg_corp_num)
-                error_cmds += "./manage -p bc -e prod deleteTopic " + bc_reg_corp_num + "\n"
-                error_cmds += "./manage -e prod requeueOrganization" + cmd_pfx + " " + bare_corp_num(bc_reg_corp_num) + "\n"
-            elif (orgbook_corp_infos[bc_reg_corp_num]["entity_status"] != bc_reg_corp_info["op_state_typ_cd"]):
+                self.add_corp_error(self.wrong_corp_name, bc_reg_corp_num, "Corp Name mis-match for: " + bc_reg_corp_num + ' BC Reg: "'+bc_reg_corp_name+'", OrgBook: "'+orgbook_corp.corp_name+'"')
+            elif (orgbook_corp.entity_status != bc_reg_corp.op_state_typ_cd):
                 # wrong entity status
-                error_msgs += "Corp Status mis-match for: " + bc_reg_corp_num + ' BC Reg: "'+bc_reg_corp_info["op_state_typ_cd"]+'", OrgBook: "'+orgbook_corp_infos[bc_reg_corp_num]["entity_status"]+'"' + "\n"
-                wrong_corp_status.append(bc_reg_corp_num)
-                error_cmds += "./manage -p bc -e prod deleteTopic " + bc_reg_corp_num + "\n"
-                error_cmds += "./manage -e prod requeueOrganization" + cmd_pfx + " " + bare_corp_num(bc_reg_corp_num) + "\n"
-            elif (orgbook_corp_infos[bc_reg_corp_num]["bus_num"].strip() != bc_reg_corp_info["bn_9"].strip()):
+                self.add_corp_error(self.wrong_corp_status, bc_reg_corp_num, "Corp Status mis-match for: " + bc_reg_corp_num + ' BC Reg: "'+bc_reg_corp.op_state_typ_cd+'", OrgBook: "'+orgbook_corp.entity_status+'"')
+            elif (orgbook_corp.bus_num.strip() != bc_reg_corp.bn_9.strip()):
                 # wrong BN9 business number
-                error_msgs += "Business Number mis-match for: " + bc_reg_corp_num + ' BC Reg: "'+bc_reg_corp_info["bn_9"]+'", OrgBook: "'+orgbook_corp_infos[bc_reg_corp_num]["bus_num"]+'"' + "\n"
-                wrong_bus_num.append(bc_reg_corp_num)
-                error_cmds += "./manage -p bc -e prod deleteTopic " + bc_reg_corp_num + "\n"
-                error_cmds += "./manage -e prod requeueOrganization" + cmd_pfx + " " + bare_corp_num(bc_reg_corp_num) + "\n"
-            elif (not compare_dates(orgbook_corp_infos[bc_reg_corp_num]["registration_date"], bc_reg_corp_info["recognition_dts"], USE_LEAR=USE_LEAR)):
-                # wrong registration date
-                error_msgs += "Corp Registration Date mis-match for: " + bc_reg_corp_num + ' BC Reg: "'+bc_reg_corp_info["recognition_dts"]+'", OrgBook: "'+orgbook_corp_infos[bc_reg_corp_num]["registration_date"]+'"' + "\n"
-                wrong_corp_reg_dt.append(bc_reg_corp_num)
-                error_cmds += "./manage -p bc -e prod deleteTopic " + bc_reg_corp_num + "\n"
-                error_cmds += "./manage -e prod requeueOrganization" + cmd_pfx + " " + bare_corp_num(bc_reg_corp_num) + "\n"
-            elif (orgbook_corp_infos[bc_reg_corp_num]["home_jurisdiction"] != get_corp_jurisdiction(bc_reg_corp_info["corp_type"], bc_reg_corp_info["corp_class"], bc_reg_corp_info["can_jur_typ_cd"], bc_reg_corp_info["othr_juris_desc"])):
+                self.add_corp_error(self.wrong_bus_num, bc_reg_corp_num, "Business Number mis-match for: " + bc_reg_corp_num + ' BC Reg: "'+bc_reg_corp.bn_9+'", OrgBook: "'+orgbook_corp.bus_num+'"')
+            elif not registration_dates_match(orgbook_corp.registration_utc, bc_reg_corp.registration_utc, USE_LEAR=self.USE_LEAR):
+                # wrong registration date (both normalized to UTC when loaded)
+                self.add_corp_error(self.wrong_corp_reg_dt, bc_reg_corp_num, "Corp Registration Date mis-match for: " + bc_reg_corp_num + ' BC Reg: "'+bc_reg_corp.recognition_dts+'", OrgBook: "'+orgbook_corp.registration_date+'"')
+            elif (orgbook_corp.home_jurisdiction != get_corp_jurisdiction(bc_reg_corp.corp_type, bc_reg_corp.corp_class, bc_reg_corp.can_jur_typ_cd, bc_reg_corp.othr_juris_desc)):
                 # wrong jurisdiction
-                calc_juris = get_corp_jurisdiction(bc_reg_corp_info["corp_type"], bc_reg_corp_info["corp_class"], bc_reg_corp_info["can_jur_typ_cd"], bc_reg_corp_info["othr_juris_desc"])
-                error_msgs += "Corp Jurisdiction mis-match for: " + bc_reg_corp_num + ' BC Reg: "'+calc_juris+'", OrgBook: "'+orgbook_corp_infos[bc_reg_corp_num]["home_jurisdiction"]+'"' + "\n"
-                wrong_corp_juris.append(bc_reg_corp_num)
-                error_cmds += "./manage -p bc -e prod deleteTopic " + bc_reg_corp_num + "\n"
-                error_cmds += "./manage -e prod requeueOrganization" + cmd_pfx + " " + bare_corp_num(bc_reg_corp_num) + "\n"
+                calc_juris = get_corp_jurisdiction(bc_reg_corp.corp_type, bc_reg_corp.corp_class, bc_reg_corp.can_jur_typ_cd, bc_reg_corp.othr_juris_desc)
+                self.add_corp_error(self.wrong_corp_juris, bc_reg_corp_num, "Corp Jurisdiction mis-match for: " + bc_reg_corp_num + ' BC Reg: "'+calc_juris+'", OrgBook: "'+orgbook_corp.home_jurisdiction+'"')
 
-    # now check if there are corps in orgbook that are *not* in BC Reg database
-    for orgbook_corp in orgbook_corp_types:
-        bc_reg_corp_type = bc_reg_corp_types.get(orgbook_corp)
-        if (bc_reg_corp_type and bc_reg_corp_type in corp_types_filter) and not (orgbook_corp in bc_reg_corp_types):
-            missing_in_bcreg.append(orgbook_corp)
-            error_msgs += "OrgBook corp not in BC Reg: " + orgbook_corp + "\n"
-            error_cmds += "./manage -p bc -e prod deleteTopic " + orgbook_corp + "\n"
-
-    # fixes for missing relationships
-    reln_hash = {}
-    reln_list = []
-    active_reln_hash = {}
-    active_reln_list = []
-    if not USE_LEAR:
+    def compare_orgbook_corp(self, orgbook_corp_num, bc_reg_corp, in_bc_reg: bool):
+        """
+        Check if a corp in orgbook is *not* in BC Reg database.
+        bc_reg_corp is None if the corp isn't in BC Reg.
+        """
+        if (bc_reg_corp and bc_reg_corp.corp_type in self.corp_types_filter) and not in_bc_reg:
+            self.missing_in_bcreg.append(orgbook_corp_num)
+            self.orgbook_msgs.append("OrgBook corp not in BC Reg: " + orgbook_corp_num + "\n")
+            self.orgbook_cmds.append("./manage -p bc -e prod deleteTopic " + orgbook_corp_num + "\n")
+
+    def compare_relations(self, bc_reg_corp_nums, bc_reg_owners, orgbook_corp_missing_relations, orgbook_corp_active_relations):
+        """
+        Check for missing and mis-matched relationships.
+        bc_reg_corp_nums can be any collection (supporting "in") of the BC Reg corps referenced by the relationships.
+        """
+        if self.USE_LEAR:
+            return
+
+        # fixes for missing relationships
+        reln_hash = {}
+        active_reln_hash = {}
         for relation in orgbook_corp_missing_relations:
             reln = relation['s_2'] + ":" + relation['s_1']
             if not reln in reln_hash:
                 reln_hash[reln] = reln
-                reln_list.append(reln)
-                error_msgs += "Mis-matched relationship in OrgBook:" + reln + "\n"
+                self.reln_list.append(reln)
+                self.reln_msgs.append("Mis-matched relationship in OrgBook:" + reln + "\n")
                 reg_cmd = "queueOrgForRelnsUpdate"
                 corp_num = relation['s_2']
                 if corp_num.startswith('FM'):
                     reg_cmd = "queueOrgForRelnsUpdateLear"
                 elif corp_num.startswith('BC'):
                     corp_num = corp_num[2:]
-                error_cmds += "./manage -e prod " + reg_cmd + " " + corp_num + " " + relation['s_1'] + "\n"
+                self.reln_cmds.append("./manage -e prod " + reg_cmd + " " + corp_num + " " + relation['s_1'] + "\n")
 
         for relation in orgbook_corp_active_relations:
             source_id_1 = relation["source_id_1"]
@@ -227,79 +216,314 @@ def compare_bc_reg_orgbook(
             active_reln_hash[o_hash] = o_hash
         for relation in bc_reg_owners:
             # only check if both firms are already in OrgBook
-            if relation["firm"] in bc_reg_corp_types and relation["owner"] in bc_reg_corp_types:
+            if relation["firm"] in bc_reg_corp_nums and relation["owner"] in bc_reg_corp_nums:
                 f_hash = relation["firm"] + ":" + relation["owner"]
                 o_hash = relation["owner"] + ":" + relation["firm"]
                 if (not f_hash in reln_hash) and (not f_hash in active_reln_hash):
-                    active_reln_list.append(f_hash)
-                    error_msgs += "Missing relationship in OrgBook:" + f_hash + "\n"
+                    self.active_reln_list.append(f_hash)
+                    self.reln_msgs.append("Missing relationship in OrgBook:" + f_hash + "\n")
                     reg_cmd = "queueOrgForRelnsUpdate"
                     corp_num = relation["owner"]
                     if corp_num.startswith('BC'):
                         corp_num = corp_num[2:]
-                    error_cmds += "./manage -e prod " + reg_cmd + " " + corp_num + " " + relation['firm'] + "\n"
+                    self.reln_cmds.append("./manage -e prod " + reg_cmd + " " + corp_num + " " + relation['firm'] + "\n")
                 if (not f_hash in reln_hash) and (not o_hash in active_reln_hash):
-                    active_reln_list.append(o_hash)
-                    error_msgs += "Missing relationship in OrgBook:" + o_hash + "\n"
+                    self.active_reln_list.append(o_hash)
+                    self.reln_msgs.append("Missing relationship in OrgBook:" + o_hash + "\n")
                     reg_cmd = "queueOrgForRelnsUpdateLear"
                     corp_num = relation["owner"]
-                    error_cmds += "./manage -e prod " + reg_cmd + " " + relation['firm'] + " " + corp_num + "\n"
-
-    corp_errors = (len(missing_in_orgbook) +
-                    len(missing_in_bcreg) +
-                    len(wrong_corp_type) +
-                    len(wrong_corp_name) +
-                    len(wrong_corp_status) +
-                    len(wrong_bus_num) +
-                    len(wrong_corp_reg_dt) +
-                    len(wrong_corp_juris) +
-                    len(reln_list) +
-                    len(active_reln_list))
-
-    if MAX_ERRORS_TO_POST < corp_errors:
-        res = find_nth_occurrance("\n", error_msgs, MAX_ERRORS_TO_POST)
-        error_msgs_summary = error_msgs[:res+1] + "... etc ..."
-        log_error(error_msgs_summary, error_msgs)
-        res = find_nth_occurrance("\n", error_cmds, MAX_ERRORS_TO_POST)
-        error_cmds_summary = error_cmds[:res+1] + "... etc ..."
-        log_error(error_cmds_summary, error_cmds)
-    elif 0 < corp_errors:
-        log_error(error_msgs)
-        log_error(error_cmds)
-
-    error_summary_summary = ""
-    if len(ignored_corps) > 0:
-        error_summary_summary += "Ignored Corps:           " + str(len(ignored_corps)) + "\n"
-    error_summary_summary += "Missing in OrgBook:      " + str(len(missing_in_orgbook)) + "\n"
-    error_summary_summary += "Missing in BC Reg:       " + str(len(missing_in_bcreg)) + "\n"
-    error_summary_summary += "Wrong corp type:         " + str(len(wrong_corp_type)) + "\n"
-    error_summary_summary += "Wrong corp name:         " + str(len(wrong_corp_name)) + "\n"
-    error_summary_summary += "Wrong corp status:       " + str(len(wrong_corp_status)) + "\n"
-    error_summary_summary += "Wrong business number:   " + str(len(wrong_bus_num)) + "\n"
-    error_summary_summary += "Wrong corp registration: " + str(len(wrong_corp_reg_dt)) + "\n"
-    error_summary_summary += "Wrong corp jurisdiction: " + str(len(wrong_corp_juris)) + "\n"
-    if not USE_LEAR:
-        error_summary_summary += "Mis-matched OrgBook relationships: " + str(len(reln_list)) + "\n"
-        error_summary_summary += "Missing OrgBook relationships: " + str(len(active_reln_list)) + "\n"
-
-    error_summary = ""
-    if len(ignored_corps) > 0:
-        error_summary += "Ignored Corps:           " + str(len(ignored_corps)) + " " + str(ignored_corps) + "\n"
-    error_summary += "Missing in OrgBook:      " + str(len(missing_in_orgbook)) + " " + str(missing_in_orgbook) + "\n"
-    error_summary += "Missing in BC Reg:       " + str(len(missing_in_bcreg)) + " " + str(missing_in_bcreg) + "\n"
-    error_summary += "Wrong corp type:         " + str(len(wrong_corp_type)) + " " + str(wrong_corp_type) + "\n"
-    error_summary += "Wrong corp name:         " + str(len(wrong_corp_name)) + " " + str(wrong_corp_name) + "\n"
-    error_summary += "Wrong corp status:       " + str(len(wrong_corp_status)) + " " + str(wrong_corp_status) + "\n"
-    error_summary += "Wrong business number:   " + str(len(wrong_bus_num)) + " " + str(wrong_bus_num) + "\n"
-    error_summary += "Wrong corp registration: " + str(len(wrong_corp_reg_dt)) + " " + str(wrong_corp_reg_dt) + "\n"
-    error_summary += "Wrong corp jurisdiction: " + str(len(wrong_corp_juris)) + " " + str(wrong_corp_juris) + "\n"
-    if not USE_LEAR:
-        error_summary += "Mis-matched OrgBook relationships: " + str(len(reln_list)) + " " + str(reln_list) + "\n"
-        error_summary += "Missing OrgBook relationships: " + str(len(active_reln_list)) + " " + str(active_reln_list) + "\n"
-
-    if 0 < corp_errors:
-        log_error(error_summary_summary, error_summary)
-    else:
-        log_info(error_summary_summary, error_summary)
+                    self.reln_cmds.append("./manage -e prod " + reg_cmd + " " + relation['firm'] + " " + corp_num + "\n")
+
+    def report(self):
+        """
+        Log the error messages, fix commands and summary, returns the list of corps with the wrong business number.
+        """
+        error_msgs = "".join(self.corp_msgs + self.orgbook_msgs + self.reln_msgs)
+        error_cmds = "".join(self.corp_cmds + self.orgbook_cmds + self.reln_cmds)
+
+        corp_errors = (len(self.missing_in_orgbook) +
+                        len(self.missing_in_bcreg) +
+                        len(self.wrong_corp_type) +
+                        len(self.wrong_corp_name) +
+                        len(self.wrong_corp_status) +
+                        len(self.wrong_bus_num) +
+                        len(self.wrong_corp_reg_dt) +
+                        len(self.wrong_corp_juris) +
+                        len(self.reln_list) +
+                        len(self.active_reln_list))
+
+        if MAX_ERRORS_TO_POST < corp_errors:
+            res = find_nth_occurrance("\n", error_msgs, MAX_ERRORS_TO_POST)
+            error_msgs_summary = error_msgs[:res+1] + "... etc ..."
+            log_error(error_msgs_summary, error_msgs)
+            res = find_nth_occurrance("\n", error_cmds, MAX_ERRORS_TO_POST)
+            error_cmds_summary = error_cmds[:res+1] + "... etc ..."
+            log_error(error_cmds_summary, error_cmds)
+        elif 0 < corp_errors:
+            log_error(error_msgs)
+            log_error(error_cmds)
+
+        error_summary_summary = ""
+        if len(self.ignored_corps) > 0:
+            error_summary_summary += "Ignored Corps:           " + str(len(self.ignored_corps)) + "\n"
+        error_summary_summary += "Missing in OrgBook:      " + str(len(self.missing_in_orgbook)) + "\n"
+        error_summary_summary += "Missing in BC Reg:       " + str(len(self.missing_in_bcreg)) + "\n"
+        error_summary_summary += "Wrong corp type:         " + str(len(self.wrong_corp_type)) + "\n"
+        error_summary_summary += "Wrong corp name:         " + str(len(self.wrong_corp_name)) + "\n"
+        error_summary_summary += "Wrong corp status:       " + str(len(self.wrong_corp_status)) + "\n"
+        error_summary_summary += "Wrong business number:   " + str(len(self.wrong_bus_num)) + "\n"
+        error_summary_summary += "Wrong corp registration: " + str(len(self.wrong_corp_reg_dt)) + "\n"
+        error_summary_summary += "Wrong corp jurisdiction: " + str(len(self.wrong_corp_juris)) + "\n"
+        if not self.USE_LEAR:
+            error_summary_summary += "Mis-matched OrgBook relationships: " + str(len(self.reln_list)) + "\n"
+            error_summary_summary += "Missing OrgBook relationships: " + str(len(self.active_reln_list)) + "\n"
+
+        error_summary = ""
+        if len(self.ignored_corps) > 0:
+            error_summary += "Ignored Corps:           " + str(len(self.ignored_corps)) + " " + str(self.ignored_corps) + "\n"
+        error_summary += "Missing in OrgBook:      " + str(len(self.missing_in_orgbook)) + " " + str(self.missing_in_orgbook) + "\n"
+        error_summary += "Missing in BC Reg:       " + str(len(self.missing_in_bcreg)) + " " + str(self.missing_in_bcreg) + "\n"
+        error_summary += "Wrong corp type:         " + str(len(self.wrong_corp_type)) + " " + str(self.wrong_corp_type) + "\n"
+        error_summary += "Wrong corp name:         " + str(len(self.wrong_corp_name)) + " " + str(self.wrong_corp_name) + "\n"
+        error_summary += "Wrong corp status:       " + str(len(self.wrong_corp_status)) + " " + str(self.wrong_corp_status) + "\n"
+        error_summary += "Wrong business number:   " + str(len(self.wrong_bus_num)) + " " + str(self.wrong_bus_num) + "\n"
+        error_summary += "Wrong corp registration: " + str(len(self.wrong_corp_reg_dt)) + " " + str(self.wrong_corp_reg_dt) + "\n"
+        error_summary += "Wrong corp jurisdiction: " + str(len(self.wrong_corp_juris)) + " " + str(self.wrong_corp_juris) + "\n"
+        if not self.USE_LEAR:
+            error_summary += "Mis-matched OrgBook relationships: " + str(len(self.reln_list)) + " " + str(self.reln_list) + "\n"
+            error_summary += "Missing OrgBook relationships: " + str(len(self.active_reln_list)) + " " + str(self.active_reln_list) + "\n"
+
+        if 0 < corp_errors:
+            log_error(error_summary_summary, error_summary)
+        else:
+            log_info(error_summary_summary, error_summary)
+
+        return self.wrong_bus_num
+
+
+def compare_bc_reg_orgbook(
+    bc_reg_corps,
+    bc_reg_owners,
+    bc_reg_firms,
+    orgbook_corps,
+    orgbook_corp_missing_relations,
+    orgbook_corp_active_relations,
+    future_corps,
+    ignore_list,
+    USE_LEAR: bool = False,
+):
+    """
+    Compares BC Reg and OrgBook corps, with both full datasets loaded into hash maps (dicts of corp_num -> record).
+    """
+    results = AuditResults(future_corps, ignore_list, USE_LEAR=USE_LEAR)
+
+    # check if all the BC Reg corps are in orgbook (with the same corp type)
+    for bc_reg_corp_num, bc_reg_corp in bc_reg_corps.items():
+        results.compare_corp(bc_reg_corp_num, bc_reg_corp, orgbook_corps.get(bc_reg_corp_num))
+
+    # now check if there are corps in orgbook that are *not* in BC Reg database
+    for orgbook_corp in orgbook_corps:
+        results.compare_orgbook_corp(orgbook_corp, bc_reg_corps.get(orgbook_corp), orgbook_corp in bc_reg_corps)
+
+    results.compare_relations(bc_reg_corps, bc_reg_owners, orgbook_corp_missing_relations, orgbook_corp_active_relations)
+
+    return results.report()
+
+
+def unique_sorted_corps(corps, source):
+    """
+    Checks a stream of corp records is sorted by corp_num, and drops duplicates
+    (the last record for each corp_num wins, the same as loading the stream into a dict).
+    """
+    prev_corp = None
+    for corp in corps:
+        if prev_corp is not None:
+            if corp.corp_num < prev_corp.corp_num:
+                raise Exception(source + " corps are not sorted by corp_num: " + prev_corp.corp_num + " > " + corp.corp_num)
+            if corp.corp_num != prev_corp.corp_num:
+                yield prev_corp
+        prev_corp = corp
+    if prev_corp is not None:
+        yield prev_corp
+
+
+def merge_compare_corps(results, bc_reg_corps_sorted, orgbook_corps_sorted, relation_corp_nums):
+    """
+    Compares two streams of BC Reg and OrgBook corp records, both ordered by corp_num (a merge join),
+    so memory use doesn't depend on the number of corps.
+    Returns the BC Reg corps (of relation_corp_nums) that were found, for the relationship checks.
+    """
+    # the only BC Reg corps we need to remember are the ones referenced by relationships
+    bc_reg_relation_corp_nums = set()
+
+    bc_reg_iter = unique_sorted_corps(bc_reg_corps_sorted, "BC Reg")
+    orgbook_iter = unique_sorted_corps(orgbook_corps_sorted, "OrgBook")
+    bc_reg_corp = next(bc_reg_iter, None)
+    orgbook_corp = next(orgbook_iter, None)
+    compare_count = 0
+    while bc_reg_corp is not None or orgbook_corp is not None:
+        if orgbook_corp is None or (bc_reg_corp is not None and bc_reg_corp.corp_num < orgbook_corp.corp_num):
+            # BC Reg only
+            results.compare_corp(bc_reg_corp.corp_num, bc_reg_corp, None)
+            if bc_reg_corp.corp_num in relation_corp_nums:
+                bc_reg_relation_corp_nums.add(bc_reg_corp.corp_num)
+            bc_reg_corp = next(bc_reg_iter, None)
+        elif bc_reg_corp is None or orgbook_corp.corp_num < bc_reg_corp.corp_num:
+            # OrgBook only
+            results.compare_orgbook_corp(orgbook_corp.corp_num, None, False)
+            orgbook_corp = next(orgbook_iter, None)
+        else:
+            # in both
+            results.compare_corp(bc_reg_corp.corp_num, bc_reg_corp, orgbook_corp)
+            results.compare_orgbook_corp(orgbook_corp.corp_num, bc_reg_corp, True)
+            if bc_reg_corp.corp_num in relation_corp_nums:
+                bc_reg_relation_corp_nums.add(bc_reg_corp.corp_num)
+            bc_reg_corp = next(bc_reg_iter, None)
+            orgbook_corp = next(orgbook_iter, None)
+        compare_count = compare_count + 1
+        if 0 == compare_count % REPORT_COUNT:
+            print(">>> Compared {} corps {}".format(compare_count, datetime.datetime.now()))
+
+    return bc_reg_relation_corp_nums
+
+
+def relation_corp_nums(bc_reg_owners):
+    """
+    Returns all the corps (firms and owners) referenced by the BC Reg relationships.
+    """
+    corp_nums = set()
+    for relation in bc_reg_owners:
+        corp_nums.add(relation["firm"])
+        corp_nums.add(relation["owner"])
+    return corp_nums
+
+
+def compare_bc_reg_orgbook_sorted(
+    bc_reg_corps_sorted,
+    bc_reg_owners,
+    bc_reg_firms,
+    orgbook_corps_sorted,
+    orgbook_corp_missing_relations,
+    orgbook_corp_active_relations,
+    future_corps,
+    ignore_list,
+    USE_LEAR: bool = False,
+):
+    """
+    Compares BC Reg and OrgBook corps in a single pass over two streams of records, both ordered by corp_num
+    (a merge join), so memory use doesn't depend on the number of corps.
+    Reports exactly the same discrepancies as compare_bc_reg_orgbook().
+    """
+    results = AuditResults(future_corps, ignore_list, USE_LEAR=USE_LEAR)
+
+    bc_reg_relation_corp_nums = merge_compare_corps(results, bc_reg_corps_sorted, orgbook_corps_sorted, relation_corp_nums(bc_reg_owners))
+
+    results.compare_relations(bc_reg_relation_corp_nums, bc_reg_owners, orgbook_corp_missing_relations, orgbook_corp_active_relations)
+
+    return results.report()
+
+
+def object_column(values):
+    """
+    Builds a numpy object array from a list of (string) values.
+    """
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+
+def in_collection(values, collection):
+    """
+    Returns a boolean mask, True for each value that is in the collection (set, dict, list etc).
+    """
+    return np.fromiter(map(collection.__contains__, values), dtype=bool, count=len(values))
+
+
+def corp_jurisdictions(corp_types, corp_classes, can_jur_typ_cds, othr_juris_descs):
+    """
+    Vectorized version of get_corp_jurisdiction().
+    """
+    is_bc_class = (corp_classes == 'BC')
+    is_xpro = (corp_classes == 'XPRO') | in_collection(corp_types, XPRO_CORP_TYPES)
+    other_juris = np.where(othr_juris_descs != "", othr_juris_descs, can_jur_typ_cds)
+    xpro_juris = np.where(can_jur_typ_cds == 'OT', other_juris, can_jur_typ_cds)
+    return np.where(is_bc_class, "BC", np.where(is_xpro, xpro_juris, "BC"))
+
+
+def stripped_mismatches(orgbook_values, bc_reg_values):
+    """
+    Returns a mask of the values that don't match, ignoring leading/trailing whitespace.
+    Only the values that don't match exactly are stripped.
+    """
+    mismatches = (orgbook_values != bc_reg_values)
+    for i in np.flatnonzero(mismatches):
+        mismatches[i] = (orgbook_values[i].strip() != bc_reg_values[i].strip())
+    return mismatches
+
+
+def compare_bc_reg_orgbook_columnar(
+    bc_reg_corps,
+    bc_reg_owners,
+    bc_reg_firms,
+    orgbook_corps,
+    orgbook_corp_missing_relations,
+    orgbook_corp_active_relations,
+    future_corps,
+    ignore_list,
+    USE_LEAR: bool = False,
+):
+    """
+    Compares BC Reg and OrgBook corps column-by-column (numpy arrays, aligned by corp num) rather than corp-by-corp.
+    A mismatch mask is computed for each field in bulk, and only the corps flagged by the masks are run
+    through the per-corp checks (to build the error messages), so the report is the same as compare_bc_reg_orgbook().
+    """
+    results = AuditResults(future_corps, ignore_list, USE_LEAR=USE_LEAR)
+
+    bc_reg_corp_list = list(bc_reg_corps.values())
+    bc_reg_corp_nums = object_column(list(bc_reg_corps))
+    # orgbook corps aligned with the BC Reg corps (a blank placeholder if the corp isn't in orgbook)
+    missing_corp = OrgBookCorp("", "")
+    orgbook_corp_list = list(map(orgbook_corps.get, bc_reg_corp_nums))
+    in_orgbook = np.fromiter((orgbook_corp is not None for orgbook_corp in orgbook_corp_list), dtype=bool, count=len(orgbook_corp_list))
+    aligned_orgbook_corps = [orgbook_corp or missing_corp for orgbook_corp in orgbook_corp_list]
+
+    def bc_reg_column(field):
+        return object_column(list(map(operator.attrgetter(field), bc_reg_corp_list)))
+
+    def orgbook_column(field):
+        return object_column(list(map(operator.attrgetter(field), aligned_orgbook_corps)))
+
+    bc_reg_corp_types = bc_reg_column("corp_type")
+
+    # corps to check, in the same order (and with the same precedence) as the per-corp checks
+    to_check = in_collection(bc_reg_corp_types, set(results.corp_types_filter))
+    flagged = to_check & in_collection(bc_reg_corp_nums, set(ignore_list))
+    to_check = to_check & ~flagged
+    check_index = np.flatnonzero(to_check)
+    to_check[check_index] = ~in_collection([bare_corp_num(corp_num) for corp_num in bc_reg_corp_nums[check_index]], future_corps)
+    flagged = flagged | (to_check & ~in_orgbook)
+    to_check = to_check & in_orgbook
+
+    orgbook_corp_types = orgbook_column("corp_type")
+    mismatches = (orgbook_corp_types == "") | (orgbook_corp_types != bc_reg_corp_types)
+    mismatches = mismatches | stripped_mismatches(orgbook_column("corp_name"), bc_reg_column("corp_name"))
+    mismatches = mismatches | (orgbook_column("entity_status") != bc_reg_column("op_state_typ_cd"))
+    mismatches = mismatches | stripped_mismatches(orgbook_column("bus_num"), bc_reg_column("bn_9"))
+    # (dates that aren't equal are re-checked per corp, some null-like dates match, see registration_dates_match())
+    mismatches = mismatches | (orgbook_column("registration_utc") != bc_reg_column("registration_utc"))
+    mismatches = mismatches | (orgbook_column("home_jurisdiction") != corp_jurisdictions(
+        bc_reg_corp_types,
+        bc_reg_column("corp_class"),
+        bc_reg_column("can_jur_typ_cd"),
+        bc_reg_column("othr_juris_desc"),
+    ))
+    flagged = flagged | (to_check & mismatches)
+
+    for i in np.flatnonzero(flagged):
+        results.compare_corp(bc_reg_corp_nums[i], bc_reg_corp_list[i], orgbook_corp_list[i])
+
+    # (no "orgbook corp not in BC Reg" check - compare_orgbook_corp() only flags corps that are both in and not in BC Reg)
+
+    results.compare_relations(bc_reg_corps, bc_reg_owners, orgbook_corp_missing_relations, orgbook_corp_active_relations)
 
-    return wrong_bus_num
+    return results.report()
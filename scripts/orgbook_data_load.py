@@ -1,26 +1,31 @@
 #!/usr/bin/python
 import os 
-import psycopg2
 import datetime
 import time
-import pytz
-import json
-import decimal
-import requests
 import csv
+import concurrent.futures
+import itertools
+import queue
+import threading
 
 from config import (
-    get_connection,
+    cancel_queries,
+    release_connections,
     get_db_sql,
-    get_sql_record_count,
+    get_db_sql_stream,
     BCREG_SYSTEM_TYPE,
     LEAR_SYSTEM_TYPE,
     CORP_TYPES_IN_SCOPE,
     LEAR_CORP_TYPES_IN_SCOPE,
     corp_num_with_prefix,
-    bare_corp_num,
+    corp_shard,
+    corp_shard_sql,
     is_valid_corp_num,
 )
+from corp_records import BcRegCorp, OrgBookCorp, intern_code
+from reg_dates import lear_date_to_utc, normalize_colin_date, normalize_utc_date
+from snapshot import SnapshotWriter, read_snapshot_columns, read_snapshot_rows, SNAPSHOT_EXTENSION
+from wallet_id_cache import WalletIdCache, open_shard_cache
 
 
 QUERY_LIMIT = '200000'
@@ -36,6 +41,218 @@ TOPIC_QUERY = "/topic/registration.registries.ca/"
 TOPIC_NAME_SEARCH = "/search/topic?inactive=false&latest=true&revoked=false&name="
 TOPIC_ID_SEARCH = "/search/topic?inactive=false&latest=true&revoked=false&topic_id="
 
+# max number of extracts to run at the same time (default is to run them all at once)
+EXTRACT_WORKERS = int(os.environ.get('EXTRACT_WORKERS', '0'))
+
+# extracts are always exported as binary snapshots, set EXPORT_CSV to also write csv files
+EXPORT_CSV = (os.environ.get('EXPORT_CSV', 'false').lower() == 'true')
+
+# rows are handed to the background export writer in batches
+EXPORT_BATCH_SIZE = 1000
+EXPORT_QUEUE_SIZE = 100
+# queued (instead of the end of the rows) when the extract fails, so the partial export is discarded
+EXPORT_ABORT = object()
+
+# full corp num (with the BC prefix, see corp_num_with_prefix()) as a sql expression
+COLIN_FULL_CORP_NUM_SQL = """
+    (case when corp.corp_typ_cd in ('BC','ULC','CC','BEN') and corp.corp_num not like 'BC%'
+        then 'BC' || corp.corp_num else corp.corp_num end)
+"""
+
+# order rows the same way python compares strings, so sorted streams can be merge-joined
+ORDER_BY_CORP_NUM_SQL = """
+    order by {} collate "C"
+"""
+
+
+
+def csv_value(value):
+    """
+    Returns a value as it is read back from a csv export (None is "", everything else is a string),
+    so the live extracts compare exactly the same way as the USE_CSV extracts.
+    """
+    if value is None:
+        return ""
+    return str(value)
+
+
+def csv_row(row):
+    return {key: csv_value(value) for key, value in row.items()}
+
+
+class BackgroundExportWriter:
+    """
+    Writes an extract to the export folder on a background thread - a binary snapshot
+    (see snapshot.py) and, if EXPORT_CSV is set, a csv file.
+    The export is a side channel only - the extracts return their data in memory.
+    Both files are written to temp files and swapped in once the extract completes, so a failed
+    extract leaves the previous export as it was.
+    """
+
+    def __init__(self, file_base, fieldnames, dict_fields=()):
+        self.file_base = file_base
+        self.fieldnames = fieldnames
+        self.dict_fields = dict_fields
+        self.batch = []
+        self.error = None
+        self.queue = queue.Queue(maxsize=EXPORT_QUEUE_SIZE)
+        self.thread = threading.Thread(target=self._write_rows, name="export-" + file_base, daemon=True)
+        self.thread.start()
+
+    def _write_rows(self):
+        csv_file_name = self.file_base + '.csv'
+        tmp_csv_file_name = csv_file_name + '.tmp'
+        corp_file = None
+        try:
+            snapshot_writer = SnapshotWriter(self.file_base + SNAPSHOT_EXTENSION, self.fieldnames, dict_fields=self.dict_fields)
+            corp_writer = None
+            if EXPORT_CSV:
+                corp_file = open(tmp_csv_file_name, mode='w')
+                corp_writer = csv.DictWriter(corp_file, fieldnames=self.fieldnames, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+                corp_writer.writeheader()
+            while True:
+                rows = self.queue.get()
+                if rows is None or rows is EXPORT_ABORT:
+                    break
+                snapshot_writer.writerows(rows)
+                if corp_writer:
+                    corp_writer.writerows(rows)
+            if rows is None:
+                # (the csv is swapped in first, so the snapshot isn't older than the csv and is the one read back)
+                if corp_file is not None:
+                    corp_file.close()
+                    corp_file = None
+                    os.replace(tmp_csv_file_name, csv_file_name)
+                snapshot_writer.close()
+        except (Exception) as error:
+            print("Error writing", self.file_base, error)
+            self.error = error
+            # keep draining so the extract isn't blocked
+            rows = self.queue.get()
+            while rows is not None and rows is not EXPORT_ABORT:
+                rows = self.queue.get()
+        finally:
+            if corp_file is not None:
+                # (the extract or the export failed, the snapshot rows are just dropped)
+                corp_file.close()
+                os.remove(tmp_csv_file_name)
+
+    def writerow(self, row):
+        self.batch.append(row)
+        if EXPORT_BATCH_SIZE <= len(self.batch):
+            self.queue.put(self.batch)
+            self.batch = []
+
+    def close(self):
+        if 0 < len(self.batch):
+            self.queue.put(self.batch)
+            self.batch = []
+        self.queue.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+    def abort(self):
+        """
+        Discards the export, leaving the previous export (if any) as it was.
+        """
+        self.batch = []
+        self.queue.put(EXPORT_ABORT)
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # (if the extract failed the exception is re-raised)
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def read_export_rows(file_base):
+    """
+    Reads the rows of an exported extract, from the binary snapshot if there is one
+    (and it isn't older than the csv export), otherwise from the csv file.
+    """
+    snapshot_file = file_base + SNAPSHOT_EXTENSION
+    csv_file = file_base + '.csv'
+    if os.path.exists(snapshot_file) and (
+        (not os.path.exists(csv_file)) or os.path.getmtime(csv_file) <= os.path.getmtime(snapshot_file)
+    ):
+        for row in read_snapshot_rows(snapshot_file):
+            yield row
+    else:
+        with open(csv_file, mode='r') as corp_file:
+            corp_reader = csv.DictReader(corp_file)
+            for row in corp_reader:
+                yield row
+
+
+def read_export_records(file_base, record_class):
+    """
+    Reads an exported extract as records (e.g. BcRegCorp) rather than dicts.
+    Records are built straight from the snapshot columns, without an intermediate dict per row.
+    """
+    snapshot_file = file_base + SNAPSHOT_EXTENSION
+    csv_file = file_base + '.csv'
+    if os.path.exists(snapshot_file) and (
+        (not os.path.exists(csv_file)) or os.path.getmtime(csv_file) <= os.path.getmtime(snapshot_file)
+    ):
+        (fieldnames, row_count, columns) = read_snapshot_columns(snapshot_file)
+        # registration_utc is missing from older exports (it is re-computed)
+        for values in zip(*[columns[field] if field in columns else itertools.repeat(None) for field in record_class.__slots__]):
+            yield record_class(*values)
+    else:
+        for row in read_export_rows(file_base):
+            yield record_class.from_row(row)
+
+
+def run_extractions(loaders, max_workers: int = EXTRACT_WORKERS):
+    """
+    Runs a set of independent extracts concurrently (each on its own db connection).
+    Takes a dict of name -> loader function, and returns a dict of name -> loader result.
+    If any extract fails the others are cancelled and the error is raised.
+    """
+    if not max_workers or 0 >= max_workers:
+        max_workers = len(loaders)
+    results = {}
+    timings = {}
+    start_time = time.perf_counter()
+
+    def timed_load(name, loader):
+        load_start = time.perf_counter()
+        try:
+            result = loader()
+        finally:
+            # (the worker threads are re-used, so don't let them hold on to pooled connections)
+            release_connections()
+        timings[name] = time.perf_counter() - load_start
+        print("Extracted", name, "in", "{:.1f}".format(timings[name]), "sec", datetime.datetime.now())
+        return result
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="extract")
+    try:
+        futures = {executor.submit(timed_load, name, loader): name for name, loader in loaders.items()}
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            error = future.exception()
+            if error is not None:
+                print("Extract", name, "failed:", error, datetime.datetime.now())
+                # fail fast - stop waiting on the other extracts
+                for other in futures:
+                    other.cancel()
+                cancel_queries()
+                raise error
+            results[name] = future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    print("Extract timings (sec):", ", ".join(name + "=" + "{:.1f}".format(timings[name]) for name in loaders if name in timings))
+    print("Total extract time:", "{:.1f}".format(time.perf_counter() - start_time), "sec")
+    return results
+
 
 def get_bc_reg_corps(USE_LEAR: bool = False):
     """
@@ -49,9 +266,10 @@ def get_bc_reg_corps(USE_LEAR: bool = False):
         return get_bc_reg_colin_corps()
 
 
-def get_bc_reg_colin_corps():
+def get_bc_reg_colin_corps_sql(sort_by_corp_num: bool = False, shard=None):
     """
-    Reads all corps and corp types from the BC Reg database and writes to a csv file.
+    Returns the two queries used to read corps from the BC Reg database, (names, states).
+    Optionally ordered by the full corp num, and optionally only the corps in one shard (shard_index, shard_count).
     """
 
     # run this query against BC Reg database:
@@ -68,7 +286,7 @@ def get_bc_reg_colin_corps():
         and corp_name_as.end_event_id is null
         and corp_name_as.corp_name_typ_cd in ('AS')
     where corp.corp_num not in (
-        select corp_num from bc_registries.corp_state where state_typ_cd = 'HWT');
+        select corp_num from bc_registries.corp_state where state_typ_cd = 'HWT')
     """
 
     sql2 = """
@@ -87,106 +305,140 @@ def get_bc_reg_colin_corps():
     left join bc_registries.corp_op_state
         on corp_op_state.state_typ_cd = corp_state.state_typ_cd
     where corp.corp_num not in (
-        select corp_num from bc_registries.corp_state where state_typ_cd = 'HWT');
+        select corp_num from bc_registries.corp_state where state_typ_cd = 'HWT')
     """
 
-    bc_reg_corps = {}
-    bc_reg_corp_types = {}
-    bc_reg_corp_names = {}
-    bc_reg_count = 0
-    with open('export/bc_reg_corps.csv', mode='w') as corp_file:
-        fieldnames = ["corp_num", "corp_type", "corp_name", "recognition_dts", "bn_9", "can_jur_typ_cd", "xpro_typ_cd", "othr_juris_desc", "state_typ_cd", "op_state_typ_cd", "corp_class"]
-        corp_writer = csv.DictWriter(corp_file, fieldnames=fieldnames, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        corp_writer.writeheader()
+    if shard:
+        sql1 = sql1 + " and " + corp_shard_sql(COLIN_FULL_CORP_NUM_SQL, *shard)
+        sql2 = sql2 + " and " + corp_shard_sql(COLIN_FULL_CORP_NUM_SQL, *shard)
+    if sort_by_corp_num:
+        sql1 = sql1 + ORDER_BY_CORP_NUM_SQL.format(COLIN_FULL_CORP_NUM_SQL)
+        sql2 = sql2 + ORDER_BY_CORP_NUM_SQL.format(COLIN_FULL_CORP_NUM_SQL)
+
+    return (sql1, sql2)
+
 
+def colin_corp_from_row(bc_reg_rec):
+    """
+    Builds a corp record from a row of the BC Reg names query.
+    """
+    full_corp_num = corp_num_with_prefix(bc_reg_rec['corp_typ_cd'], bc_reg_rec['corp_num'])
+    corp_name = bc_reg_rec['corp_nme_as'] if (bc_reg_rec['corp_nme_as'] and 0 < len(bc_reg_rec['corp_nme_as'])) else bc_reg_rec['corp_nme']
+    recognition_dts = csv_value(bc_reg_rec['recognition_dts'])
+    return BcRegCorp(
+        full_corp_num,
+        bc_reg_rec['corp_typ_cd'],
+        corp_name=csv_value(corp_name),
+        recognition_dts=recognition_dts,
+        bn_9=csv_value(bc_reg_rec['bn_9']),
+        registration_utc=normalize_colin_date(recognition_dts),
+    )
+
+
+def update_colin_corp(bc_reg_corp, bc_reg_rec):
+    """
+    Adds a row of the BC Reg states query to a corp record (creates the record if bc_reg_corp is None).
+    """
+    if bc_reg_corp is None:
+        recognition_dts = csv_value(bc_reg_rec['recognition_dts'])
+        bc_reg_corp = BcRegCorp(
+            corp_num_with_prefix(bc_reg_rec['corp_typ_cd'], bc_reg_rec['corp_num']),
+            bc_reg_rec['corp_typ_cd'],
+            recognition_dts=recognition_dts,
+            bn_9=csv_value(bc_reg_rec['bn_9']),
+            registration_utc=normalize_colin_date(recognition_dts),
+        )
+    bc_reg_corp.can_jur_typ_cd = intern_code(bc_reg_rec['can_jur_typ_cd'])
+    bc_reg_corp.xpro_typ_cd = intern_code(bc_reg_rec['xpro_typ_cd'])
+    bc_reg_corp.othr_juris_desc = csv_value(bc_reg_rec['othr_juris_desc'])
+    bc_reg_corp.state_typ_cd = intern_code(bc_reg_rec['state_typ_cd'])
+    bc_reg_corp.op_state_typ_cd = intern_code(bc_reg_rec['op_state_typ_cd'])
+    bc_reg_corp.corp_class = intern_code(bc_reg_rec['corp_class'])
+    return bc_reg_corp
+
+
+def get_bc_reg_colin_corps():
+    """
+    Reads all corps and corp types from the BC Reg database and writes to a csv file.
+    """
+    (sql1, sql2) = get_bc_reg_colin_corps_sql()
+
+    bc_reg_corps = {}
+    fieldnames = list(BcRegCorp.__slots__)
+    with BackgroundExportWriter('export/bc_reg_corps', fieldnames, dict_fields=BcRegCorp.CODE_FIELDS) as corp_writer:
         print("Get corp stats from BC Registries DB", datetime.datetime.now())
-        start_time = time.perf_counter()
-        processed_count = 0
-        bc_reg_recs = get_db_sql("bc_registries", sql1)
+        bc_reg_recs = get_db_sql_stream("bc_registries", sql1)
         for bc_reg_rec in bc_reg_recs:
             if bc_reg_rec['corp_typ_cd'] in CORP_TYPES_IN_SCOPE:
-                bc_reg_count = bc_reg_count + 1
-                full_corp_num = corp_num_with_prefix(bc_reg_rec['corp_typ_cd'], bc_reg_rec['corp_num'])
-                corp_name = bc_reg_rec['corp_nme_as'] if (bc_reg_rec['corp_nme_as'] and 0 < len(bc_reg_rec['corp_nme_as'])) else bc_reg_rec['corp_nme']
-                bc_reg_corp = {
-                    "corp_num": full_corp_num,
-                    "corp_type": bc_reg_rec['corp_typ_cd'],
-                    "corp_name": corp_name,
-                    "recognition_dts": bc_reg_rec['recognition_dts'],
-                    "bn_9": bc_reg_rec['bn_9'],
-                    "can_jur_typ_cd": "",
-                    "xpro_typ_cd": "",
-                    "othr_juris_desc": "",
-                    "state_typ_cd": "",
-                    "op_state_typ_cd": "",
-                    "corp_class": "",
-                }
-                bc_reg_corps[full_corp_num] = bc_reg_corp
-                bc_reg_corp_types[bc_reg_corp["corp_num"]] = bc_reg_corp["corp_type"]
-                bc_reg_corp_names[bc_reg_corp["corp_num"]] = bc_reg_corp["corp_name"]
-
-        bc_reg_recs_2 = get_db_sql("bc_registries", sql2)
+                bc_reg_corp = colin_corp_from_row(bc_reg_rec)
+                bc_reg_corps[bc_reg_corp.corp_num] = bc_reg_corp
+
+        bc_reg_recs_2 = get_db_sql_stream("bc_registries", sql2)
         for bc_reg_rec in bc_reg_recs_2:
             if bc_reg_rec['corp_typ_cd'] in CORP_TYPES_IN_SCOPE:
                 full_corp_num = corp_num_with_prefix(bc_reg_rec['corp_typ_cd'], bc_reg_rec['corp_num'])
-                if full_corp_num in bc_reg_corps:
-                    bc_reg_corp = bc_reg_corps[full_corp_num]
-                else:
-                    bc_reg_corp = {
-                        "corp_num": full_corp_num,
-                        "corp_type": bc_reg_rec['corp_typ_cd'],
-                        "corp_name": "",
-                        "recognition_dts": bc_reg_rec['recognition_dts'],
-                        "bn_9": bc_reg_rec['bn_9'],
-                    }
-                bc_reg_corp["can_jur_typ_cd"] = bc_reg_rec['can_jur_typ_cd']
-                bc_reg_corp["xpro_typ_cd"] = bc_reg_rec['xpro_typ_cd']
-                bc_reg_corp["othr_juris_desc"] = bc_reg_rec['othr_juris_desc']
-                bc_reg_corp["state_typ_cd"] = bc_reg_rec['state_typ_cd']
-                bc_reg_corp["op_state_typ_cd"] = bc_reg_rec['op_state_typ_cd']
-                bc_reg_corp["corp_class"] = bc_reg_rec['corp_class']
-                bc_reg_corps[full_corp_num] = bc_reg_corp
-
-        for full_corp_num in bc_reg_corps:
-            bc_reg_corp = bc_reg_corps[full_corp_num]
-            corp_writer.writerow(bc_reg_corp)
-
-    return get_bc_reg_corps_csv()
+                bc_reg_corps[full_corp_num] = update_colin_corp(bc_reg_corps.get(full_corp_num), bc_reg_rec)
+
+        for bc_reg_corp in bc_reg_corps.values():
+            corp_writer.writerow(bc_reg_corp.as_row())
+
+    return bc_reg_corps
+
+
+def group_by_corp_num(bc_reg_recs, corp_types_filter):
+    """
+    Groups a stream of (sorted) in-scope BC Reg rows by full corp num, yields (corp_num, rows).
+    """
+    in_scope_recs = (bc_reg_rec for bc_reg_rec in bc_reg_recs if bc_reg_rec['corp_typ_cd'] in corp_types_filter)
+    key = lambda bc_reg_rec: corp_num_with_prefix(bc_reg_rec['corp_typ_cd'], bc_reg_rec['corp_num'])
+    for (corp_num, corp_recs) in itertools.groupby(in_scope_recs, key=key):
+        yield (corp_num, list(corp_recs))
+
+
+def get_bc_reg_colin_corps_sorted(shard=None):
+    """
+    Streams all corps (or the corps in one shard) from the BC Reg database, ordered by corp num.
+    The names and states queries are both streamed in corp num order and merged on the fly,
+    so only one corp is held in memory at a time.
+    """
+    (sql1, sql2) = get_bc_reg_colin_corps_sql(sort_by_corp_num=True, shard=shard)
+
+    print("Stream corp stats from BC Registries DB", datetime.datetime.now())
+    names = group_by_corp_num(get_db_sql_stream("bc_registries", sql1), CORP_TYPES_IN_SCOPE)
+    states = group_by_corp_num(get_db_sql_stream("bc_registries", sql2), CORP_TYPES_IN_SCOPE)
+    name_group = next(names, None)
+    state_group = next(states, None)
+    while name_group is not None or state_group is not None:
+        bc_reg_corp = None
+        if state_group is None or (name_group is not None and name_group[0] <= state_group[0]):
+            for bc_reg_rec in name_group[1]:
+                bc_reg_corp = colin_corp_from_row(bc_reg_rec)
+            corp_num = name_group[0]
+            name_group = next(names, None)
+        else:
+            corp_num = state_group[0]
+        if state_group is not None and state_group[0] == corp_num:
+            for bc_reg_rec in state_group[1]:
+                bc_reg_corp = update_colin_corp(bc_reg_corp, bc_reg_rec)
+            state_group = next(states, None)
+        yield bc_reg_corp
 
 
 def get_bc_reg_corps_csv():
     """
     Check if all the BC Reg corps are in orgbook (with the same corp type)
     """
-    bc_reg_corp_types = {}
-    bc_reg_corp_names = {}
-    bc_reg_corp_infos = {}
-    with open('export/bc_reg_corps.csv', mode='r') as corp_file:
-        corp_reader = csv.DictReader(corp_file)
-        for row in corp_reader:
-            bc_reg_corp_types[row["corp_num"]] = row["corp_type"]
-            bc_reg_corp_names[row["corp_num"]] = row["corp_name"]
-
-            bc_reg_corp_infos[row["corp_num"]] = {
-                "corp_num": row["corp_num"],
-                "corp_type": row["corp_type"],
-                "corp_name": row["corp_name"],
-                "recognition_dts": row["recognition_dts"],
-                "bn_9": row["bn_9"],
-                "can_jur_typ_cd": row["can_jur_typ_cd"],
-                "xpro_typ_cd": row["xpro_typ_cd"],
-                "othr_juris_desc": row["othr_juris_desc"],
-                "state_typ_cd": row["state_typ_cd"],
-                "op_state_typ_cd": row["op_state_typ_cd"],
-                "corp_class": row["corp_class"],
-            }
-
-    return (bc_reg_corp_types, bc_reg_corp_names, bc_reg_corp_infos)
+    bc_reg_corps = {}
+    for bc_reg_corp in read_export_records('export/bc_reg_corps', BcRegCorp):
+        bc_reg_corps[bc_reg_corp.corp_num] = bc_reg_corp
 
+    return bc_reg_corps
 
-def get_bc_reg_lear_corps():
+
+def get_bc_reg_lear_corps_sql(sort_by_corp_num: bool = False, shard=None):
     """
-    Reads all corps and corp types from the BC Reg LEAR database and writes to a csv file.
+    Returns the query used to read corps from the BC Reg LEAR database, optionally ordered by corp num,
+    and optionally only the corps in one shard (shard_index, shard_count).
     """
 
     # run this query against BC Reg LEAR database:
@@ -205,8 +457,9 @@ def get_bc_reg_lear_corps():
                 state as state_typ_cd,
                 '' as corp_class
             from businesses
-            where legal_type in ('SP', 'GP');
+            where legal_type in ('SP', 'GP')
         """
+        corp_num_sql = "identifier"
     else:
         sql1 = """
             select
@@ -224,55 +477,104 @@ def get_bc_reg_lear_corps():
             from businesses bus, businesses_version ver
             where bus.legal_type in ('SP', 'GP')
               and bus.identifier = ver.identifier
-              and ver.end_transaction_id is null;
+              and ver.end_transaction_id is null
+    """
+        corp_num_sql = "ver.identifier"
+
+    if shard:
+        sql1 = sql1 + " and " + corp_shard_sql(corp_num_sql, *shard)
+    if sort_by_corp_num:
+        sql1 = sql1 + ORDER_BY_CORP_NUM_SQL.format(corp_num_sql)
+
+    return sql1
+
+
+def lear_corp_from_row(bc_reg_rec):
+    """
+    Builds a corp record from a row of the BC Reg LEAR query.
+    """
+    full_corp_num = corp_num_with_prefix(bc_reg_rec['corp_typ_cd'], bc_reg_rec['corp_num'])
+    corp_name = bc_reg_rec['corp_nme']
+    bn_9 = ""
+    # take the first 9 digist as the BN9, but only if there are 9 or more digits
+    # (otherwise assume it's just bad data)
+    if bc_reg_rec['bn_9'] and 9 <= len(bc_reg_rec['bn_9']):
+        bn_9 = bc_reg_rec['bn_9'][:9]
+    state_type = 'ACT' if bc_reg_rec['state_typ_cd'] == 'ACTIVE' else 'HIS'
+    recognition_dts = lear_date_to_utc(bc_reg_rec['recognition_dts'])
+    return BcRegCorp(
+        full_corp_num,
+        bc_reg_rec['corp_typ_cd'],
+        corp_name=csv_value(corp_name),
+        recognition_dts=recognition_dts,
+        bn_9=bn_9,
+        can_jur_typ_cd=bc_reg_rec['can_jur_typ_cd'],
+        xpro_typ_cd=bc_reg_rec['xpro_typ_cd'],
+        othr_juris_desc=csv_value(bc_reg_rec['othr_juris_desc']),
+        state_typ_cd=state_type,
+        op_state_typ_cd=state_type,
+        corp_class=bc_reg_rec['corp_class'],
+        registration_utc=normalize_utc_date(recognition_dts),
+    )
+
+
+def get_bc_reg_lear_corps():
     """
+    Reads all corps and corp types from the BC Reg LEAR database and writes to a csv file.
+    """
+    sql1 = get_bc_reg_lear_corps_sql()
 
     bc_reg_corps = {}
-    bc_reg_corp_types = {}
-    bc_reg_corp_names = {}
-    bc_reg_count = 0
-    with open('export/bc_reg_corps.csv', mode='w') as corp_file:
-        fieldnames = ["corp_num", "corp_type", "corp_name", "recognition_dts", "bn_9", "can_jur_typ_cd", "xpro_typ_cd", "othr_juris_desc", "state_typ_cd", "op_state_typ_cd", "corp_class"]
-        corp_writer = csv.DictWriter(corp_file, fieldnames=fieldnames, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        corp_writer.writeheader()
-
+    fieldnames = list(BcRegCorp.__slots__)
+    with BackgroundExportWriter('export/bc_reg_corps', fieldnames, dict_fields=BcRegCorp.CODE_FIELDS) as corp_writer:
         print("Get corp stats from BC Registries LEAR DB", datetime.datetime.now())
-        start_time = time.perf_counter()
-        processed_count = 0
-        bc_reg_recs = get_db_sql("bc_reg_lear", sql1)
+        bc_reg_recs = get_db_sql_stream("bc_reg_lear", sql1)
         for bc_reg_rec in bc_reg_recs:
             if bc_reg_rec['corp_typ_cd'] in LEAR_CORP_TYPES_IN_SCOPE:
-                bc_reg_count = bc_reg_count + 1
-                full_corp_num = corp_num_with_prefix(bc_reg_rec['corp_typ_cd'], bc_reg_rec['corp_num'])
-                corp_name = bc_reg_rec['corp_nme']
-                bn_9 = ""
-                # take the first 9 digist as the BN9, but only if there are 9 or more digits
-                # (otherwise assume it's just bad data)
-                if bc_reg_rec['bn_9'] and 9 <= len(bc_reg_rec['bn_9']):
-                    bn_9 = bc_reg_rec['bn_9'][:9]
-                state_type = 'ACT' if bc_reg_rec['state_typ_cd'] == 'ACTIVE' else 'HIS'
-                bc_reg_corp = {
-                    "corp_num": full_corp_num,
-                    "corp_type": bc_reg_rec['corp_typ_cd'],
-                    "corp_name": corp_name,
-                    "recognition_dts": bc_reg_rec['recognition_dts'].astimezone(pytz.utc).isoformat(),
-                    "bn_9": bn_9,
-                    "can_jur_typ_cd": bc_reg_rec['can_jur_typ_cd'],
-                    "xpro_typ_cd": bc_reg_rec['xpro_typ_cd'],
-                    "othr_juris_desc": bc_reg_rec['othr_juris_desc'],
-                    "state_typ_cd": state_type,
-                    "op_state_typ_cd": state_type,
-                    "corp_class": bc_reg_rec['corp_class'],
-                }
-                bc_reg_corps[full_corp_num] = bc_reg_corp
-                bc_reg_corp_types[bc_reg_corp["corp_num"]] = bc_reg_corp["corp_type"]
-                bc_reg_corp_names[bc_reg_corp["corp_num"]] = bc_reg_corp["corp_name"]
-
-        for full_corp_num in bc_reg_corps:
-            bc_reg_corp = bc_reg_corps[full_corp_num]
-            corp_writer.writerow(bc_reg_corp)
-
-    return get_bc_reg_corps_csv()
+                bc_reg_corp = lear_corp_from_row(bc_reg_rec)
+                bc_reg_corps[bc_reg_corp.corp_num] = bc_reg_corp
+
+        for bc_reg_corp in bc_reg_corps.values():
+            corp_writer.writerow(bc_reg_corp.as_row())
+
+    return bc_reg_corps
+
+
+def get_bc_reg_lear_corps_sorted(shard=None):
+    """
+    Streams all corps (or the corps in one shard) from the BC Reg LEAR database, ordered by corp num.
+    """
+    sql1 = get_bc_reg_lear_corps_sql(sort_by_corp_num=True, shard=shard)
+
+    print("Stream corp stats from BC Registries LEAR DB", datetime.datetime.now())
+    for (corp_num, bc_reg_recs) in group_by_corp_num(get_db_sql_stream("bc_reg_lear", sql1), LEAR_CORP_TYPES_IN_SCOPE):
+        yield lear_corp_from_row(bc_reg_recs[-1])
+
+
+def get_bc_reg_corps_sorted(USE_LEAR: bool = False, shard=None):
+    """
+    Streams all corps (or the corps in one shard) from the BC Reg database (COLIN or LEAR), ordered by corp num.
+    """
+    if USE_LEAR:
+        return get_bc_reg_lear_corps_sorted(shard=shard)
+    else:
+        return get_bc_reg_colin_corps_sorted(shard=shard)
+
+
+def sorted_corps_csv(file_base, record_class, shard=None):
+    """
+    Reads an exported extract of corps (or the corps in one shard), returns them sorted by corp num.
+    Duplicates are dropped (the last one wins, the same as the other csv loaders).
+    """
+    corps = {}
+    for corp in read_export_records(file_base, record_class):
+        if (not shard) or corp_shard(corp.corp_num, shard[1]) == shard[0]:
+            corps[corp.corp_num] = corp
+    return sorted(corps.values(), key=lambda corp: corp.corp_num)
+
+
+def get_bc_reg_corps_sorted_csv(shard=None):
+    return sorted_corps_csv('export/bc_reg_corps', BcRegCorp, shard=shard)
 
 
 def get_bc_reg_lear_all_relations():
@@ -297,30 +599,25 @@ def get_bc_reg_lear_all_relations():
             and r.cessation_date is null;
     """
 
-    bc_reg_owners = {}
-    bc_reg_firms = {}
-    bc_reg_count = 0
-    with open('export/bc_reg_relations.csv', mode='w') as corp_file:
-        fieldnames = ["firm", "owner", "owner_name"]
-        corp_writer = csv.DictWriter(corp_file, fieldnames=fieldnames, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        corp_writer.writeheader()
+    bc_reg_owners = []
+    bc_reg_firms = []
+    fieldnames = ["firm", "owner", "owner_name"]
+    with BackgroundExportWriter('export/bc_reg_relations', fieldnames) as corp_writer:
 
         print("Get corp relations from BC Registries LEAR DB", datetime.datetime.now())
-        start_time = time.perf_counter()
-        processed_count = 0
-        bc_reg_recs = get_db_sql("bc_reg_lear", sql1)
+        bc_reg_recs = get_db_sql_stream("bc_reg_lear", sql1)
         for bc_reg_rec in bc_reg_recs:
             if is_valid_corp_num(bc_reg_rec['owner']) and is_valid_corp_num(bc_reg_rec['firm']):
-                bc_reg_relation = {
+                bc_reg_relation = csv_row({
                     "owner": bc_reg_rec['owner'],
                     "firm": bc_reg_rec['firm'],
                     "owner_name": bc_reg_rec['owner_name'],
-                }
-                bc_reg_owners[bc_reg_rec['owner']] = bc_reg_relation
-                bc_reg_firms[bc_reg_rec['firm']] = bc_reg_relation
+                })
+                bc_reg_owners.append(bc_reg_relation)
+                bc_reg_firms.append(bc_reg_relation)
                 corp_writer.writerow(bc_reg_relation)
 
-    return get_bc_reg_lear_all_relations_csv()
+    return (bc_reg_owners, bc_reg_firms)
 
 
 def get_bc_reg_lear_all_relations_csv():
@@ -329,144 +626,136 @@ def get_bc_reg_lear_all_relations_csv():
     """
     bc_reg_owners = []
     bc_reg_firms = []
-    with open('export/bc_reg_relations.csv', mode='r') as corp_file:
-        corp_reader = csv.DictReader(corp_file)
-        for row in corp_reader:
-            bc_reg_relation = {
-                "owner": row['owner'],
-                "firm": row['firm'],
-                "owner_name": row['owner_name'],
-            }
-            bc_reg_owners.append(bc_reg_relation)
-            bc_reg_firms.append(bc_reg_relation)
+    for row in read_export_rows('export/bc_reg_relations'):
+        bc_reg_relation = {
+            "owner": row['owner'],
+            "firm": row['firm'],
+            "owner_name": row['owner_name'],
+        }
+        bc_reg_owners.append(bc_reg_relation)
+        bc_reg_firms.append(bc_reg_relation)
 
     return (bc_reg_owners, bc_reg_firms)
 
 
-def get_orgbook_all_corps(USE_LEAR: bool = False):
+def get_orgbook_all_corps_sql(sort_by_corp_num: bool = False, shard=None):
     """
-    Reads all companies from the orgbook database
+    Returns the query used to read all companies from the orgbook database, optionally ordered by corp num,
+    and optionally only the companies in one shard (shard_index, shard_count).
     """
-    conn = None
+    sql4_a = "select id from credential_type where description = 'registration.registries.ca'"
+
+    sql4_b = "select id from credential_type where description = 'business_number.registries.ca'"
+
+    corp_typ_id = None
+    bus_num_id = None
     try:
-        conn = get_connection('org_book')
+        for row in get_db_sql("org_book", sql4_a):
+            corp_typ_id = row['id']
+        for row in get_db_sql("org_book", sql4_b):
+            bus_num_id = row['id']
     except (Exception) as error:
         print(error)
         raise
 
-    if USE_LEAR:
-        corp_types_filter = LEAR_CORP_TYPES_IN_SCOPE
-    else:
-        corp_types_filter = CORP_TYPES_IN_SCOPE
-
-    # get all the corps from orgbook
-    print("Get corp stats from OrgBook DB", datetime.datetime.now())
-    orgbook_corp_types = {}
-    orgbook_corp_names = {}
-    orgbook_corp_infos = {}
-    with open('export/orgbook_search_corps.csv', mode='w') as corp_file:
-        fieldnames = ["corp_num", "corp_type", "registration_date", "corp_name", "home_jurisdiction", "entity_status", "bus_num"]
-        corp_writer = csv.DictWriter(corp_file, fieldnames=fieldnames, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        corp_writer.writeheader()
+    sql4 = """
+    select topic.source_id, attribute.value entity_type, attr_reg_dt.value registration_date,
+        name.text entity_name, name_as.text entity_name_assumed,
+        attr_juris.value home_jurisdiction, attr_status.value entity_status,
+        attr_bus_num.value bus_num
+        from topic
+    left join credential as cred_corp_typ on cred_corp_typ.topic_id = topic.id and cred_corp_typ.latest = true and cred_corp_typ.credential_type_id = """ + str(corp_typ_id) + """
+    left join attribute on attribute.credential_id = cred_corp_typ.id and attribute.type = 'entity_type'
+    left join attribute attr_reg_dt on attr_reg_dt.credential_id = cred_corp_typ.id and attr_reg_dt.type = 'registration_date'
+    left join attribute attr_juris on attr_juris.credential_id = cred_corp_typ.id and attr_juris.type = 'home_jurisdiction'
+    left join attribute attr_status on attr_status.credential_id = cred_corp_typ.id and attr_status.type = 'entity_status'
+    left join name on name.credential_id = cred_corp_typ.id and name.type = 'entity_name'
+    left join name name_as on name_as.credential_id = cred_corp_typ.id and name_as.type = 'entity_name_assumed'
+    left join credential as cred_bus_num on cred_bus_num.topic_id = topic.id and cred_bus_num.latest = true and cred_bus_num.credential_type_id = """ + str(bus_num_id) + """
+    left join attribute as attr_bus_num on attr_bus_num.credential_id = cred_bus_num.id and attr_bus_num.type = 'business_number'
+    """
+    if shard:
+        sql4 = sql4 + " where " + corp_shard_sql("topic.source_id", *shard)
+    if sort_by_corp_num:
+        sql4 = sql4 + ORDER_BY_CORP_NUM_SQL.format("topic.source_id")
+
+    return sql4
+
+
+def orgbook_corp_from_row(row):
+    """
+    Builds a corp record from a (tuple) row of the orgbook corps query.
+    """
+    # row[1] is the corp_type
+    # if row[1] in corp_types_filter:
+    # load all orgs and check the filter when running the audit report
+    corp_name = row[4] if (row[4] and 0 < len(row[4])) else row[3]
+    return OrgBookCorp(
+        csv_value(row[0]),
+        row[1],
+        registration_date=csv_value(row[2]),
+        corp_name=csv_value(corp_name),
+        home_jurisdiction=row[5],
+        entity_status=row[6],
+        bus_num=csv_value(row[7]),
+    )
 
-        sql4_a = "select id from credential_type where description = 'registration.registries.ca'"
 
-        sql4_b = "select id from credential_type where description = 'business_number.registries.ca'"
+def get_orgbook_all_corps(USE_LEAR: bool = False):
+    """
+    Reads all companies from the orgbook database
+    """
 
-        corp_typ_id = None
-        bus_num_id = None
+    # get all the corps from orgbook
+    print("Get corp stats from OrgBook DB", datetime.datetime.now())
+    orgbook_corps = {}
+    fieldnames = list(OrgBookCorp.__slots__)
+    with BackgroundExportWriter('export/orgbook_search_corps', fieldnames, dict_fields=OrgBookCorp.CODE_FIELDS) as corp_writer:
+        sql4 = get_orgbook_all_corps_sql()
         try:
-            cur = conn.cursor()
-            cur.execute(sql4_a)
-            for row in cur:
-                corp_typ_id = row[0]
-            cur.close()
-            cur = conn.cursor()
-            cur.execute(sql4_b)
-            for row in cur:
-                bus_num_id = row[0]
-            cur.close()
+            for row in get_db_sql_stream("org_book", sql4, as_dict=False):
+                orgbook_corp = orgbook_corp_from_row(row)
+                corp_writer.writerow(orgbook_corp.as_row())
+                orgbook_corps[orgbook_corp.corp_num] = orgbook_corp
         except (Exception) as error:
             print(error)
             raise
 
-        sql4 = """
-        select topic.source_id, attribute.value entity_type, attr_reg_dt.value registration_date,
-            name.text entity_name, name_as.text entity_name_assumed,
-            attr_juris.value home_jurisdiction, attr_status.value entity_status,
-            attr_bus_num.value bus_num
-            from topic
-        left join credential as cred_corp_typ on cred_corp_typ.topic_id = topic.id and cred_corp_typ.latest = true and cred_corp_typ.credential_type_id = """ + str(corp_typ_id) + """
-        left join attribute on attribute.credential_id = cred_corp_typ.id and attribute.type = 'entity_type'
-        left join attribute attr_reg_dt on attr_reg_dt.credential_id = cred_corp_typ.id and attr_reg_dt.type = 'registration_date'
-        left join attribute attr_juris on attr_juris.credential_id = cred_corp_typ.id and attr_juris.type = 'home_jurisdiction'
-        left join attribute attr_status on attr_status.credential_id = cred_corp_typ.id and attr_status.type = 'entity_status'
-        left join name on name.credential_id = cred_corp_typ.id and name.type = 'entity_name'
-        left join name name_as on name_as.credential_id = cred_corp_typ.id and name_as.type = 'entity_name_assumed'
-        left join credential as cred_bus_num on cred_bus_num.topic_id = topic.id and cred_bus_num.latest = true and cred_bus_num.credential_type_id = """ + str(bus_num_id) + """
-        left join attribute as attr_bus_num on attr_bus_num.credential_id = cred_bus_num.id and attr_bus_num.type = 'business_number'
-        """
-        try:
-            cur = conn.cursor()
-            cur.execute(sql4)
-            for row in cur:
-                # row[1] is the corp_type
-                # if row[1] in corp_types_filter:
-                # load all orgs and check the filter when running the audit report
-                orgbook_corp_types[row[0]] = row[1]
-                corp_name = row[4] if (row[4] and 0 < len(row[4])) else row[3]
-                orgbook_corp_names[row[0]] = corp_name
-                write_corp = {
-                    "corp_num": row[0],
-                    "corp_type": row[1],
-                    "registration_date": row[2],
-                    "corp_name":corp_name,
-                    "home_jurisdiction": row[5],
-                    "entity_status": row[6],
-                    "bus_num": row[7],
-                }
-                corp_writer.writerow(write_corp)
-                orgbook_corp_infos[row[0]] = write_corp
-            cur.close()
-        except (Exception) as error:
-            print(error)
-            raise
+    return orgbook_corps
+
 
-    return get_orgbook_all_corps_csv()
+def get_orgbook_all_corps_sorted(shard=None):
+    """
+    Streams all companies (or the companies in one shard) from the orgbook database, ordered by corp num.
+    """
+    print("Stream corp stats from OrgBook DB", datetime.datetime.now())
+    sql4 = get_orgbook_all_corps_sql(sort_by_corp_num=True, shard=shard)
+    for row in get_db_sql_stream("org_book", sql4, as_dict=False):
+        yield orgbook_corp_from_row(row)
 
 
 def get_orgbook_all_corps_csv():
-    orgbook_corp_types = {}
-    orgbook_corp_names = {}
-    orgbook_corp_infos = {}
-    with open('export/orgbook_search_corps.csv', mode='r') as corp_file:
-        corp_reader = csv.DictReader(corp_file)
-        for row in corp_reader:
-            orgbook_corp_types[row["corp_num"]] = row["corp_type"]
-            orgbook_corp_names[row["corp_num"]] = row["corp_name"]
-            orgbook_corp_infos[row["corp_num"]] = row
+    orgbook_corps = {}
+    for orgbook_corp in read_export_records('export/orgbook_search_corps', OrgBookCorp):
+        orgbook_corps[orgbook_corp.corp_num] = orgbook_corp
 
-    return (orgbook_corp_types, orgbook_corp_names, orgbook_corp_infos)
+    return orgbook_corps
+
+
+def get_orgbook_all_corps_sorted_csv(shard=None):
+    return sorted_corps_csv('export/orgbook_search_corps', OrgBookCorp, shard=shard)
 
 
 def get_orgbook_active_relations(USE_LEAR: bool = False):
     """
     Checks orgbook for all active relationships.
     """
-    conn = None
-    try:
-        conn = get_connection('org_book')
-    except (Exception) as error:
-        print(error)
-        raise
 
     # get all the mis-matched relationships from orgbook
     print("Get all corp relationships from OrgBook DB", datetime.datetime.now())
-    orgbook_corp_infos = {}
-    with open('export/orgbook_corp_active_relations.csv', mode='w') as corp_file:
-        fieldnames = ["rel_id", "credential_id", "source_id_1", "source_id_2", "cred_id", "effective_date", "revoked"]
-        corp_writer = csv.DictWriter(corp_file, fieldnames=fieldnames, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        corp_writer.writeheader()
+    orgbook_corp_relations = []
+    fieldnames = ["rel_id", "credential_id", "source_id_1", "source_id_2", "cred_id", "effective_date", "revoked"]
+    with BackgroundExportWriter('export/orgbook_corp_active_relations', fieldnames, dict_fields=["revoked"]) as corp_writer:
 
         if not USE_LEAR:
             sql = """
@@ -486,10 +775,8 @@ def get_orgbook_active_relations(USE_LEAR: bool = False):
             """
 
             try:
-                cur = conn.cursor()
-                cur.execute(sql)
-                for row in cur:
-                    write_corp = {
+                for row in get_db_sql_stream("org_book", sql, as_dict=False):
+                    write_corp = csv_row({
                         "rel_id": row[0],
                         "credential_id": row[1],
                         "source_id_1": row[2],
@@ -497,22 +784,20 @@ def get_orgbook_active_relations(USE_LEAR: bool = False):
                         "cred_id": row[4],
                         "effective_date": row[5],
                         "revoked": row[6],
-                    }
+                    })
                     corp_writer.writerow(write_corp)
-                cur.close()
+                    orgbook_corp_relations.append(write_corp)
             except (Exception) as error:
                 print(error)
                 raise
 
-    return get_orgbook_active_relations_csv()
+    return orgbook_corp_relations
 
 
 def get_orgbook_active_relations_csv():
     orgbook_corp_relations = []
-    with open('export/orgbook_corp_active_relations.csv', mode='r') as corp_file:
-        corp_reader = csv.DictReader(corp_file)
-        for row in corp_reader:
-            orgbook_corp_relations.append(row)
+    for row in read_export_rows('export/orgbook_corp_active_relations'):
+        orgbook_corp_relations.append(row)
 
     return orgbook_corp_relations
 
@@ -521,20 +806,12 @@ def get_orgbook_missing_relations(USE_LEAR: bool = False):
     """
     Checks orgbook for missing/mis-matched relationships.
     """
-    conn = None
-    try:
-        conn = get_connection('org_book')
-    except (Exception) as error:
-        print(error)
-        raise
 
     # get all the mis-matched relationships from orgbook
     print("Get mis-matched corp relationships from OrgBook DB", datetime.datetime.now())
-    orgbook_corp_infos = {}
-    with open('export/orgbook_corp_missing_relations.csv', mode='w') as corp_file:
-        fieldnames = ["tr1_topic_id", "tr1_related_topic_id", "id_1", "s_1", "id_2", "s_2"]
-        corp_writer = csv.DictWriter(corp_file, fieldnames=fieldnames, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        corp_writer.writeheader()
+    orgbook_corp_relations = []
+    fieldnames = ["tr1_topic_id", "tr1_related_topic_id", "id_1", "s_1", "id_2", "s_2"]
+    with BackgroundExportWriter('export/orgbook_corp_missing_relations', fieldnames) as corp_writer:
 
         if not USE_LEAR:
             sql = """
@@ -565,32 +842,28 @@ def get_orgbook_missing_relations(USE_LEAR: bool = False):
             """
 
             try:
-                cur = conn.cursor()
-                cur.execute(sql)
-                for row in cur:
-                    write_corp = {
+                for row in get_db_sql_stream("org_book", sql, as_dict=False):
+                    write_corp = csv_row({
                         "tr1_topic_id": row[0],
                         "tr1_related_topic_id": row[1],
                         "id_1": row[2],
                         "s_1":row[3],
                         "id_2": row[4],
                         "s_2": row[5],
-                    }
+                    })
                     corp_writer.writerow(write_corp)
-                cur.close()
+                    orgbook_corp_relations.append(write_corp)
             except (Exception) as error:
                 print(error)
                 raise
 
-    return get_orgbook_missing_relations_csv()
+    return orgbook_corp_relations
 
 
 def get_orgbook_missing_relations_csv():
     orgbook_corp_relations = []
-    with open('export/orgbook_corp_missing_relations.csv', mode='r') as corp_file:
-        corp_reader = csv.DictReader(corp_file)
-        for row in corp_reader:
-            orgbook_corp_relations.append(row)
+    for row in read_export_rows('export/orgbook_corp_missing_relations'):
+        orgbook_corp_relations.append(row)
 
     return orgbook_corp_relations
 
@@ -613,23 +886,17 @@ def get_event_proc_future_db_corps(system_type_cd):
     Reads from the event processor database and writes to a csv file:
     - corps queued for future processing (we don't check if these are in orgbook or not)
     """
-    corps = []
     future_corps = {}
     sql1 = """SELECT corp_num FROM event_by_corp_filing WHERE process_date is null and SYSTEM_TYPE_CD = '""" + system_type_cd + """';"""
-    corp_recs = get_db_sql("event_processor", sql1)
-    if 0 < len(corp_recs):
-        for corp_rec in corp_recs:
-            corps.append({'corp_num': corp_rec['corp_num']})
-
-    with open('export/event_future_corps.csv', mode='w') as corp_file:
-        fieldnames = ["corp_num"]
-        corp_writer = csv.DictWriter(corp_file, fieldnames=fieldnames, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        corp_writer.writeheader()
-        for corp in corps:
+
+    fieldnames = ["corp_num"]
+    with BackgroundExportWriter('export/event_future_corps', fieldnames) as corp_writer:
+        for corp_rec in get_db_sql_stream("event_processor", sql1):
+            corp = csv_row({'corp_num': corp_rec['corp_num']})
             corp_writer.writerow(corp)
             future_corps[corp["corp_num"]] = corp["corp_num"]
 
-    return get_event_proc_future_corps_csv()
+    return future_corps
 
 
 def get_event_proc_future_corps_csv():
@@ -637,10 +904,8 @@ def get_event_proc_future_corps_csv():
     Corps that are still in the event processor queue waiting to be processed (won't be in orgbook yet)
     """
     future_corps = {}
-    with open('export/event_future_corps.csv', mode='r') as corp_file:
-        corp_reader = csv.DictReader(corp_file)
-        for row in corp_reader:
-            future_corps[row["corp_num"]] = row["corp_num"]
+    for row in read_export_rows('export/event_future_corps'):
+        future_corps[row["corp_num"]] = row["corp_num"]
 
     return future_corps
 
@@ -652,40 +917,21 @@ def get_event_proc_audit_corps(USE_LEAR: bool = False):
     """
     audit_corps = []
     sql3 = """SELECT corp_num, corp_type FROM CORP_AUDIT_LOG;"""
-    corp_audit_recs = get_db_sql("event_processor", sql3)
-    if 0 < len(corp_audit_recs):
-        for corp_rec in corp_audit_recs:
-            audit_corps.append({'corp_num': corp_rec['corp_num'], 'corp_type': corp_rec['corp_type']})
-
-    with open('export/event_audit_corps.csv', mode='w') as corp_file:
-        fieldnames = ["corp_num", "corp_type"]
-        corp_writer = csv.DictWriter(corp_file, fieldnames=fieldnames, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        corp_writer.writeheader()
-        for corp in audit_corps:
+
+    fieldnames = ["corp_num", "corp_type"]
+    with BackgroundExportWriter('export/event_audit_corps', fieldnames, dict_fields=["corp_type"]) as corp_writer:
+        for corp_rec in get_db_sql_stream("event_processor", sql3):
+            corp = csv_row({'corp_num': corp_rec['corp_num'], 'corp_type': corp_rec['corp_type']})
+            audit_corps.append(corp)
             corp_writer.writerow(corp)
 
     return audit_corps
 
 
-def get_agent_wallet_ids():
-    """
-    Reads from the exported list of wallet id's
-    """
-    agent_wallet_ids = {}
-    with open('export/export-wallet-cred-ids.txt', mode='r') as corp_file:
-        corp_reader = csv.DictReader(corp_file)
-        for row in corp_reader:
-            agent_wallet_ids[row["wallet_id"]] = row["wallet_id"]
-
-    return agent_wallet_ids
-
-
-def append_agent_wallet_ids(agent_ids):
+def get_agent_wallet_ids(shard=None):
     """
-    Appends agent credential ids to our local cache
+    Opens the local cache of wallet id's (see wallet_id_cache.py), or the cache for one shard of a sharded audit
     """
-    with open('export/export-wallet-cred-ids.txt', mode='a') as corp_file:
-        fieldnames = ["type", "wallet_id"]
-        corp_writer = csv.DictWriter(corp_file, fieldnames=fieldnames, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        for agent_id in agent_ids:
-            corp_writer.writerow({"type": "Indy::Credential", "wallet_id": agent_id["credential_id"]})
+    if shard:
+        return open_shard_cache(shard)
+    return WalletIdCache()
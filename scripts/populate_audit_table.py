@@ -1,10 +1,18 @@
 #!/usr/bin/python
 import os 
 import psycopg2
+import argparse
+import concurrent.futures
+import contextlib
+import csv
 import datetime
+import io
 import json
 import decimal
-from config import get_connection, get_db_sql, get_sql_record_count, CORP_TYPES_IN_SCOPE, corp_num_with_prefix, bare_corp_num
+import glob
+import multiprocessing
+import time
+from config import db_connection, get_db_sql, release_connections, get_db_sql_batches, get_sql_record_count, get_scoped_corp_count, corp_types_sql, CORP_TYPES_IN_SCOPE, corp_num_with_prefix, bare_corp_num, corp_shard_sql
 from rocketchat_hooks import log_error, log_warning, log_info
 
 
@@ -56,222 +64,616 @@ Once this completes, re-run this script:
     ./run-step.sh bcreg/populate_audit_table.py
 
 Re-run the 'select count(*) ...' query again and the numbers should now balance.
+
+The corp_history_log records are read a page (QUERY_LIMIT records) at a time, each page is loaded into a temp
+table with COPY and applied to CORP_AUDIT_LOG with one set-based update and insert (the latest history record
+for each corp wins), so each page takes a handful of statements and a single commit.  The REG credentials are
+then streamed from credential_log a page at a time, and applied to CORP_AUDIT_LOG the same way.
+
+For the initial backfill (e.g. after an event processor rebuild) the corps can be split into shards by a stable
+hash of the corp num (see corp_shard_sql() in config.py), each populated by its own worker process and database
+connections - the shards never touch the same CORP_AUDIT_LOG rows.  The counts are checked once all the shards
+are done:
+
+    python populate_audit_table.py --workers 8
+
+Or each shard can be run separately (e.g. as job pods), and the counts checked once they're all done:
+
+    python populate_audit_table.py --shard-count 8 --shard-index 0
+    ...
+    python populate_audit_table.py --check
+
+The progress of the run (the phase, the record id reached, the rate and an ETA) is saved after every page to
+export/populate_audit_state.json (or a file per shard).  To see how a run is going, or to carry on from where an
+interrupted run got to (rather than re-scanning CORP_AUDIT_LOG for the watermarks):
+
+    python populate_audit_table.py --status
+    python populate_audit_table.py --resume [--workers 8]
 """
 
 QUERY_LIMIT = '200000'
-REPORT_COUNT = 10000
 ERROR_THRESHOLD_COUNT = 5
 
-# run this query against BC Reg database:
-sql1 = """
-select corp.corp_num, corp.corp_typ_cd
-from bc_registries.corporation corp
-where corp.corp_num not in (
-    select corp_num from bc_registries.corp_state where state_typ_cd = 'HWT');
-"""
+# progress of the current run, saved after every page
+POPULATE_AUDIT_STATE_FILE = 'export/populate_audit_state.json'
+POPULATE_AUDIT_SHARD_STATE_FILE = 'export/populate_audit_state_{}_of_{}.json'
+
+# phases of a run, in order
+POPULATE_PHASES = ["corp_history", "credentials", "missing_credentials", "complete"]
+
+
+def run_state_file_name(shard=None):
+    if shard:
+        return POPULATE_AUDIT_SHARD_STATE_FILE.format(shard[0], shard[1])
+    return POPULATE_AUDIT_STATE_FILE
+
+
+def new_run_state(shard=None):
+    return {
+        "shard": list(shard) if shard else None,
+        "started": datetime.datetime.now().isoformat(),
+        "updated": None,
+        "phase": POPULATE_PHASES[0],
+        # (ACT, HIS) credential watermarks the credentials phase started from
+        "credential_watermarks": None,
+        # record id reached in the current phase, and the last record id when the phase started
+        "watermark": None,
+        "end_record_id": None,
+        # record id the current phase started from, and the seconds spent in it (by this and any interrupted runs)
+        "phase_started": None,
+        "phase_start_watermark": None,
+        "phase_elapsed": 0.0,
+        # when this run started (or resumed) the phase, and the phase's elapsed seconds at that point
+        "resumed": None,
+        "resumed_elapsed": 0.0,
+        "rows": 0,
+        "applied": 0,
+        "rows_per_sec": 0.0,
+        "eta": None,
+    }
+
+
+def read_run_state(shard=None):
+    """
+    Reads the progress saved by an interrupted run (or shard of a run),
+    returns None if there isn't one (or the run completed).
+    """
+    file_name = run_state_file_name(shard)
+    if not os.path.exists(file_name):
+        print("No run state to resume from, starting a new run")
+        return None
+    with open(file_name, mode='r') as state_file:
+        run_state = json.load(state_file)
+    if run_state["phase"] == "complete":
+        print("Last run completed, starting a new run")
+        return None
+    print("Resuming run started", run_state["started"], ", phase:", run_state["phase"], ", record id:", run_state["watermark"])
+    return run_state
+
+
+def write_run_state(run_state):
+    # written to a temp file and renamed, so an interrupted write can't corrupt the previous version
+    run_state["updated"] = datetime.datetime.now().isoformat()
+    file_name = run_state_file_name(run_state["shard"])
+    tmp_file_name = file_name + ".tmp"
+    with open(tmp_file_name, mode='w') as state_file:
+        json.dump(run_state, state_file, indent=2)
+    os.replace(tmp_file_name, file_name)
+
+
+def resume_watermark(run_state, phase):
+    """
+    The record id an interrupted run got to in this phase, or None if it didn't get to the phase.
+    """
+    if run_state["phase"] == phase:
+        return run_state["watermark"]
+    return None
 
-print("Get corp stats from BC Registries DB", datetime.datetime.now())
-bc_reg_count = 0
-bc_reg_recs = get_db_sql("bc_registries", sql1)
-for bc_reg_rec in bc_reg_recs:
-    if bc_reg_rec['corp_typ_cd'] in CORP_TYPES_IN_SCOPE:
-        bc_reg_count = bc_reg_count + 1
-
-
-# run this query against Event Processor database:
-sql1a = "select COALESCE(MAX(LAST_CORP_HISTORY_ID), 0) from CORP_AUDIT_LOG"
-sql2 = """
-SELECT record_id, system_type_cd, corp_num, corp_state, corp_json->>'corp_typ_cd' as corp_typ_cd, last_event->>'event_id' as last_event_id, last_event->>'event_date' as last_event_date, entry_date, process_date, process_msg 
-FROM corp_history_log
-WHERE record_id > %s AND process_date is not null
-ORDER BY record_id
-limit """ + QUERY_LIMIT + """;
+
+def start_phase(run_state, phase, watermark, end_record_id):
+    """
+    Starts a phase from the watermark, or carries on with the phase an interrupted run got to
+    (keeping where the phase started and the time spent in it, so the rate and ETA cover the whole phase).
+    """
+    now = datetime.datetime.now().isoformat()
+    if run_state["phase"] != phase or run_state["phase_start_watermark"] is None:
+        run_state["phase"] = phase
+        run_state["watermark"] = watermark
+        run_state["phase_started"] = now
+        run_state["phase_start_watermark"] = watermark
+        run_state["phase_elapsed"] = 0.0
+        run_state["rows"] = 0
+        run_state["applied"] = 0
+        run_state["rows_per_sec"] = 0.0
+        run_state["eta"] = None
+    run_state["end_record_id"] = end_record_id
+    run_state["resumed"] = now
+    run_state["resumed_elapsed"] = run_state["phase_elapsed"]
+    write_run_state(run_state)
+
+
+def update_run_state(run_state, watermark, rows, applied):
+    """
+    Saves the progress after a page has been applied, with the rate so far and the ETA of the phase
+    (estimated from the range of record id's left, so it doesn't need a count of the remaining rows).
+    """
+    now = datetime.datetime.now()
+    # (time the run was stopped isn't counted)
+    elapsed = run_state["resumed_elapsed"] + (now - datetime.datetime.fromisoformat(run_state["resumed"])).total_seconds()
+    run_state["phase_elapsed"] = elapsed
+    run_state["watermark"] = watermark
+    run_state["rows"] = run_state["rows"] + rows
+    run_state["applied"] = run_state["applied"] + applied
+    run_state["rows_per_sec"] = (run_state["rows"] / elapsed) if 0 < elapsed else 0.0
+    done = watermark - run_state["phase_start_watermark"]
+    remaining = max(0, run_state["end_record_id"] - watermark)
+    run_state["eta"] = (now + datetime.timedelta(seconds=elapsed * remaining / done)).isoformat() if 0 < done else None
+    write_run_state(run_state)
+    print(
+        '>>> Processing {} {}.'.format(run_state["applied"], now),
+        "phase:", run_state["phase"], ", record id:", watermark, "of", run_state["end_record_id"],
+        ", {:.1f} rows/sec".format(run_state["rows_per_sec"]), ", ETA:", run_state["eta"],
+    )
+
+
+def print_run_status():
+    """
+    Prints the saved progress of the last (or current) run, and of each shard of a sharded run.
+    """
+    file_names = sorted(glob.glob(POPULATE_AUDIT_SHARD_STATE_FILE.format("*", "*")))
+    if os.path.exists(POPULATE_AUDIT_STATE_FILE):
+        file_names = [POPULATE_AUDIT_STATE_FILE] + file_names
+    if 0 == len(file_names):
+        print("No run state found")
+        return
+    for file_name in file_names:
+        with open(file_name, mode='r') as state_file:
+            run_state = json.load(state_file)
+        print(
+            "Shard {} of {}:".format(*run_state["shard"]) if run_state["shard"] else "Run:",
+            "started", run_state["started"], ", updated", run_state["updated"], ", phase:", run_state["phase"],
+        )
+        if run_state["phase"] != "complete":
+            print(
+                "    record id:", run_state["watermark"], "of", run_state["end_record_id"], "(from", str(run_state["phase_start_watermark"]) + ")",
+                ", rows:", run_state["rows"], ", applied:", run_state["applied"],
+                ", {:.1f} rows/sec".format(run_state["rows_per_sec"]), ", ETA:", run_state["eta"],
+            )
+
+
+def get_bc_reg_corp_count():
+    """
+    Counts the in-scope (non-HWT) corps in BC Reg (counted in the database).
+    """
+    # run this query against BC Reg database:
+    sql1 = """
+    from bc_registries.corporation corp
+    where corp.corp_num not in (
+        select corp_num from bc_registries.corp_state where state_typ_cd = 'HWT')
+    """
+
+    print("Get corp stats from BC Registries DB", datetime.datetime.now())
+    return get_scoped_corp_count("bc_registries", sql1, "corp.corp_typ_cd")
+
+
+def shard_condition(corp_num_sql, shard, with_args: bool = False):
+    """
+    SQL condition (to add to a WHERE clause) selecting the corps in a shard (shard_index, shard_count), or all corps.
+    with_args if the query is run with parameters (the modulo operator is escaped).
+    """
+    if not shard:
+        return ""
+    condition = " AND " + corp_shard_sql(corp_num_sql, *shard)
+    if with_args:
+        condition = condition.replace("%", "%%")
+    return condition
+
+
+# columns of CORP_AUDIT_LOG loaded from each page of corp_history_log
+CORP_HISTORY_STAGE_COLUMNS = ["LAST_CORP_HISTORY_ID", "SYSTEM_TYPE_CD", "LAST_EVENT_DATE", "CORP_NUM", "CORP_STATE", "CORP_TYPE"]
+
+# (like the per-record updates, only the corp's first CORP_AUDIT_LOG record is updated)
+sql_first_corp_audit_record = "CORP_AUDIT_LOG.RECORD_ID = (SELECT MIN(first_rec.RECORD_ID) FROM CORP_AUDIT_LOG first_rec WHERE first_rec.CORP_NUM = stage.CORP_NUM)"
+
+# latest staged history record for each corp
+sql_latest_corp_history = """
+SELECT DISTINCT ON (CORP_NUM) """ + ", ".join(CORP_HISTORY_STAGE_COLUMNS) + """
+FROM CORP_HISTORY_STAGE
+ORDER BY CORP_NUM, LAST_CORP_HISTORY_ID DESC
 """
-continue_loop = True
-i = 0
-while continue_loop:
-    print("Get corp history processed rec id", datetime.datetime.now())
-    event_proc_inbound_recid = get_db_sql("event_processor", sql1a)
-    print("Get corp history from Event Processor DB", datetime.datetime.now())
-    event_proc_inbound_recs = get_db_sql("event_processor", sql2, (event_proc_inbound_recid[0]['coalesce'],))
-    print("... build audit log", datetime.datetime.now())
-    continue_loop = 0 < len(event_proc_inbound_recs)
-    for inbound_rec in event_proc_inbound_recs:
-        if inbound_rec['corp_typ_cd'] in CORP_TYPES_IN_SCOPE and inbound_rec['corp_state'] != 'HWT':
-            i = i + 1
-            if (i % REPORT_COUNT == 0):
-                print('>>> Processing {} {}.'.format(i, datetime.datetime.now()))
-
-            if inbound_rec['process_msg'] and inbound_rec['process_msg'] == 'Withdrawn':
-                # skip
-                pass
-            else:
-                # see if we have a record for this corp yet
-                sql2a = """
-                SELECT RECORD_ID, LAST_CORP_HISTORY_ID, SYSTEM_TYPE_CD, LAST_EVENT_DATE, CORP_NUM, CORP_STATE, CORP_TYPE, ENTRY_DATE
-                FROM CORP_AUDIT_LOG WHERE CORP_NUM = %s;
-                """
-                corp_recs = get_db_sql("event_processor", sql2a, (inbound_rec['corp_num'],))
-                if 0 == len(corp_recs):
-                    # if not, add it
-                    sql2b = """
-                    INSERT INTO CORP_AUDIT_LOG 
-                    (LAST_CORP_HISTORY_ID, SYSTEM_TYPE_CD, LAST_EVENT_DATE, CORP_NUM, CORP_STATE, CORP_TYPE, ENTRY_DATE)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING RECORD_ID;
-                    """
-                    cur = None
-                    try:
-                        conn = get_connection("event_processor")
-                        cur = conn.cursor()
-                        cur.execute(sql2b, (inbound_rec['record_id'], inbound_rec['system_type_cd'], inbound_rec['last_event_date'], inbound_rec['corp_num'], inbound_rec['corp_state'], inbound_rec['corp_typ_cd'], datetime.datetime.now(),))
-                        _record_id = cur.fetchone()[0]
-                        conn.commit()
-                        cur.close()
-                        cur = None
-                    except (Exception, psycopg2.DatabaseError) as error:
-                        print(error)
-                        raise
-                    finally:
-                        if cur is not None:
-                            cur.close()
-                else:
-                    # if yes, see if we need to update it
-                    sql2c = """
-                    UPDATE CORP_AUDIT_LOG
-                    SET LAST_CORP_HISTORY_ID = %s, LAST_EVENT_DATE = %s, CORP_STATE = %s, CORP_TYPE = %s, ENTRY_DATE = %s
-                    WHERE RECORD_ID = %s AND CORP_NUM = %s;
-                    """
-                    cur = None
-                    corp_rec = corp_recs[0]
-                    try:
-                        conn = get_connection("event_processor")
-                        cur = conn.cursor()
-                        cur.execute(sql2c, (inbound_rec['record_id'], inbound_rec['last_event_date'], inbound_rec['corp_state'], inbound_rec['corp_typ_cd'], datetime.datetime.now(), corp_rec['record_id'], corp_rec['corp_num'],))
-                        conn.commit()
-                        cur.close()
-                        cur = None
-                    except (Exception, psycopg2.DatabaseError) as error:
-                        print(error)
-                        raise
-                    finally:
-                        if cur is not None:
-                            cur.close()
-
-# run this query against Event Processor database:
-sql1b = "select COALESCE(MAX(LAST_CREDENTIAL_ID), 0) from CORP_AUDIT_LOG where corp_state = 'ACT'"
-sql1c = "select COALESCE(MAX(LAST_CREDENTIAL_ID), 0) from CORP_AUDIT_LOG where corp_state = 'HIS'"
-sql3s = [
+sql_update_corp_history = """
+UPDATE CORP_AUDIT_LOG
+SET LAST_CORP_HISTORY_ID = stage.LAST_CORP_HISTORY_ID, LAST_EVENT_DATE = stage.LAST_EVENT_DATE, CORP_STATE = stage.CORP_STATE, CORP_TYPE = stage.CORP_TYPE, ENTRY_DATE = %s
+FROM (""" + sql_latest_corp_history + """) stage
+WHERE CORP_AUDIT_LOG.CORP_NUM = stage.CORP_NUM
+  AND """ + sql_first_corp_audit_record + """;
 """
-SELECT record_id, corp_num, credential_json->>'entity_status' as corp_state, credential_json->>'entity_type' as corp_typ_cd, credential_json->>'effective_date' as effective_date, entry_date, process_date 
-FROM credential_log 
-WHERE process_date is not null and credential_type_cd = 'REG'
-  AND ((corp_state = 'ACT' and record_id > %s) OR  (corp_state = 'HIS' and record_id > %s))
-ORDER BY record_id
-limit """ + QUERY_LIMIT + """;
-""",
+sql_insert_corp_history = """
+INSERT INTO CORP_AUDIT_LOG
+(""" + ", ".join(CORP_HISTORY_STAGE_COLUMNS) + """, ENTRY_DATE)
+SELECT """ + ", ".join("stage." + column for column in CORP_HISTORY_STAGE_COLUMNS) + """, %s
+FROM (""" + sql_latest_corp_history + """) stage
+WHERE NOT EXISTS (SELECT 1 FROM CORP_AUDIT_LOG WHERE CORP_AUDIT_LOG.CORP_NUM = stage.CORP_NUM);
 """
-SELECT record_id, corp_num, credential_json->>'entity_status' as corp_state, credential_json->>'entity_type' as corp_typ_cd, credential_json->>'effective_date' as effective_date, entry_date, process_date 
-FROM credential_log 
-WHERE process_date is not null and credential_type_cd = 'REG'
-  AND corp_num in (select corp_num from CORP_AUDIT_LOG where last_credential_id is null)
-ORDER BY record_id
-limit """ + QUERY_LIMIT + """;
-""",
-]
-for sql3 in sql3s:
+
+
+def is_audited_corp_history(inbound_rec):
+    """
+    In-scope corp types only, skipping HWT corps and withdrawn filings.
+    """
+    return (
+        inbound_rec['corp_typ_cd'] in CORP_TYPES_IN_SCOPE
+        and inbound_rec['corp_state'] != 'HWT'
+        and inbound_rec['process_msg'] != 'Withdrawn'
+    )
+
+
+def copy_rows(cur, table_name, column_names, rows):
+    """
+    Bulk loads rows (tuples) into a table with COPY.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    for row in rows:
+        # (nulls are written as \N, so they aren't confused with empty strings)
+        writer.writerow(["\\N" if value is None else value for value in row])
+    buffer.seek(0)
+    cur.copy_expert(
+        "COPY " + table_name + " (" + ", ".join(column_names) + ") FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+        buffer,
+    )
+
+
+@contextlib.contextmanager
+def staged_page(stage_table_name, column_names, rows):
+    """
+    Loads a page of rows into a temp table (with the same column types as CORP_AUDIT_LOG), and yields a cursor
+    to apply it with.  The page is committed (and the temp table dropped) at the end of the "with" block.
+    """
+    cur = None
+    try:
+        with db_connection("event_processor", readonly=False) as conn:
+            try:
+                cur = conn.cursor()
+                cur.execute(
+                    "CREATE TEMP TABLE " + stage_table_name + " ON COMMIT DROP AS SELECT " + ", ".join(column_names)
+                    + " FROM CORP_AUDIT_LOG WITH NO DATA"
+                )
+                copy_rows(cur, stage_table_name, column_names, rows)
+                yield cur
+                conn.commit()
+                cur.close()
+                cur = None
+            finally:
+                if cur is not None and not cur.closed:
+                    cur.close()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        raise
+
+
+def upsert_corp_history_page(inbound_recs):
+    """
+    Applies a page of corp_history_log records to CORP_AUDIT_LOG in a single transaction.
+    Returns the number of (in-scope) records applied.
+    """
+    rows = [
+        (inbound_rec['record_id'], inbound_rec['system_type_cd'], inbound_rec['last_event_date'], inbound_rec['corp_num'], inbound_rec['corp_state'], inbound_rec['corp_typ_cd'])
+        for inbound_rec in inbound_recs
+        if is_audited_corp_history(inbound_rec)
+    ]
+    if 0 == len(rows):
+        return 0
+
+    entry_date = datetime.datetime.now()
+    with staged_page("CORP_HISTORY_STAGE", CORP_HISTORY_STAGE_COLUMNS, rows) as cur:
+        cur.execute(sql_update_corp_history, (entry_date,))
+        cur.execute(sql_insert_corp_history, (entry_date,))
+    return len(rows)
+
+
+def populate_corp_history(run_state, shard=None):
+    """
+    Applies the corp_history_log records (of all corps, or the corps in a shard) added since the last run,
+    or since the record an interrupted run got to.
+    """
+    # run this query against Event Processor database:
+    sql1a = """
+    select COALESCE(MAX(LAST_CORP_HISTORY_ID), 0) from CORP_AUDIT_LOG
+    where LAST_CORP_HISTORY_ID is not null""" + shard_condition("corp_num", shard) + """;
+    """
+    sql1d = "select COALESCE(MAX(record_id), 0) from corp_history_log"
+    sql2 = """
+    SELECT record_id, system_type_cd, corp_num, corp_state, corp_json->>'corp_typ_cd' as corp_typ_cd, last_event->>'event_id' as last_event_id, last_event->>'event_date' as last_event_date, entry_date, process_date, process_msg 
+    FROM corp_history_log
+    WHERE record_id > %s AND process_date is not null""" + shard_condition("corp_num", shard, with_args=True) + """
+    ORDER BY record_id
+    limit """ + QUERY_LIMIT + """;
+    """
+    event_proc_inbound_recid = resume_watermark(run_state, "corp_history")
+    if event_proc_inbound_recid is None:
+        print("Get corp history processed rec id", datetime.datetime.now())
+        event_proc_inbound_recid = get_db_sql("event_processor", sql1a)[0]['coalesce']
+    start_phase(run_state, "corp_history", event_proc_inbound_recid, get_db_sql("event_processor", sql1d)[0]['coalesce'])
     continue_loop = True
-    i = 0
     while continue_loop:
-        print("Get corp REG processed rec ids", datetime.datetime.now())
-        event_proc_outbound_act_recid = get_db_sql("event_processor", sql1b)
-        event_proc_outbound_his_recid = get_db_sql("event_processor", sql1c)
-        print("Get corp REG credentials from Event Processor DB", datetime.datetime.now())
-        event_proc_outbound_recs = get_db_sql("event_processor", sql3, (event_proc_outbound_act_recid[0]['coalesce'], event_proc_outbound_his_recid[0]['coalesce'],))
+        print("Get corp history from Event Processor DB", datetime.datetime.now())
+        event_proc_inbound_recs = get_db_sql("event_processor", sql2, (event_proc_inbound_recid,))
         print("... build audit log", datetime.datetime.now())
-        continue_loop = 0 < len(event_proc_outbound_recs)
-        for outbound_rec in event_proc_outbound_recs:
-            if outbound_rec['corp_typ_cd'] in CORP_TYPES_IN_SCOPE:
-                i = i + 1
-                if (i % REPORT_COUNT == 0):
-                    print('>>> Processing {} {}.'.format(i, datetime.datetime.now()))
-                # see if we have a record for this corp yet
-                sql3a = """
-                SELECT RECORD_ID, LAST_CORP_HISTORY_ID, SYSTEM_TYPE_CD, LAST_EVENT_DATE, CORP_NUM, CORP_STATE, CORP_TYPE, ENTRY_DATE,
-                        LAST_CREDENTIAL_ID, CRED_EFFECTIVE_DATE
-                FROM CORP_AUDIT_LOG WHERE CORP_NUM = %s;
-                """
-                corp_recs = get_db_sql("event_processor", sql3a, (outbound_rec['corp_num'],))
-                if 0 == len(corp_recs):
-                    # if not, it's an error
-                    # ignore for now
-                    print("Error no inbound record found for", outbound_rec['corp_num'])
-                    pass
-                else:
-                    # if yes, see if we need to update it
-                    sql3b = """
-                    UPDATE CORP_AUDIT_LOG
-                    SET LAST_CREDENTIAL_ID = %s, CRED_EFFECTIVE_DATE = %s
-                    WHERE RECORD_ID = %s AND CORP_NUM = %s;
-                    """
-                    cur = None
-                    corp_rec = corp_recs[0]
-                    try:
-                        conn = get_connection("event_processor")
-                        cur = conn.cursor()
-                        cur.execute(sql3b, (outbound_rec['record_id'], outbound_rec['effective_date'], corp_rec['record_id'], corp_rec['corp_num']))
-                        conn.commit()
-                        cur.close()
-                        cur = None
-                    except (Exception, psycopg2.DatabaseError) as error:
-                        print(error)
-                        raise
-                    finally:
-                        if cur is not None:
-                            cur.close()
-
-print("Got all corp audits", datetime.datetime.now())
-
-corp_types = ""
-for corp_type in CORP_TYPES_IN_SCOPE:
-    if 0 < len(corp_types):
-        corp_types = corp_types + ", "
-    corp_types = corp_types + "'" + corp_type + "'"
-
-# now check counts
-evp_corp_history_count = 0
-evp_credential_count = 0
-sql1 = """
-SELECT count(*) FROM CORP_AUDIT_LOG
-WHERE corp_type in (""" + corp_types + """);
+        continue_loop = 0 < len(event_proc_inbound_recs)
+        if continue_loop:
+            applied = upsert_corp_history_page(event_proc_inbound_recs)
+            # (the page is in record_id order, carry on after the last record read even if none of the page was in scope)
+            event_proc_inbound_recid = event_proc_inbound_recs[-1]['record_id']
+            update_run_state(run_state, event_proc_inbound_recid, len(event_proc_inbound_recs), applied)
+
+
+# columns of CORP_AUDIT_LOG loaded from each page of credential_log
+CREDENTIAL_STAGE_COLUMNS = ["LAST_CREDENTIAL_ID", "CORP_NUM", "CRED_EFFECTIVE_DATE"]
+
+# latest staged credential for each corp
+sql_latest_credential = """
+SELECT DISTINCT ON (CORP_NUM) """ + ", ".join(CREDENTIAL_STAGE_COLUMNS) + """
+FROM CREDENTIAL_STAGE
+ORDER BY CORP_NUM, LAST_CREDENTIAL_ID DESC
 """
-sql2 = """
-SELECT count(*) FROM CORP_AUDIT_LOG WHERE last_credential_id is not null
-AND corp_type in (""" + corp_types + """);
+sql_update_credential = """
+UPDATE CORP_AUDIT_LOG
+SET LAST_CREDENTIAL_ID = stage.LAST_CREDENTIAL_ID, CRED_EFFECTIVE_DATE = stage.CRED_EFFECTIVE_DATE
+FROM (""" + sql_latest_credential + """) stage
+WHERE CORP_AUDIT_LOG.CORP_NUM = stage.CORP_NUM
+  AND """ + sql_first_corp_audit_record + """;
 """
-evp_corp_history_count = get_sql_record_count("event_processor", sql1)
-evp_credential_count = get_sql_record_count("event_processor", sql2)
-
-# get future-dated corps that haven't yet been processed
-sql3 = """
-select count(*) from event_by_corp_filing
-where process_success is null and corp_num not in
-(select corp_num from CORP_AUDIT_LOG);
+sql_missing_credential_corps = """
+SELECT DISTINCT CORP_NUM FROM CREDENTIAL_STAGE
+WHERE NOT EXISTS (SELECT 1 FROM CORP_AUDIT_LOG WHERE CORP_AUDIT_LOG.CORP_NUM = CREDENTIAL_STAGE.CORP_NUM)
+ORDER BY CORP_NUM;
 """
-evp_future_corp_process_count = get_sql_record_count("event_processor", sql3)
-evp_bc_reg_match_count = evp_corp_history_count + evp_future_corp_process_count
-
-# check count of BC Reg corps vs event processor corps
-if evp_bc_reg_match_count != bc_reg_count:
-    print("Error missing corps in Event Processor", bc_reg_count, evp_bc_reg_match_count)
-    if ERROR_THRESHOLD_COUNT < abs(evp_bc_reg_match_count - bc_reg_count):
-        log_error("Error missing corps in Event Processor: BCReg={} EvP={}".format(bc_reg_count, evp_bc_reg_match_count))
-    else:
-        log_warning("Warning missing corps in Event Processor: BCReg={} EvP={}".format(bc_reg_count, evp_bc_reg_match_count))
 
-# check counts of event processor input and output
-if evp_credential_count != evp_corp_history_count:
-    print("Error missing credentials in Event Processor", evp_corp_history_count, evp_credential_count)
-    if ERROR_THRESHOLD_COUNT < abs(evp_credential_count - evp_corp_history_count):
-        log_error("Error missing credentials in Event Processor: EvP corps={} EvP creds={}".format(evp_corp_history_count, evp_credential_count))
+
+def update_credential_page(outbound_recs):
+    """
+    Applies a page of credential_log REG credentials to CORP_AUDIT_LOG in a single transaction.
+    Returns the number of (in-scope) credentials applied.
+    """
+    rows = [
+        (outbound_rec['record_id'], outbound_rec['corp_num'], outbound_rec['effective_date'])
+        for outbound_rec in outbound_recs
+        if outbound_rec['corp_typ_cd'] in CORP_TYPES_IN_SCOPE
+    ]
+    if 0 == len(rows):
+        return 0
+
+    with staged_page("CREDENTIAL_STAGE", CREDENTIAL_STAGE_COLUMNS, rows) as cur:
+        cur.execute(sql_update_credential)
+        cur.execute(sql_missing_credential_corps)
+        for (corp_num,) in cur.fetchall():
+            # if there's no inbound record it's an error
+            # ignore for now
+            print("Error no inbound record found for", corp_num)
+    return len(rows)
+
+
+def populate_credentials(run_state, shard=None):
+    """
+    Applies the REG credentials (of all corps, or the corps in a shard) added since the last run,
+    and the credentials of any corps that don't have one yet - or carries on from where an interrupted run got to.
+    """
+    # run this query against Event Processor database:
+    sql1b = "select COALESCE(MAX(LAST_CREDENTIAL_ID), 0) from CORP_AUDIT_LOG where corp_state = 'ACT'" + shard_condition("corp_num", shard)
+    sql1c = "select COALESCE(MAX(LAST_CREDENTIAL_ID), 0) from CORP_AUDIT_LOG where corp_state = 'HIS'" + shard_condition("corp_num", shard)
+    sql1e = "select COALESCE(MAX(record_id), 0) from credential_log"
+    sql3s = [
+    """
+    SELECT record_id, corp_num, credential_json->>'entity_status' as corp_state, credential_json->>'entity_type' as corp_typ_cd, credential_json->>'effective_date' as effective_date, entry_date, process_date 
+    FROM credential_log 
+    WHERE process_date is not null and credential_type_cd = 'REG'
+      AND ((corp_state = 'ACT' and record_id > %s) OR  (corp_state = 'HIS' and record_id > %s))
+      AND record_id > %s""" + shard_condition("corp_num", shard, with_args=True) + """
+    ORDER BY record_id;
+    """,
+    """
+    SELECT record_id, corp_num, credential_json->>'entity_status' as corp_state, credential_json->>'entity_type' as corp_typ_cd, credential_json->>'effective_date' as effective_date, entry_date, process_date 
+    FROM credential_log 
+    WHERE process_date is not null and credential_type_cd = 'REG'
+      AND corp_num in (select corp_num from CORP_AUDIT_LOG where last_credential_id is null)
+      AND record_id > %s""" + shard_condition("corp_num", shard, with_args=True) + """
+    ORDER BY record_id;
+    """,
+    ]
+    # the watermarks are read once (and saved in the run state), the credentials after them are streamed
+    # (in record_id order) a page at a time
+    if run_state["credential_watermarks"] is None:
+        print("Get corp REG processed rec ids", datetime.datetime.now())
+        event_proc_outbound_act_recid = get_db_sql("event_processor", sql1b)[0]['coalesce']
+        event_proc_outbound_his_recid = get_db_sql("event_processor", sql1c)[0]['coalesce']
+        run_state["credential_watermarks"] = [event_proc_outbound_act_recid, event_proc_outbound_his_recid]
+    (event_proc_outbound_act_recid, event_proc_outbound_his_recid) = run_state["credential_watermarks"]
+    end_record_id = get_db_sql("event_processor", sql1e)[0]['coalesce']
+
+    phases = ["credentials", "missing_credentials"]
+    for (phase, sql3) in zip(phases, sql3s):
+        if POPULATE_PHASES.index(phase) < POPULATE_PHASES.index(run_state["phase"]):
+            # (done by the interrupted run)
+            continue
+        event_proc_outbound_recid = resume_watermark(run_state, phase)
+        if event_proc_outbound_recid is None:
+            # (the credentials before both watermarks have already been applied)
+            event_proc_outbound_recid = min(event_proc_outbound_act_recid, event_proc_outbound_his_recid) if phase == "credentials" else 0
+        start_phase(run_state, phase, event_proc_outbound_recid, end_record_id)
+        if phase == "credentials":
+            args = (event_proc_outbound_act_recid, event_proc_outbound_his_recid, event_proc_outbound_recid,)
+        else:
+            args = (event_proc_outbound_recid,)
+        print("Get corp REG credentials from Event Processor DB", datetime.datetime.now())
+        for event_proc_outbound_recs in get_db_sql_batches("event_processor", sql3, args, itersize=int(QUERY_LIMIT)):
+            applied = update_credential_page(event_proc_outbound_recs)
+            update_run_state(run_state, event_proc_outbound_recs[-1]['record_id'], len(event_proc_outbound_recs), applied)
+
+
+def populate_audit(run_state, shard=None):
+    """
+    Runs the phases of a run (that an interrupted run didn't get through).
+    """
+    if run_state["phase"] == "corp_history":
+        populate_corp_history(run_state, shard=shard)
+    populate_credentials(run_state, shard=shard)
+    run_state["phase"] = "complete"
+    write_run_state(run_state)
+
+
+def populate_audit_shard(shard_index, shard_count, resume: bool = False):
+    """
+    Populates CORP_AUDIT_LOG for the corps in one shard.
+    """
+    shard = (shard_index, shard_count)
+    start_time = time.perf_counter()
+    print("Populate shard {} of {}".format(shard_index, shard_count), datetime.datetime.now())
+    run_state = read_run_state(shard) if resume else None
+    try:
+        populate_audit(run_state if run_state else new_run_state(shard), shard=shard)
+    finally:
+        # (the worker process is re-used for other shards)
+        release_connections()
+    print("Populated shard {} of {} in {:.2f} sec".format(shard_index, shard_count, time.perf_counter() - start_time))
+
+
+def run_populate_shards(shard_count, max_workers, resume: bool = False):
+    """
+    Populates all the shards in a pool of worker processes.
+    Workers are started with "spawn" so they open their own database connections.
+    If any shard fails the shards that haven't started yet are cancelled and the exception is re-raised.
+    """
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+    try:
+        futures = {
+            executor.submit(populate_audit_shard, shard_index, shard_count, resume): shard_index
+            for shard_index in range(shard_count)
+        }
+        for future in concurrent.futures.as_completed(futures):
+            error = future.exception()
+            if error is not None:
+                print("Populate of shard {} failed: {}".format(futures[future], error))
+                for other_future in futures:
+                    other_future.cancel()
+                raise error
+    finally:
+        executor.shutdown(wait=True)
+
+
+def check_audit_counts(bc_reg_count):
+    """
+    Checks the CORP_AUDIT_LOG counts against BC Reg, and the corps against the credentials.
+    """
+    corp_types = corp_types_sql()
+
+    # now check counts
+    evp_corp_history_count = 0
+    evp_credential_count = 0
+    sql1 = """
+    SELECT count(*) FROM CORP_AUDIT_LOG
+    WHERE corp_type in (""" + corp_types + """);
+    """
+    sql2 = """
+    SELECT count(*) FROM CORP_AUDIT_LOG WHERE last_credential_id is not null
+    AND corp_type in (""" + corp_types + """);
+    """
+    evp_corp_history_count = get_sql_record_count("event_processor", sql1)
+    evp_credential_count = get_sql_record_count("event_processor", sql2)
+
+    # get future-dated corps that haven't yet been processed
+    sql3 = """
+    select count(*) from event_by_corp_filing
+    where process_success is null and corp_num not in
+    (select corp_num from CORP_AUDIT_LOG);
+    """
+    evp_future_corp_process_count = get_sql_record_count("event_processor", sql3)
+    evp_bc_reg_match_count = evp_corp_history_count + evp_future_corp_process_count
+
+    # check count of BC Reg corps vs event processor corps
+    if evp_bc_reg_match_count != bc_reg_count:
+        print("Error missing corps in Event Processor", bc_reg_count, evp_bc_reg_match_count)
+        if ERROR_THRESHOLD_COUNT < abs(evp_bc_reg_match_count - bc_reg_count):
+            log_error("Error missing corps in Event Processor: BCReg={} EvP={}".format(bc_reg_count, evp_bc_reg_match_count))
+        else:
+            log_warning("Warning missing corps in Event Processor: BCReg={} EvP={}".format(bc_reg_count, evp_bc_reg_match_count))
+
+    # check counts of event processor input and output
+    if evp_credential_count != evp_corp_history_count:
+        print("Error missing credentials in Event Processor", evp_corp_history_count, evp_credential_count)
+        if ERROR_THRESHOLD_COUNT < abs(evp_credential_count - evp_corp_history_count):
+            log_error("Error missing credentials in Event Processor: EvP corps={} EvP creds={}".format(evp_corp_history_count, evp_credential_count))
+        else:
+            log_warning("Warning missing credentials in Event Processor: EvP corps={} EvP creds={}".format(evp_corp_history_count, evp_credential_count))
+
+
+# mainline
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Populates the CORP_AUDIT_LOG table from the event processor corp history and credentials."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        required=False,
+        help="Number of worker processes to populate the shards (default 1).",
+    )
+    parser.add_argument(
+        "--shard-count",
+        type=int,
+        default=None,
+        required=False,
+        help="Number of shards to split the corps into (default is the number of workers).",
+    )
+    parser.add_argument(
+        "--shard-index",
+        type=int,
+        default=None,
+        required=False,
+        help="Only populate this shard (e.g. in a job pod), run --check once all the shards are done.",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        required=False,
+        help="Only check the CORP_AUDIT_LOG counts against BC Registries.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        required=False,
+        help="Carry on from where an interrupted run got to.",
+    )
+    parser.add_argument(
+        "--status",
+        action="store_true",
+        required=False,
+        help="Print the progress of the last (or current) run, and exit.",
+    )
+    args = parser.parse_args()
+    shard_count = args.shard_count if args.shard_count else args.workers
+    if args.shard_index is not None and not 1 < shard_count:
+        parser.error("--shard-index needs a --shard-count")
+
+    if args.status:
+        print_run_status()
+    elif args.shard_index is not None:
+        populate_audit_shard(args.shard_index, shard_count, resume=args.resume)
+    elif args.check:
+        check_audit_counts(get_bc_reg_corp_count())
     else:
-        log_warning("Warning missing credentials in Event Processor: EvP corps={} EvP creds={}".format(evp_corp_history_count, evp_credential_count))
+        bc_reg_count = get_bc_reg_corp_count()
+
+        if 1 < shard_count:
+            run_populate_shards(shard_count, args.workers, resume=args.resume)
+        else:
+            run_state = read_run_state() if args.resume else None
+            populate_audit(run_state if run_state else new_run_state())
+
+        print("Got all corp audits", datetime.datetime.now())
+
+        check_audit_counts(bc_reg_count)
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+import datetime
+import functools
+import pytz
+
+
+"""
+Registration dates, normalized once (when the corps are loaded) to the UTC iso format used by OrgBook,
+so the audit can compare BC Reg and OrgBook dates with a plain equality check.
+
+Missing dates normalize to NULL_DATE, and invalid BC Reg (COLIN) dates to the MIN_START_DATE placeholder.
+Null-like dates (empty, 0001-01-01 or the placeholder) are kept as they are, and matched the same way as the
+original per-corp date checks (see registration_dates_match()).
+"""
+
+MIN_START_DATE = datetime.datetime(datetime.MINYEAR+1, 1, 1)
+MIN_VALID_DATE = datetime.datetime(datetime.MINYEAR+10, 1, 1)
+MAX_END_DATE   = datetime.datetime(datetime.MAXYEAR-1, 12, 31)
+
+# for now, we are in PST time
+timezone = pytz.timezone("PST8PDT")
+
+MIN_START_DATE_TZ = timezone.localize(MIN_START_DATE)
+MIN_VALID_DATE_TZ = timezone.localize(MIN_VALID_DATE)
+MAX_END_DATE_TZ   = timezone.localize(MAX_END_DATE)
+
+MIN_START_DATE_UTC = MIN_START_DATE_TZ.astimezone(pytz.utc).isoformat()
+
+NULL_DATE = ""
+
+# max number of distinct timestamps to remember the conversion of
+DATE_CACHE_SIZE = 100000
+
+
+def normalize_utc_date(reg_dt):
+    """
+    Normalizes an OrgBook or BC Reg LEAR date (a datetime, or already in UTC iso format).
+    """
+    if isinstance(reg_dt, datetime.datetime):
+        return reg_dt.astimezone(pytz.utc).isoformat()
+    if not reg_dt:
+        return NULL_DATE
+    return reg_dt
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def lear_date_to_utc(reg_dt):
+    """
+    Converts a BC Reg LEAR date (a datetime with time zone) to UTC iso format.
+    """
+    if reg_dt is None:
+        return NULL_DATE
+    return reg_dt.astimezone(pytz.utc).isoformat()
+
+
+@functools.lru_cache(maxsize=None)
+def local_day_utc_offset(day):
+    """
+    Returns the UTC offset of a local day ('YYYY-MM-DD'), or None if it changes during the day (DST change).
+    """
+    start_of_day = datetime.datetime.strptime(day, '%Y-%m-%d')
+    end_of_day = start_of_day + datetime.timedelta(hours=23, minutes=59, seconds=59)
+    start_offset = timezone.utcoffset(start_of_day)
+    if start_offset != timezone.utcoffset(end_of_day):
+        return None
+    return start_offset
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def colin_date_to_utc(bc_reg_reg_dt):
+    """
+    Converts a BC Reg (COLIN) local date ('YYYY-MM-DD HH:MM:SS') to UTC iso format, invalid dates convert to MIN_START_DATE.
+    Dates are shifted by the (cached) UTC offset of their day, pytz is only called for days with a DST change.
+    """
+    try:
+        if (
+            len(bc_reg_reg_dt) == 19 and bc_reg_reg_dt[4] == '-' and bc_reg_reg_dt[7] == '-'
+            and bc_reg_reg_dt[10] == ' ' and bc_reg_reg_dt[13] == ':' and bc_reg_reg_dt[16] == ':'
+        ):
+            offset = local_day_utc_offset(bc_reg_reg_dt[:10])
+            if offset is not None:
+                bc_reg_reg_dt_obj = datetime.datetime.fromisoformat(bc_reg_reg_dt)
+                return (bc_reg_reg_dt_obj - offset).isoformat() + '+00:00'
+    except (Exception) as error:
+        pass
+    try:
+        bc_reg_reg_dt_obj = datetime.datetime.strptime(bc_reg_reg_dt, '%Y-%m-%d %H:%M:%S')
+        return timezone.localize(bc_reg_reg_dt_obj).astimezone(pytz.utc).isoformat()
+    except (Exception) as error:
+        return MIN_START_DATE_UTC
+
+
+def normalize_colin_date(bc_reg_reg_dt):
+    """
+    Normalizes a BC Reg (COLIN) local date.
+    """
+    if not bc_reg_reg_dt:
+        return NULL_DATE
+    return colin_date_to_utc(bc_reg_reg_dt)
+
+
+def normalize_bc_reg_date(bc_reg_reg_dt):
+    """
+    Normalizes a BC Reg date that could be from either COLIN (local time) or LEAR (UTC iso format).
+    Only needed for extracts exported before the normalized date was added.
+    """
+    if bc_reg_reg_dt and 'T' in bc_reg_reg_dt:
+        return normalize_utc_date(bc_reg_reg_dt)
+    return normalize_colin_date(bc_reg_reg_dt)
+
+
+# the BC Reg (COLIN) "no date" date, which matches an empty OrgBook date
+COLIN_NULL_DATE_UTC = normalize_colin_date('0001-01-01 00:00:00')
+
+
+def is_null_lear_date(reg_dt):
+    return (not reg_dt) or reg_dt.startswith('0001-01-01')
+
+
+def registration_dates_match(orgbook_reg_dt, bc_reg_reg_dt, USE_LEAR: bool = False):
+    """
+    Compares normalized OrgBook and BC Reg registration dates.
+    Null-like dates match the same way as the original per-corp checks:
+    - LEAR - empty and 0001-01-01 dates match each other, and nothing else
+    - COLIN - an empty BC Reg date matches an empty or MIN_START_DATE OrgBook date, an empty OrgBook date
+      matches a 0001-01-01 00:00:00 BC Reg date, and an invalid BC Reg date matches a MIN_START_DATE OrgBook date
+    """
+    if orgbook_reg_dt == bc_reg_reg_dt:
+        return True
+    if USE_LEAR:
+        return is_null_lear_date(orgbook_reg_dt) and is_null_lear_date(bc_reg_reg_dt)
+    if bc_reg_reg_dt == NULL_DATE:
+        return orgbook_reg_dt == MIN_START_DATE_UTC
+    if orgbook_reg_dt == NULL_DATE:
+        return bc_reg_reg_dt == COLIN_NULL_DATE_UTC
+    return False
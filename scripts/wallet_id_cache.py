@@ -0,0 +1,395 @@
+#!/usr/bin/python
+import os
+import bisect
+import csv
+import hashlib
+import heapq
+import math
+import mmap
+import struct
+
+
+"""
+Local cache of the agent wallet credential id's.
+
+The id's are kept in two files:
+- an index - the id's deduped and sorted, as fixed-width (null padded) records which are memory-mapped and binary searched
+- a delta log - the (csv) export of wallet id's, which new id's are appended to
+
+Opening the cache only reads the delta log, and the delta log is merged into the index (and emptied) once it gets too big,
+so startup time and memory use no longer grow with the number of cached id's.
+
+The shards of a sharded audit share the index and main delta log (read-only), and each appends to its own delta log.
+
+Optionally (WALLET_ID_BLOOM) a Bloom filter of the index id's is kept alongside the index, so most lookups of id's
+that aren't cached (the ones that need to be checked with the agent) don't touch the index at all.  The filter is a
+small fraction of the size of the index, so it stays in memory even when the index doesn't.
+"""
+
+WALLET_ID_INDEX_FILE = 'export/export-wallet-cred-ids.idx'
+WALLET_ID_DELTA_FILE = 'export/export-wallet-cred-ids.txt'
+# each shard of a sharded audit appends to its own delta log, these are merged into the main delta log after the audit
+WALLET_ID_SHARD_DELTA_FILE = 'export/export-wallet-cred-ids_{}_of_{}.txt'
+WALLET_ID_FIELDS = ["type", "wallet_id"]
+
+# merge the delta log into the index once it has more than this many id's
+WALLET_ID_DELTA_MAX = int(os.environ.get('WALLET_ID_DELTA_MAX', '100000'))
+
+# index header - magic, record width, record count, digest of the records
+INDEX_HEADER = struct.Struct('<4sII16s')
+INDEX_MAGIC = b'WID2'
+# (indexes written before the digest was added are still read, and are re-written with one when they are next compacted)
+INDEX_HEADER_V1 = struct.Struct('<4sII')
+INDEX_MAGIC_V1 = b'WIDX'
+
+
+# Bloom filter of the index id's (optional), and its target false positive rate
+WALLET_ID_BLOOM_FILE = 'export/export-wallet-cred-ids.bloom'
+WALLET_ID_BLOOM = (os.environ.get('WALLET_ID_BLOOM', 'false').lower() == 'true')
+WALLET_ID_BLOOM_ERROR_RATE = float(os.environ.get('WALLET_ID_BLOOM_ERROR_RATE', '0.01'))
+
+# Bloom filter header - magic, number of bits, number of hashes, number of id's, fingerprint of the index it was built from
+BLOOM_HEADER = struct.Struct('<4sQIQ16s')
+BLOOM_MAGIC = b'WBLM'
+
+
+# number of index records per block - the first record of each block is kept in memory (the "fence"),
+# a lookup bisects the fence and then searches a single block of the memory-mapped index
+INDEX_BLOCK_SIZE = 128
+
+
+def index_fingerprint(width, count, digest):
+    """
+    A hash of an index (its record width and count, and the digest of its records), to tell if a Bloom filter matches it.
+    """
+    return hashlib.blake2b(struct.pack('<II', width, count) + digest, digest_size=16).digest()
+
+
+class WalletIdIndex:
+    """
+    Read-only view of the sorted, fixed-width id records in an index file.
+    """
+
+    def __init__(self, file_name):
+        self.width = 0
+        self.count = 0
+        self.digest = hashlib.blake2b(digest_size=16).digest()
+        self.header_size = INDEX_HEADER.size
+        self.file = None
+        self.map = None
+        self.fence = []
+        if os.path.exists(file_name) and INDEX_HEADER_V1.size < os.path.getsize(file_name):
+            self.file = open(file_name, mode='rb')
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic = self.map[:len(INDEX_MAGIC)]
+            if magic == INDEX_MAGIC:
+                (magic, self.width, self.count, self.digest) = INDEX_HEADER.unpack_from(self.map, 0)
+            elif magic == INDEX_MAGIC_V1:
+                (magic, self.width, self.count) = INDEX_HEADER_V1.unpack_from(self.map, 0)
+                self.header_size = INDEX_HEADER_V1.size
+                self.digest = None
+            else:
+                raise Exception("Not a wallet id index file: " + file_name)
+            self.fence = [self[i] for i in range(0, self.count, INDEX_BLOCK_SIZE)]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        offset = self.header_size + (i * self.width)
+        return self.map[offset:offset + self.width]
+
+    def __contains__(self, wallet_id):
+        key = wallet_id.encode()
+        if self.count == 0 or self.width < len(key):
+            return False
+        key = key.ljust(self.width, b'\0')
+        block = bisect.bisect_right(self.fence, key) - 1
+        if block < 0:
+            return False
+        start = self.header_size + (block * INDEX_BLOCK_SIZE * self.width)
+        end = min(start + (INDEX_BLOCK_SIZE * self.width), self.header_size + (self.count * self.width))
+        found = self.map.find(key, start, end)
+        # (a match has to start on a record boundary)
+        while 0 <= found and 0 != (found - self.header_size) % self.width:
+            found = self.map.find(key, found + 1, end)
+        return 0 <= found
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i].rstrip(b'\0').decode()
+
+    def fingerprint(self):
+        """
+        A hash of the whole index, to tell if a Bloom filter matches it.
+        Uses the digest of the records saved when the index was written (an older index without one is hashed in full).
+        """
+        if self.digest is None:
+            digest = hashlib.blake2b(digest_size=16)
+            digest.update(self.map[self.header_size:self.header_size + (self.count * self.width)])
+            self.digest = digest.digest()
+        return index_fingerprint(self.width, self.count, self.digest)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.file.close()
+        self.map = None
+        self.file = None
+
+
+def bloom_hashes(wallet_id):
+    # the bit positions are (h1 + i * h2) for i in range(num_hashes), from a single 128 bit hash (Kirsch-Mitzenmacher)
+    digest = hashlib.blake2b(wallet_id.encode(), digest_size=16).digest()
+    return (int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1)
+
+
+class WalletIdBloomFilter:
+    """
+    Read-only, memory-mapped Bloom filter of the id's in an index - "not in" the filter means not in the index.
+    """
+
+    def __init__(self, file_name):
+        self.file = open(file_name, mode='rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.num_bits, self.num_hashes, self.count, self.index_fingerprint) = BLOOM_HEADER.unpack_from(self.map, 0)
+        if magic != BLOOM_MAGIC:
+            raise Exception("Not a wallet id Bloom filter file: " + file_name)
+
+    def __contains__(self, wallet_id):
+        (h1, h2) = bloom_hashes(wallet_id)
+        bits = self.map
+        for i in range(self.num_hashes):
+            position = (h1 + (i * h2)) % self.num_bits
+            if not bits[BLOOM_HEADER.size + (position >> 3)] & (1 << (position & 7)):
+                return False
+        return True
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def write_bloom_filter(file_name, index, error_rate: float = WALLET_ID_BLOOM_ERROR_RATE):
+    """
+    Builds a Bloom filter of the id's in the index, sized for the target false positive rate.
+    """
+    count = max(1, len(index))
+    num_bits = max(64, int(math.ceil(-count * math.log(error_rate) / (math.log(2) ** 2))))
+    num_hashes = max(1, int(round((num_bits / count) * math.log(2))))
+    bits = bytearray((num_bits + 7) // 8)
+    for wallet_id in index:
+        (h1, h2) = bloom_hashes(wallet_id)
+        for i in range(num_hashes):
+            position = (h1 + (i * h2)) % num_bits
+            bits[position >> 3] |= (1 << (position & 7))
+
+    tmp_file_name = file_name + '.tmp'
+    with open(tmp_file_name, mode='wb') as bloom_file:
+        bloom_file.write(BLOOM_HEADER.pack(BLOOM_MAGIC, num_bits, num_hashes, len(index), index.fingerprint()))
+        bloom_file.write(bits)
+    os.replace(tmp_file_name, file_name)
+
+
+def read_delta_ids(file_name):
+    """
+    Reads the id's from the delta log (the csv export of wallet id's).
+    """
+    delta_ids = set()
+    if os.path.exists(file_name):
+        with open(file_name, mode='r') as delta_file:
+            for row in csv.DictReader(delta_file):
+                delta_ids.add(row["wallet_id"])
+    return delta_ids
+
+
+def reset_delta_log(file_name):
+    with open(file_name, mode='w') as delta_file:
+        csv.DictWriter(delta_file, fieldnames=WALLET_ID_FIELDS).writeheader()
+
+
+def write_index(file_name, sorted_ids, width):
+    """
+    Writes the (sorted) id's to a new index file, duplicates are dropped.
+    The index is written to a temp file and then renamed, so the current index can be read while it is written.
+    """
+    tmp_file_name = file_name + '.tmp'
+    count = 0
+    digest = hashlib.blake2b(digest_size=16)
+    with open(tmp_file_name, mode='wb') as index_file:
+        index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, width, 0, digest.digest()))
+        prev_id = None
+        for wallet_id in sorted_ids:
+            if wallet_id != prev_id:
+                record = wallet_id.encode().ljust(width, b'\0')
+                index_file.write(record)
+                digest.update(record)
+                count = count + 1
+                prev_id = wallet_id
+        index_file.seek(0)
+        index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, width, count, digest.digest()))
+    os.replace(tmp_file_name, file_name)
+    return count
+
+
+class WalletIdCache:
+    """
+    Set-like cache of wallet credential id's (supports "in", len() and add()).
+    """
+
+    def __init__(
+        self,
+        index_file: str = WALLET_ID_INDEX_FILE,
+        delta_file: str = WALLET_ID_DELTA_FILE,
+        delta_max: int = WALLET_ID_DELTA_MAX,
+        shared_delta_files=(),
+        use_bloom: bool = WALLET_ID_BLOOM,
+        bloom_file: str = WALLET_ID_BLOOM_FILE,
+    ):
+        """
+        Opens the cache, compacting it whenever the delta log has more than delta_max id's (None to never compact).
+        The id's in the shared delta files are read, but not appended to or compacted.
+        If use_bloom, the Bloom filter is loaded (and re-built if it doesn't match the index, unless the cache never compacts).
+        """
+        self.index_file = index_file
+        self.delta_file = delta_file
+        self.delta_max = delta_max
+        self.use_bloom = use_bloom
+        self.bloom_file = bloom_file
+        self.index = WalletIdIndex(index_file)
+        self.bloom = None
+        if use_bloom:
+            self.load_bloom(rebuild=(delta_max is not None))
+        self.delta_ids = set()
+        for file_name in [delta_file] + list(shared_delta_files):
+            self.delta_ids.update(wallet_id for wallet_id in read_delta_ids(file_name) if wallet_id not in self.index)
+        self.compact_if_full()
+
+    def __contains__(self, wallet_id):
+        if wallet_id in self.delta_ids:
+            return True
+        if self.bloom is not None and wallet_id not in self.bloom:
+            return False
+        return wallet_id in self.index
+
+    def load_bloom(self, rebuild: bool = True):
+        if self.bloom is not None:
+            self.bloom.close()
+            self.bloom = None
+        if os.path.exists(self.bloom_file):
+            bloom = WalletIdBloomFilter(self.bloom_file)
+            if bloom.index_fingerprint == self.index.fingerprint():
+                self.bloom = bloom
+                return
+            bloom.close()
+        if rebuild:
+            write_bloom_filter(self.bloom_file, self.index)
+            self.bloom = WalletIdBloomFilter(self.bloom_file)
+            print("Built wallet id Bloom filter:", self.bloom.num_bits // 8, "bytes,", self.bloom.num_hashes, "hashes")
+
+    def __len__(self):
+        return len(self.index) + len(self.delta_ids)
+
+    def add(self, wallet_ids):
+        """
+        Appends new id's to the delta log (and compacts the cache once the delta log gets too big).
+        """
+        new_ids = [wallet_id for wallet_id in wallet_ids if wallet_id not in self]
+        with open(self.delta_file, mode='a') as delta_file:
+            delta_writer = csv.DictWriter(delta_file, fieldnames=WALLET_ID_FIELDS, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+            if delta_file.tell() == 0:
+                delta_writer.writeheader()
+            for wallet_id in new_ids:
+                delta_writer.writerow({"type": "Indy::Credential", "wallet_id": wallet_id})
+        self.delta_ids.update(new_ids)
+        self.compact_if_full()
+
+    def compact_if_full(self):
+        if self.delta_max is not None and self.delta_max < len(self.delta_ids):
+            self.compact()
+
+    def compact(self):
+        """
+        Merges the delta log into the index, and empties the delta log.
+        """
+        width = max([self.index.width] + [len(wallet_id.encode()) for wallet_id in self.delta_ids])
+        self.rewrite(heapq.merge(iter(self.index), sorted(self.delta_ids)), width)
+        print("Compacted wallet id cache:", len(self.index), "id's")
+
+    def new_listing(self):
+        """
+        Opens an empty cache (in temp files next to this one) to load a full listing of the wallet into.
+        This cache isn't touched until the completed listing is swapped in with replace(), so an interrupted listing
+        leaves it as it was.
+        """
+        index_file = self.index_file + '.listing'
+        delta_file = self.delta_file + '.listing'
+        write_index(index_file, [], 0)
+        reset_delta_log(delta_file)
+        return WalletIdCache(index_file=index_file, delta_file=delta_file, delta_max=None, use_bloom=False)
+
+    def replace(self, listing):
+        """
+        Swaps in a completed listing (see new_listing()) as the contents of this cache.
+        """
+        listing.compact()
+        listing.close()
+        self.index.close()
+        os.replace(listing.index_file, self.index_file)
+        os.remove(listing.delta_file)
+        reset_delta_log(self.delta_file)
+        self.index = WalletIdIndex(self.index_file)
+        self.delta_ids = set()
+        if self.use_bloom:
+            self.load_bloom()
+
+    def rewrite(self, sorted_ids, width):
+        # the new index is written to a temp file and renamed, and the delta log is only reset once it is in place
+        # (if interrupted the delta log may repeat id's in the index, they are dropped when it is read)
+        write_index(self.index_file, sorted_ids, width)
+        self.index.close()
+        reset_delta_log(self.delta_file)
+        self.index = WalletIdIndex(self.index_file)
+        self.delta_ids = set()
+        if self.use_bloom:
+            self.load_bloom()
+
+    def close(self):
+        self.index.close()
+        if self.bloom is not None:
+            self.bloom.close()
+
+
+def shard_delta_file(shard):
+    (shard_index, shard_count) = shard
+    return WALLET_ID_SHARD_DELTA_FILE.format(shard_index, shard_count)
+
+
+def open_shard_cache(shard):
+    """
+    Opens the cache for one shard of a sharded audit (which never compacts, since the other shards are using the index).
+    """
+    return WalletIdCache(delta_file=shard_delta_file(shard), delta_max=None, shared_delta_files=[WALLET_ID_DELTA_FILE])
+
+
+def merge_shard_delta_logs(shard_count):
+    """
+    Merges the delta logs of all the shards of a sharded audit into the main delta log (compacting it if it gets too big).
+    """
+    wallet_id_cache = WalletIdCache()
+    for shard_index in range(shard_count):
+        file_name = shard_delta_file((shard_index, shard_count))
+        if os.path.exists(file_name):
+            wallet_id_cache.add(read_delta_ids(file_name))
+            os.remove(file_name)
+    wallet_id_cache.close()
+
+
+# mainline
+if __name__ == "__main__":
+    """
+    Merges the delta log into the index (e.g. to compact the cache ahead of an audit run).
+    """
+    wallet_id_cache = WalletIdCache()
+    wallet_id_cache.compact()
+    wallet_id_cache.close()